@@ -54,7 +54,11 @@ class Config(JSONConf):
     :param api_rel_path: metriqued api uri prefix (api/v2)
     :param auto_login:
         automatically attempt to log-in to metriqued host (False)
-    :param batch_size: The number of objs save at a time (5000)
+    :param batch_size:
+        The number of objs saved or streamed back at a time (1000)
+    :param compress_threshold:
+        min size, in bytes, of request bodies sent gzip compressed,
+        to servers which accept them; 0 disables compression (4096)
     :param cookiejar: path to file for storing cookies (~/.metrique/.cookiejar)
     :param configdir: path to where config files are located (~/.metrique/etc)
     :param cube_autoregister:
@@ -62,16 +66,48 @@ class Config(JSONConf):
     :param cube_pkgs: list of package names where to search for cubes ('cubes')
     :param cube_paths: Additional paths to search for client cubes (None)
     :param debug: turn on debug mode logging (level: INFO)
+    :param export_retries:
+        number of times a failed (or truncated) export download is
+        retried (2)
     :param gnupg_dir: path to where user gnupg data directory (~/.gnupg)
     :param gnupg_fingerprint: gpnupg fingerprint to sign/verify with (None)
     :param host: metriqued server host(s) (single string or list or strings)
+    :param host_max_failures:
+        failures in a row before a host is considered down (3)
+    :param host_ping_interval:
+        seconds between background pings of multiple hosts; 0 disables.
+        least_latency orders hosts by their ping round trips (30)
+    :param host_reset_timeout:
+        seconds before a host considered down is tried again (30)
+    :param host_strategy:
+        order hosts are tried in; ordered, round_robin or least_latency
+        (round_robin)
+    :param keep_alive: keep connections to metriqued open for reuse (True)
     :param logdir: path to where log files are stored (~/.metrique/logs)
     :param logfile: filename for logs ('metrique.log')
     :param log2file: boolean - log output to file? (False)
     :param logstout: boolean - log output to stdout? (True)
     :param max_workers: number of workers for threaded operations (#cpus)
     :param password: the password to connect to metriqued with (None)
+    :param pool_connections: number of hosts to pool connections for (10)
+    :param pool_maxsize: max number of pooled connections per host (10)
     :param port: metriqued server port (5420)
+    :param request_timeout:
+        seconds to wait for the server to respond (or send more of a
+        response); None waits forever (None)
+    :param request_timings_size:
+        number of most recent request timings kept (1000)
+    :param save_client_start:
+        stamp objects saved without _start with the client's current
+        time, rather than the server's; retried batches then keep
+        their _start (False)
+    :param save_retries:
+        number of times a failed batch save is retried (3)
+    :param save_retry_delay:
+        seconds before the first retry; doubled per retry (1)
+    :param save_spread:
+        spread concurrent batch saves across all hosts (False)
+    :param save_workers: number of batch saves run concurrently (1)
     :param sql_retries: number of attempts to run sql queries before excepting
     :param sql_batch_size: number of objects to sql query for at a time (1000)
     :param ssl: connect to metriqued with SSL (False)
@@ -79,6 +115,8 @@ class Config(JSONConf):
     :param tmpdir: path to temporary data storage (~/.metrique/tmp)
     :param username: the username to connect to metriqued with ($USERNAME)
     :param userdir: path to metrique user directory (~/.metrique)
+    :param wire_format:
+        preferred wire format; msgpack, bson or json (None: best available)
     '''
     default_config = DEFAULT_CONFIG
     default_config_dir = CONFIG_DIR
@@ -89,22 +127,38 @@ class Config(JSONConf):
             'api_rel_path': 'api/v2',
             'auto_login': False,
             'batch_size': 1000,
+            'compress_threshold': 4096,
             'cookiejar': COOKIEJAR,
             'configdir': self.default_config_dir,
             'cube_autoregister': False,
             'cube_pkgs': ['cubes'],
             'cube_paths': [],
             'debug': None,
+            'export_retries': 2,
             'gnupg_dir': GNUPG_DIR,
             'gnupg_fingerprint': None,
             'host': '127.0.0.1',
+            'host_max_failures': 3,
+            'host_ping_interval': 30,
+            'host_reset_timeout': 30,
+            'host_strategy': 'round_robin',
+            'keep_alive': True,
             'logdir': LOG_DIR,
             'logfile': 'metrique.log',
             'log2file': True,
             'logstdout': True,
             'max_workers': multiprocessing.cpu_count(),
             'password': None,
+            'pool_connections': 10,
+            'pool_maxsize': 10,
             'port': 5420,
+            'request_timeout': None,
+            'request_timings_size': 1000,
+            'save_client_start': False,
+            'save_retries': 3,
+            'save_retry_delay': 1,
+            'save_spread': False,
+            'save_workers': 1,
             'sql_retries': 1,
             'sql_batch_size': 500,
             'ssl': False,
@@ -112,6 +166,7 @@ class Config(JSONConf):
             'tmpdir': TMP_DIR,
             'username': os.getenv('USER'),
             'userdir': USER_DIR,
+            'wire_format': None,
         }
         # apply defaults
         self.config.update(config)
@@ -69,6 +69,7 @@ And finishing with some querying and simple charting of the data.
     valid date format: '%Y-%m-%d %H:%M:%S,%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'
 '''
 
+from collections import deque
 from copy import copy
 import cPickle
 import gc
@@ -79,18 +80,33 @@ import os
 import pandas as pd
 import re
 import requests
+from requests.adapters import HTTPAdapter
 import simplejson as json
+from threading import Lock
+from time import time
 import urllib
+from urlparse import urlparse
+import zlib
 
 from metrique import query_api, user_api, cube_api
 from metrique import regtest as regression_test
 from metrique.config import Config
+from metrique.hosts import get_selector
 from metrique.utils import json_encode, get_cube
 from metriqueu.utils import utcnow
+from metriqueu import wire
 
 logger = logging.getLogger(__name__)
 
 FILETYPES = {'csv': pd.read_csv, 'json': pd.read_json}
+WIRE_FORMATS = {'json': wire.JSON, 'msgpack': wire.MSGPACK,
+                'bson': wire.BSON}
+# response status codes which count as a host failure
+UNAVAILABLE = (502, 503, 504)
+# bytes read (and written to disk) at a time, when saving streamed responses
+STREAM_CHUNK_SIZE = 1048576
+# cookiejar files might be saved from concurrent (eg, export) threads
+COOKIEJAR_LOCK = Lock()
 fields_re = re.compile('[\W]+')
 space_re = re.compile('\s+')
 unda_re = re.compile('_')
@@ -513,8 +529,16 @@ class HTTPClient(BaseClient):
     cube_index_list = cube_api.list_index
     cube_index = cube_api.ensure_index
     cube_index_drop = cube_api.drop_index
+    cube_index_advice = cube_api.index_advice
+    cube_rollup_info = cube_api.rollup_info
+    cube_rollup = cube_api.rollup
+    cube_rollup_drop = cube_api.drop_rollup
+    cube_snapshot_list = cube_api.list_snapshots
+    cube_snapshot = cube_api.snapshot
+    cube_snapshot_drop = cube_api.drop_snapshot
 
     query_find = find = query_api.find
+    query_find_pages = find_pages = query_api.find_pages
     query_history = history = query_api.history
     query_deptree = deptree = query_api.deptree
     query_count = count = query_api.count
@@ -532,6 +556,18 @@ class HTTPClient(BaseClient):
         super(HTTPClient, self).__init__(cube_autoregister=cube_autoregister,
                                          **kwargs)
         self.owner = owner or self.config.username
+        # (method, url, status code, seconds) of the most recent requests
+        self.request_timings = deque(
+            maxlen=self.config.request_timings_size)
+        api_uris = self.config.api_uris
+        self.hosts = get_selector(api_uris,
+                                  strategy=self.config.host_strategy,
+                                  max_failures=self.config.host_max_failures,
+                                  reset_timeout=self.config.host_reset_timeout)
+        if len(api_uris) > 1:
+            pings = [os.path.join(uri, 'ping') for uri in api_uris]
+            self.hosts.start_pings(pings, self.config.host_ping_interval,
+                                   verify=self.config.ssl_verify)
         # load a new requests session; for the cookies.
         self._load_session()
 
@@ -561,20 +597,60 @@ class HTTPClient(BaseClient):
         '''Return the common cube id string; ie, `%(owner)s__%(name)s`'''
         return '__'.join((self.owner, self.name))
 
-    def _build_runner(self, kind, kwargs):
+    def _build_runner(self, kind, url, kwargs, data=None, headers=None):
         '''Generic caller for HTTP
-            A) POST; use data, not params
-            B) otherwise; use params
+            A) raw request body (data); use params for the rest
+            B) POST; use data, not params; binary encoded, if the
+               server accepts any of our preferred wire formats
+            C) otherwise; use params
         '''
-        kwargs_json = self._kwargs_json(**kwargs)
-        if kind == self.session.post:
+        headers = dict(headers or {})
+        formats = self._wire_formats()
+        headers.setdefault('Accept', ', '.join(formats))
+        if data is not None:
+            # callables are called to get a fresh (eg, generator) body
+            data = data() if callable(data) else data
+            runner = partial(kind, data=data, headers=headers,
+                             params=self._kwargs_json(**kwargs))
+        elif kind == self.session.post:
+            content_type = self._request_format(url, formats)
+            if content_type == wire.JSON:
+                data = self._kwargs_json(**kwargs)
+            else:
+                headers['Content-Type'] = content_type
+                data = wire.encode(kwargs, content_type)
+            data = self._compress(url, data, headers)
             # use data instead of params
-            runner = partial(kind, data=kwargs_json)
+            runner = partial(kind, data=data, headers=headers)
         else:
-            runner = partial(kind, params=kwargs_json)
+            runner = partial(kind, params=self._kwargs_json(**kwargs),
+                             headers=headers)
         return runner
 
-    def _build_urls(self, cmd, api_url):
+    def _compress(self, url, data, headers):
+        '''
+        gzip compress request bodies over config.compress_threshold
+        bytes, if the server accepts gzip compressed request bodies.
+        '''
+        threshold = self.config.compress_threshold
+        if not threshold or threshold <= 0:
+            return data
+        netloc = urlparse(url).netloc
+        if 'gzip' not in self._server_encodings.get(netloc, ()):
+            return data
+        if isinstance(data, dict):
+            # form encode ourselves, so the encoded body can be compressed
+            data = urllib.urlencode(
+                [(k, v.encode('utf8') if isinstance(v, unicode) else v)
+                 for k, v in data.iteritems()])
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if len(data) < threshold:
+            return data
+        z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        headers['Content-Encoding'] = 'gzip'
+        return z.compress(data) + z.flush()
+
+    def _build_urls(self, cmd, api_url, host_offset=0):
         ' generic path joininer for http api commands '
         cmd = cmd or ''
         join = os.path.join
@@ -582,7 +658,8 @@ class HTTPClient(BaseClient):
             urls = [join(api_uri, cmd) for api_uri in self.config.api_uris]
         else:
             urls = [join(uri, cmd) for uri in self.config.uris]
-        return urls
+        # ordered by the host selector; hosts which are down go last
+        return self.hosts.order(urls, host_offset)
 
     def cookiejar_clear(self):
         '''Delete existing user cookiejar, if it exists'''
@@ -601,12 +678,24 @@ class HTTPClient(BaseClient):
                 pass
             else:
                 self.session.cookies.update(cookiejar)
+                self._saved_cookies = self._cookies_state()
 
     def cookiejar_save(self):
-        '''Save current session cookies to cookiejar, if possible'''
+        '''Save current session cookies to cookiejar, if possible and
+        if they changed since the cookiejar was last loaded or saved'''
+        cookies = self._cookies_state()
+        if cookies == self._saved_cookies:
+            return
         path = '%s.%s' % (self.config.cookiejar, self.config.username)
-        with open(path, 'w') as f:
-            cPickle.dump(self.session.cookies, f)
+        with COOKIEJAR_LOCK:
+            with open(path, 'w') as f:
+                cPickle.dump(self.session.cookies, f)
+        self._saved_cookies = cookies
+
+    def _cookies_state(self):
+        ' comparable snapshot of the current session cookies '
+        return sorted((c.domain, c.path, c.name, c.value, c.expires)
+                      for c in self.session.cookies)
 
     def _delete(self, *args, **kwargs):
         ' requests DELETE; using current session '
@@ -681,18 +770,31 @@ class HTTPClient(BaseClient):
     def _get_response(self, runner, _url, username, password,
                       allow_redirects=True, stream=False):
         ' wrapper for running a metrique api request; get/post/etc '
-        # avoids bug in requests-2.0.1 - pass a dict no RequestsCookieJar
-        # eg, see: https://github.com/kennethreitz/requests/issues/1744
-        dfc = requests.utils.dict_from_cookiejar
+        start = time()
+        # the session keeps the (updated) cookies itself
         _response = runner(_url, auth=(username, password),
-                           cookies=dfc(self.session.cookies),
                            verify=self.config.ssl_verify,
                            allow_redirects=allow_redirects,
-                           stream=stream)
+                           stream=stream,
+                           timeout=self.config.request_timeout)
+        # until the response body is received, unless it's streamed
+        elapsed = time() - start
+        method = _response.request.method
+        self.request_timings.append(
+            (method, _url, _response.status_code, elapsed))
+        logger.debug('%s %s [%s] %.3fs' % (method, _url,
+                                           _response.status_code, elapsed))
 
-        self.session.cookies = _response.cookies
         self.cookiejar_save()
 
+        netloc = urlparse(_url).netloc
+        formats = _response.headers.get(wire.FORMATS_HEADER)
+        if formats:
+            self._server_formats[netloc] = set(formats.split(','))
+        encodings = _response.headers.get(wire.ENCODINGS_HEADER)
+        if encodings:
+            self._server_encodings[netloc] = set(encodings.split(','))
+
         try:
             _response.raise_for_status()
         except Exception as e:
@@ -711,7 +813,20 @@ class HTTPClient(BaseClient):
 
     def _load_session(self):
         ' load a fresh new requests session; mainly, reset cookies '
-        self.session = requests.Session()
+        if getattr(self, 'session', None):
+            # release the old session's pooled connections
+            self.session.close()
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.config.pool_connections,
+                              pool_maxsize=self.config.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.config.keep_alive:
+            session.headers['Connection'] = 'close'
+        self.session = session
+        self._server_formats = {}
+        self._server_encodings = {}
+        self._saved_cookies = None
         self.cookiejar_load()
 
     def ping(self, auth=False):
@@ -739,44 +854,59 @@ class HTTPClient(BaseClient):
 
     def _run(self, kind, cmd, api_url=True,
              allow_redirects=True, full_response=False,
-             stream=False, filename=None, **kwargs):
+             stream=False, filename=None, data=None, headers=None,
+             host_offset=0, **kwargs):
         '''
         wrapper for handling all requests; authentication,
         preparing arguments, calling request, handling
         exceptions, returning results.
+
+        Hosts are tried in the order of the config'd host selection
+        strategy, rotated by host_offset, until one can be reached.
         '''
         username = self.config.username
         password = self.config.password
 
-        runner = self._build_runner(kind, kwargs)
-
-        urls = self._build_urls(cmd, api_url)
+        urls = self._build_urls(cmd, api_url, host_offset)
         for url in urls:
             logger.debug("Connecting to %s" % url)
+            runner = self._build_runner(kind, url, kwargs, data, headers)
             try:
                 _response = self._get_response(runner, url,
                                                username, password,
                                                allow_redirects,
                                                stream)
             except requests.exceptions.ConnectionError:
+                self.hosts.failure(url)
                 logger.error("Failed to connect to %s" % url)
                 # try the next url available
                 continue
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code in UNAVAILABLE:
+                    self.hosts.failure(url)
+                else:
+                    self.hosts.success(url)
+                raise
             else:
+                # latency is sampled by the pings only; request durations
+                # depend on the request (eg, a large find) more than
+                # on the host's health
+                self.hosts.success(url)
                 logger.debug("Got response from %s" % url)
 
             if full_response:
                 return _response
             elif stream:
-                with open(filename, 'wb') as handle:
-                    for block in _response.iter_content(1024):
+                with open(filename, 'wb', STREAM_CHUNK_SIZE) as handle:
+                    for block in _response.iter_content(STREAM_CHUNK_SIZE):
                         if not block:
                             break
                         handle.write(block)
                 return filename
             else:
                 try:
-                    return json.loads(_response.content)
+                    content_type = _response.headers.get('Content-Type')
+                    return wire.decode(_response.content, content_type)
                 except Exception as e:
                     m = getattr(e, 'message')
                     content = '%s\n%s\n%s' % (url, m, _response.content)
@@ -794,11 +924,36 @@ class HTTPClient(BaseClient):
             if key in self.session.cookies:
                 self.session.cookies.pop(key)
 
+    def _request_format(self, url, formats):
+        ' pick the first of our wire formats the server accepts '
+        netloc = urlparse(url).netloc
+        accepted = self._server_formats.get(netloc, ())
+        for content_type in formats:
+            if content_type in accepted:
+                return content_type
+        return wire.JSON
+
     def _save(self, filename, *args, **kwargs):
         ' requests GET of a "file stream" using current session '
         return self._run(self.session.get, stream=True, filename=filename,
                          *args, **kwargs)
 
+    def _wire_formats(self):
+        ' locally available wire formats, in order of preference '
+        preferred = self.config.wire_format
+        if not preferred:
+            return wire.available_formats()
+        elif preferred not in WIRE_FORMATS:
+            raise ValueError('Invalid wire_format: %s' % preferred)
+        content_type = WIRE_FORMATS[preferred]
+        if content_type not in wire.available_formats():
+            raise RuntimeError('%s module is not installed' % preferred)
+        if content_type == wire.JSON:
+            return [wire.JSON]
+        else:
+            # always fallback to json
+            return [content_type, wire.JSON]
+
     def whoami(self, auth=False):
         '''Request user profile status of currently authenticated user
         :param auth: (bool) login/authenticate before querying?
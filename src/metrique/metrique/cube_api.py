@@ -9,11 +9,27 @@ metrique.cube_api
 This module contains all Cube related api functionality.
 '''
 
-from metriqueu.utils import batch_gen
+from collections import OrderedDict
+from functools import partial
+import gzip
+from multiprocessing.pool import ThreadPool
+import os
+from requests.exceptions import ChunkedEncodingError
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+import shutil
+import simplejson as json
+import time
+import zlib
+
+from metrique.utils import ndjson_gen
+from metriqueu.utils import batch_gen, dt2ts, utcnow
 
 import logging
 logger = logging.getLogger(__name__)
 
+# bytes copied at a time, when combining export shards
+COPY_BUFFER_SIZE = 1048576
+
 
 def list_all(self, startswith=None):
     '''
@@ -166,27 +182,197 @@ def drop_index(self, index_or_name, cube=None, owner=None):
     return self._delete(cmd, drop=index_or_name)
 
 
+def index_advice(self, query=None, date=None, apply=False, cube=None,
+                 owner=None):
+    '''
+    Check the cube's indexes against the indexes (temporal) queries
+    are planned to use; returning back the missing and redundant
+    indexes and summaries of the query plans of current value and
+    as of date versions of the given query.
+
+    :param query: `pql` query to explain
+    :param date: as of date to explain; defaults to now
+    :param apply: create the missing indexes
+    :param cube: cube name
+    :param owner: username of cube owner
+    '''
+    cmd = self.get_cmd(owner, cube, 'index_advice')
+    if apply:
+        return self._post(cmd, query=query, date=date)
+    else:
+        return self._get(cmd, query=query, date=date)
+
+
+######### ROLLUP #########
+def rollup_info(self, cube=None, owner=None):
+    '''
+    Get the cube's rollup fields (None if the cube has no rollups)
+    and the number of rollup docs.
+
+    :param cube: cube name
+    :param owner: username of cube owner
+    '''
+    cmd = self.get_cmd(owner, cube, 'rollup')
+    return self._get(cmd)
+
+
+def rollup(self, fields=None, cube=None, owner=None):
+    '''
+    Keep daily rollups of the cube, which unfiltered history
+    queries (by one of the given fields, or none) are answered
+    from; (re)building them from the cube's objects.
+
+    :param fields: list of fields to roll up (history by_field)
+    :param cube: cube name
+    :param owner: username of cube owner
+    '''
+    cmd = self.get_cmd(owner, cube, 'rollup')
+    return self._post(cmd, fields=fields)
+
+
+def drop_rollup(self, cube=None, owner=None):
+    '''
+    Stop keeping daily rollups of the cube and remove them.
+
+    :param cube: cube name
+    :param owner: username of cube owner
+    '''
+    cmd = self.get_cmd(owner, cube, 'rollup')
+    return self._delete(cmd)
+
+
+######### SNAPSHOT #########
+def list_snapshots(self, cube=None, owner=None):
+    '''
+    List the cube's snapshots (date, creation date and size).
+
+    :param cube: cube name
+    :param owner: username of cube owner
+    '''
+    cmd = self.get_cmd(owner, cube, 'snapshot')
+    return self._get(cmd)
+
+
+def snapshot(self, date, cube=None, owner=None):
+    '''
+    Build (or rebuild) a snapshot of the cube as of the given date;
+    find and count queries of (or near) that date are served from it.
+
+    :param date: date of the snapshot
+    :param cube: cube name
+    :param owner: username of cube owner
+    '''
+    cmd = self.get_cmd(owner, cube, 'snapshot')
+    return self._post(cmd, date=date)
+
+
+def drop_snapshot(self, date, cube=None, owner=None):
+    '''
+    Drop the cube's snapshot of the given date.
+
+    :param date: date of the snapshot
+    :param cube: cube name
+    :param owner: username of cube owner
+    '''
+    cmd = self.get_cmd(owner, cube, 'snapshot')
+    return self._delete(cmd, date=date)
+
+
 ######## SAVE/REMOVE ########
+def _save_batch(self, cmd, start_time, autosnap, batch, host_offset=0):
+    '''
+    Save a batch of objects; failed saves are retried, with
+    exponential backoff, unless the server rejected the batch (4xx).
+    '''
+    delay = self.config.save_retry_delay
+    retries = self.config.save_retries
+    for attempt in range(retries + 1):
+        try:
+            return self._post(cmd, objects=batch, start_time=start_time,
+                              autosnap=autosnap, host_offset=host_offset)
+        except (ConnectionError, HTTPError, Timeout) as e:
+            response = getattr(e, 'response', None)
+            rejected = response is not None and response.status_code < 500
+            if rejected or attempt == retries:
+                raise
+            logger.warn('batch save failed (%s); retrying in %ss' % (
+                e, delay))
+            time.sleep(delay)
+            delay *= 2
+
+
+def _oid_batches(objects, batch_size):
+    '''
+    Batch objects so all the versions of an _oid are in the same
+    batch, in their original order; batches only exceed batch_size
+    when a single _oid has more versions than that.
+    '''
+    groups = OrderedDict()
+    for obj in objects:
+        groups.setdefault(obj.get('_oid'), []).append(obj)
+    batch = []
+    for group in groups.itervalues():
+        if batch and len(batch) + len(group) > batch_size:
+            yield batch
+            batch = []
+        batch.extend(group)
+    if batch:
+        yield batch
+
+
 def _save_default(self, objects, start_time, owner, cube, autosnap):
     batch_size = self.config.batch_size
     cmd = self.get_cmd(owner, cube, 'save')
+    start_time = dt2ts(start_time)
+    if not start_time and self.config.save_client_start:
+        # one start_time for all the batches; so a retried batch which
+        # was saved already doesn't get a new (serverside) _start
+        start_time = utcnow()
+    save = partial(_save_batch, self, cmd, start_time, autosnap)
     olen = len(objects) if objects else None
     if (batch_size <= 0) or (olen <= batch_size):
-        saved = self._post(cmd, objects=objects, start_time=start_time,
-                           autosnap=autosnap)
+        return save(objects)
+
+    if self.config.save_workers > 1:
+        # concurrent batches must not rotate versions of the same _oid
+        batches = list(_oid_batches(objects, batch_size))
+    else:
+        batches = list(batch_gen(objects, batch_size))
+    workers = min(self.config.save_workers, len(batches))
+    spread = self.config.save_spread
+
+    def _save(args):
+        k, batch = args
+        # with spread, batch k is sent to the k'th host first
+        return save(batch, host_offset=k if spread else 0)
+
+    if workers > 1:
+        # batches are encoded and posted by the workers, so
+        # several batches are in flight at once
+        pool = ThreadPool(workers)
+        try:
+            # results are returned in batch order
+            results = pool.map(_save, enumerate(batches))
+        finally:
+            pool.close()
+            pool.join()
     else:
-        saved = []
-        k = 0
-        for batch in batch_gen(objects, batch_size):
-            _saved = self._post(cmd, objects=batch, start_time=start_time,
-                                autosnap=autosnap)
-            saved.extend(_saved)
-            k += len(batch)
-    return saved
+        results = map(_save, enumerate(batches))
+    return [_id for saved in results for _id in saved]
+
+
+def _save_stream(self, objects, owner, cube, autosnap):
+    batch_size = self.config.batch_size
+    cmd = self.get_cmd(owner, cube, 'save_stream')
+    # a new generator is built per request attempt (host)
+    body = partial(ndjson_gen, objects, gzip=True, batch_size=batch_size)
+    headers = {'Content-Type': 'application/x-ndjson',
+               'Content-Encoding': 'gzip'}
+    return self._post(cmd, data=body, headers=headers, autosnap=autosnap)
 
 
 def save(self, objects=None, cube=None, owner=None, start_time=None,
-         flush=True, autosnap=True):
+         flush=True, autosnap=True, stream=False):
     '''
     Save a list of objects the given metrique.cube.
     Returns back a list of object ids (_id|_oid) saved.
@@ -194,15 +380,33 @@ def save(self, objects=None, cube=None, owner=None, start_time=None,
     :param objects: list of dictionary-like objects to be stored
     :param cube: cube name
     :param owner: username of cube owner
-    :param start_time: ISO format datetime to apply as _start
-                       per object, serverside
+    :param start_time: ISO format datetime (or epoch) to apply as
+                       _start to objects without one, serverside;
+                       defaults to the server's current time
     :param flush: flush objects from memory after save
     :param autosnap: rotate _end:None's before saving new objects
+    :param stream: stream objects as gzipped newline-delimited JSON
+                   in a single request, rather than in batched requests
     :returns result: _ids saved
+
+    With config.save_workers > 1, batches are saved concurrently;
+    all versions of an _oid are then saved in the same batch.
+
+    With config.save_client_start, start_time defaults to the
+    client's current time instead; the same for all batches and
+    their retries. The client's clock must then be in sync with the
+    server's; rotated versions' _end is the new version's _start.
+
+    With stream=True, the batches the server saved before a failure
+    are kept; the HTTPError's response body (JSON) lists their _ids
+    under 'saved'.
     '''
     if not objects:
         logger.info("... No objects to save")
         result = []
+    elif stream:
+        logger.info("Streaming %s objects" % len(objects))
+        result = _save_stream(self, objects, owner, cube, autosnap)
     else:
         logger.info("Saving %s objects" % len(objects))
         result = _save_default(self, objects, start_time, owner, cube,
@@ -240,13 +444,124 @@ def remove(self, query, date=None, cube=None, owner=None):
     return result
 
 
-def export(self, filename, cube=None, owner=None):
+def export(self, filename, cube=None, owner=None, query=None, fields='~',
+           date='~', _format='json', shards=1, workers=4):
     '''
-    Export a cube to compressed (gzip) json
+    Export a cube to compressed (gzip), newline delimited json
+    (or concatenated bson) objects. By default, all versions of
+    all objects are exported.
 
-    :param filename: path/filename of results export.tgz file
+    With shards > 1, the cube is split into _id ranges which are
+    downloaded concurrently, then combined into a single file. If
+    the export is interrupted, calling export again with the same
+    arguments only downloads the shards which are still missing.
+
+    :param filename: path/filename of results export .gz file
     :param cube: cube name
     :param owner: username of cube owner
+    :param query: `pql` query to filter the exported objects with
+    :param fields: fields to export; '~' exports whole objects
+    :param date: date (metrique date range) to export versions of
+    :param _format: 'json' or 'bson'
+    :param shards: number of _id ranges to split the export into
+    :param workers: max number of shards downloaded concurrently
     '''
     cmd = self.get_cmd(owner, cube, 'export')
-    return self._save(cmd=cmd, filename=filename)
+    kwargs = dict(query=query, fields=fields, date=date, format=_format)
+    if shards <= 1:
+        return _export_shard(self, cmd, kwargs, (filename, (None, None)))
+
+    splits = _export_splits(self, filename, owner, cube, shards, kwargs)
+    ranges = zip([None] + splits, splits + [None])
+    paths = ['%s.%03d' % (filename, i) for i in range(len(ranges))]
+    todo = [(path, _range) for path, _range in zip(paths, ranges)
+            if not os.path.exists(path)]
+    logger.debug('exporting %s of %s shards' % (len(todo), len(paths)))
+    if todo:
+        pool = ThreadPool(max(min(workers, len(todo)), 1))
+        try:
+            # shards downloaded before any failure are kept, for resuming
+            pool.map(partial(_export_shard, self, cmd, kwargs), todo)
+        finally:
+            pool.close()
+            pool.join()
+
+    # concatenated gzip files are a valid (multi-member) gzip file
+    with open(filename, 'wb') as f_out:
+        for path in paths:
+            with open(path, 'rb') as f_in:
+                shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+    for path in paths:
+        os.remove(path)
+    os.remove('%s.shards' % filename)
+    return filename
+
+
+def _export_splits(self, filename, owner, cube, shards, kwargs):
+    '''
+    Load the _id splits of an earlier, interrupted export of the
+    same cube with the same arguments; or get new splits from the
+    server, discarding any stale shards.
+    '''
+    path = '%s.shards' % filename
+    manifest = dict(cmd=self.get_cmd(owner, cube, 'export'),
+                    shards=shards, kwargs=kwargs)
+    if os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+        splits = saved.pop('splits')
+        if saved == json.loads(json.dumps(manifest)):
+            return splits
+        for i in range(len(splits) + 1):
+            shard = '%s.%03d' % (filename, i)
+            if os.path.exists(shard):
+                os.remove(shard)
+    cmd = self.get_cmd(owner, cube, 'export_splits')
+    manifest['splits'] = self._get(cmd, splits=shards)
+    with open(path, 'w') as f:
+        json.dump(manifest, f)
+    return manifest['splits']
+
+
+def _gzip_complete(path):
+    '''
+    Check a gzip file can be decompressed to its end; truncated
+    files fail with an early EOF or a CRC/length mismatch.
+    '''
+    try:
+        f = gzip.GzipFile(path, 'rb')
+        try:
+            while f.read(COPY_BUFFER_SIZE):
+                pass
+        finally:
+            f.close()
+    except (IOError, EOFError, zlib.error):
+        return False
+    return True
+
+
+def _export_shard(self, cmd, kwargs, shard):
+    '''
+    Download a single export shard; the shard file only
+    exists once it has been completely downloaded and its gzip
+    content verified. Failed downloads are retried.
+    '''
+    path, (id_min, id_max) = shard
+    part = '%s.part' % path
+    retries = self.config.export_retries
+    for attempt in range(retries + 1):
+        try:
+            self._save(cmd=cmd, filename=part, id_min=id_min,
+                       id_max=id_max, **kwargs)
+        except (ConnectionError, ChunkedEncodingError) as e:
+            error = e
+        else:
+            if _gzip_complete(part):
+                os.rename(part, path)
+                return path
+            error = 'truncated gzip content'
+        if os.path.exists(part):
+            os.remove(part)
+        if attempt == retries:
+            raise IOError('export of %s failed: %s' % (path, error))
+        logger.warn('export of %s failed (%s); retrying' % (path, error))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+# Author: "Chris Ward" <cward@redhat.com>
+
+'''
+metrique.hosts
+~~~~~~~~~~~~~~
+
+This module contains the host selector metrique clients use to
+spread requests across multiple metriqued hosts and to route
+around hosts which are down.
+'''
+
+import logging
+import requests
+from threading import Lock, Thread
+from time import sleep, time
+from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ('ordered', 'round_robin', 'least_latency')
+# weight of the newest sample in the moving average of host latencies
+LATENCY_ALPHA = 0.3
+
+_selectors = {}
+_selectors_lock = Lock()
+
+
+def get_selector(uris, strategy='round_robin', max_failures=3,
+                 reset_timeout=30):
+    '''
+    Return back the (process wide) host selector of the given hosts,
+    so all clients of the same hosts share their health details.
+
+    :param uris: list of metriqued host uris
+    :param strategy: host selection strategy; see HostSelector
+    :param max_failures: see HostSelector
+    :param reset_timeout: see HostSelector
+    '''
+    key = (tuple(uris), strategy, max_failures, reset_timeout)
+    with _selectors_lock:
+        if key not in _selectors:
+            _selectors[key] = HostSelector(strategy, max_failures,
+                                           reset_timeout)
+        return _selectors[key]
+
+
+class HostSelector(object):
+    '''
+    Order the hosts (urls) a request should be tried on, according
+    to the selection strategy:
+
+        * ordered: in config order; the first host takes all the load
+        * round_robin: starting with the next host, per request
+        * least_latency: fastest (moving average) ping round trip
+          first; see start_pings
+
+    Hosts are tracked by network location (host:port). Hosts which
+    fail `max_failures` times in a row are considered down (circuit
+    open) and are only tried after all the other hosts, until
+    `reset_timeout` seconds have passed. Then they're tried again
+    as usual; a single failure opens the circuit again.
+
+    :param strategy: host selection strategy
+    :param max_failures: failures in a row before a host is down
+    :param reset_timeout: seconds before down hosts are tried again
+    '''
+    def __init__(self, strategy='round_robin', max_failures=3,
+                 reset_timeout=30):
+        if strategy not in STRATEGIES:
+            raise ValueError('Invalid host strategy: %s; expected one of %s'
+                             % (strategy, STRATEGIES))
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self._hosts = {}
+        self._lock = Lock()
+        self._next = 0
+        self._pinger = None
+
+    def _host(self, url):
+        netloc = urlparse(url).netloc
+        if netloc not in self._hosts:
+            self._hosts[netloc] = {'failures': 0, 'opened': None,
+                                   'latency': None}
+        return self._hosts[netloc]
+
+    def _up(self, url, now):
+        host = self._host(url)
+        opened = host['opened']
+        return opened is None or now - opened >= self.reset_timeout
+
+    def order(self, urls, offset=0):
+        '''
+        Return back the urls in the order they should be tried.
+
+        :param urls: list of urls, one per host
+        :param offset: number of hosts to rotate the order by
+        '''
+        if len(urls) <= 1:
+            return list(urls)
+        with self._lock:
+            now = time()
+            up = [url for url in urls if self._up(url, now)]
+            down = [url for url in urls if url not in up]
+            # the load is spread across the hosts which are up only
+            k = offset
+            if self.strategy == 'round_robin':
+                k += self._next
+                self._next += 1
+            if up:
+                k %= len(up)
+                up = up[k:] + up[:k]
+            if self.strategy == 'least_latency':
+                # hosts without latency samples yet are tried first
+                up.sort(key=lambda url: self._host(url)['latency'] or 0)
+        return up + down
+
+    def success(self, url, latency=None):
+        '''
+        Record a successful request, closing the host's circuit.
+
+        :param url: requested url
+        :param latency: seconds the request took; only sampled for
+                        requests of constant cost, ie pings
+        '''
+        with self._lock:
+            host = self._host(url)
+            if host['opened'] is not None:
+                logger.info('%s is back up' % urlparse(url).netloc)
+            host['failures'] = 0
+            host['opened'] = None
+            if latency is not None:
+                last = host['latency']
+                if last is None:
+                    host['latency'] = latency
+                else:
+                    host['latency'] = (LATENCY_ALPHA * latency +
+                                       (1 - LATENCY_ALPHA) * last)
+
+    def failure(self, url):
+        '''
+        Record a failed request; opening the host's circuit
+        once it failed max_failures times in a row.
+
+        :param url: requested url
+        '''
+        with self._lock:
+            host = self._host(url)
+            host['failures'] += 1
+            if host['failures'] >= self.max_failures:
+                if host['opened'] is None:
+                    logger.warn('%s is down' % urlparse(url).netloc)
+                host['opened'] = time()
+
+    def start_pings(self, urls, interval=30, timeout=5, verify=False):
+        '''
+        Ping the given (ping api) urls every `interval` seconds, from
+        a background thread, to keep the host details up to date.
+        Only one ping thread is started per selector.
+
+        :param urls: list of ping urls, one per host
+        :param interval: seconds between pings; 0 disables pings
+        :param timeout: seconds to wait for a ping response
+        :param verify: verify ssl certificates?
+        '''
+        if interval <= 0:
+            return
+        with self._lock:
+            if self._pinger is not None:
+                return
+            self._pinger = Thread(target=self._ping_loop, name='pings',
+                                  args=(urls, interval, timeout, verify))
+            self._pinger.daemon = True
+            self._pinger.start()
+
+    def _ping_loop(self, urls, interval, timeout, verify):
+        while True:
+            sleep(interval)
+            for url in urls:
+                start = time()
+                try:
+                    response = requests.get(url, timeout=timeout,
+                                            verify=verify)
+                    response.raise_for_status()
+                except Exception:
+                    self.failure(url)
+                else:
+                    self.success(url, time() - start)
+
+    def stats(self):
+        ' return back the failures, latency and state of each host '
+        now = time()
+        with self._lock:
+            return dict((netloc, {'failures': host['failures'],
+                                  'latency': host['latency'],
+                                  'up': (host['opened'] is None or
+                                         now - host['opened'] >=
+                                         self.reset_timeout)})
+                        for netloc, host in self._hosts.iteritems())
@@ -10,7 +10,10 @@ This module contains all the query and aggregation
 related api functionality.
 '''
 
+import pandas as pd
+
 from metrique.result import Result
+from metriqueu import wire
 
 import logging
 logger = logging.getLogger(__name__)
@@ -47,7 +50,7 @@ def count(self, query=None, date=None, cube=None, owner=None):
 
 def find(self, query=None, fields=None, date=None, sort=None, one=False,
          raw=False, explain=False, merge_versions=True, skip=0,
-         limit=0, cube=None, owner=None):
+         limit=0, cube=None, owner=None, stream=False):
     '''
     Run a pql mongodb based query on the given cube.
 
@@ -65,8 +68,15 @@ def find(self, query=None, fields=None, date=None, sort=None, one=False,
     :param limit: number of results matched to return of total found
     :param cube: cube name
     :param owner: username of cube owner
+    :param stream: stream back results in batches of config.batch_size
+                   objects, rather than in a single response
     '''
     cmd = self.get_cmd(owner, cube, 'find')
+    if stream and not (one or explain):
+        return _find_stream(self, cmd, raw=raw, query=query, fields=fields,
+                            date=date, sort=sort,
+                            merge_versions=merge_versions,
+                            skip=skip, limit=limit)
     result = self._get(cmd, query=query, fields=fields,
                        date=date, sort=sort, one=one, explain=explain,
                        merge_versions=merge_versions,
@@ -74,6 +84,69 @@ def find(self, query=None, fields=None, date=None, sort=None, one=False,
     return result if raw or explain else Result(result, date)
 
 
+def find_pages(self, query=None, fields=None, date=None, merge_versions=True,
+               raw=False, page_size=None, cube=None, owner=None):
+    '''
+    Run a pql mongodb based query on the given cube, iterating over
+    the results page by page; yields back one Result (or, if raw,
+    one list of objects) per page.
+
+    Each page is requested with the continuation token returned with
+    the previous page, so every page costs about the same to query,
+    and only one page is held in memory at a time.
+
+    :param query: The query in pql
+    :param fields: Fields that should be returned (comma-separated)
+    :param date: date (metrique date range) that should be queried.
+                 If date==None then the most recent versions of the
+                 objects will be queried.
+    :param merge_versions: merge versions where fields values equal
+    :param raw: yield back lists of objects rather than pandas dataframes
+    :param page_size: max number of objects per page (config.batch_size)
+    :param cube: cube name
+    :param owner: username of cube owner
+    '''
+    cmd = self.get_cmd(owner, cube, 'find')
+    page_size = page_size or self.config.batch_size
+    page_token = None
+    while True:
+        page = self._get(cmd, query=query, fields=fields, date=date,
+                         merge_versions=merge_versions,
+                         page_size=page_size, page_token=page_token)
+        if page['objects']:
+            objects = page['objects']
+            yield objects if raw else Result(objects, date)
+        page_token = page['page_token']
+        if not page_token:
+            break
+
+
+def _find_stream(self, cmd, raw=False, date=None, **kwargs):
+    '''
+    Decode a streamed find response batch by batch; building
+    a dataframe per batch, rather than one from all the objects.
+    '''
+    batch_size = self.config.batch_size
+    response = self._get(cmd, full_response=True, stream=True,
+                         batch_size=batch_size, date=date, **kwargs)
+    content_type = response.headers.get('Content-Type')
+    objects = wire.decode_stream(response.iter_content(65536), content_type)
+    if raw:
+        return list(objects)
+    frames = []
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) >= batch_size:
+            frames.append(pd.DataFrame(batch))
+            batch = []
+    if batch:
+        frames.append(pd.DataFrame(batch))
+    if not frames:
+        return Result([], date)
+    return Result(pd.concat(frames, ignore_index=True), date)
+
+
 def history(self, query, by_field=None, date_list=None, cube=None, owner=None):
     '''
     Run a pql mongodb based query on the given cube and return back the
@@ -17,8 +17,10 @@ import os
 import pytz
 import simplejson as json
 import sys
+import zlib
 
-from metriqueu.utils import dt2ts
+from metriqueu.utils import batch_gen, dt2ts
+from metriqueu import wire
 
 logger = logging.getLogger(__name__)
 
@@ -166,3 +168,28 @@ def json_encode(obj):
         return dt2ts(obj)
     else:
         return json_encoder.default(obj)
+
+
+def ndjson_gen(objects, gzip=False, batch_size=1000):
+    '''
+    Encode objects as newline-delimited JSON, yielding back one
+    (optionally gzip compressed) utf-8 string per batch of objects.
+
+    Empty strings are never yielded, since an empty chunk would end
+    a chunked transfer-encoded request body early.
+
+    :param objects: list of objects to encode
+    :param gzip: compress the output with gzip?
+    :param batch_size: number of objects to encode per string
+    '''
+    if gzip:
+        z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for batch in batch_gen(objects, batch_size):
+        lines = wire.encode_stream(batch)
+        if isinstance(lines, unicode):
+            lines = lines.encode('utf8')
+        chunk = z.compress(lines) if gzip else lines
+        if chunk:
+            yield chunk
+    if gzip:
+        yield z.flush()
@@ -16,7 +16,7 @@ import os
 try:
     from pymongo import MongoClient, MongoReplicaSetClient
 except ImportError:
-    raise ImportError("Pymongo 2.6+ required!")
+    raise ImportError("Pymongo 2.7+ required!")
 from pymongo.errors import ConnectionFailure
 from pymongo.read_preferences import ReadPreference
 
@@ -40,7 +40,7 @@ class BaseMongoDB(object):
     Connections are cached and reused, until destruction or connection
     error is encountered.
 
-    Requires Mongodb 2.4+ and pymongo 2.6+!
+    Requires Mongodb 2.4+ and pymongo 2.7+!
 
     Supports the following connection types:
         + SSL and non-SSL (key/cert and combined)
@@ -52,11 +52,44 @@ class metriqued_config(TornadoConfig):
     :param user_cube_quota: max number of cubes a user can own
     :param gnupg_dir: path to gnupg data directory
     :param gnupg_fingerprint: key fingerprint for gpg signing/verification
+    :param decompress_max_bytes:
+        max size, once decompressed, of gzip compressed request bodies
+        (and of each object in streamed saves); 0 for no limit
+    :param decompress_request:
+        accept gzip compressed request bodies from authenticated users?
+    :param executor_workers:
+        number of threads blocking mongodb calls are run in
+    :param executor_endpoint_limit:
+        max number of concurrent calls per api endpoint
+    :param executor_endpoint_limits:
+        dict of per api endpoint (eg, 'find') limit overrides
     :param krb_auth: enable kerberos authentication
     :param log2mongodb: enable passing log events to mongodb?
+    :param log_batch_size:
+        max number of requests (access) details logged per batch
+    :param log_queue_size:
+        max number of requests (access) details queued to be logged
+    :param log_queue_timeout:
+        seconds to wait for room in a full log queue before
+        dropping the request details; 0 drops them immediately
     :param log_mongodb_level: logger level to listen on and pass to mongodb
     :param mongodb_config: path to mongodb config json
     :param port: port to listen on
+    :param profile_cache_ttl:
+        seconds user and cube profiles are cached; 0 disables caching
+    :param response_cache_max_objects:
+        results of more objects than this are not cached; 0 for no limit
+    :param response_cache_size:
+        max number of read results cached; 0 disables caching
+    :param save_batch_size: max number of objects per bulk save operation
+    :param save_ordered: run bulk saves as ordered (sequential) operations?
+    :param save_stream_max_bytes:
+        max request body size of streamed saves; compressed and
+        decompressed
+    :param snapshot_max_delta:
+        max seconds between the date of an exact date query and the
+        date of the cube snapshot it's served from (plus the versions
+        in between); 0 serves only queries of snapshot dates
     :param superusers: list of usernames that have root access
     '''
     default_config = DEFAULT_CONFIG
@@ -67,11 +100,26 @@ class metriqued_config(TornadoConfig):
             'user_cube_quota': 3,
             'gnupg_dir': GNUPG_DIR,
             'gnupg_fingerprint': None,
+            'decompress_max_bytes': 104857600,  # 100M
+            'decompress_request': True,
+            'executor_workers': 16,
+            'executor_endpoint_limit': 8,
+            'executor_endpoint_limits': {},
             'krb_auth': False,
             'log2mongodb': False,
+            'log_batch_size': 100,
+            'log_queue_size': 10000,
+            'log_queue_timeout': 0,
             'log_mongodb_level': 100,
             'mongodb_config': None,
             'port': 5420,
+            'profile_cache_ttl': 5,
+            'response_cache_max_objects': 10000,
+            'response_cache_size': 1000,
+            'save_batch_size': 1000,
+            'save_ordered': False,
+            'save_stream_max_bytes': 10737418240,  # 10G
+            'snapshot_max_delta': 604800,  # 1 week
             'superusers': ["admin"],
         }
         # apply defaults
@@ -115,11 +163,11 @@ class mongodb_config(JSONConf):
     :param collection_cube_profile: cube profile collection name
     :param collection_user_profile: user profile collection name
     :param collection_logs: logs collection name
+    :param collection_rollups: cube daily rollups collection name
     :param fsync: sync writes to disk before return?
     :param host: mongodb host(s) to connect to
     :param journal: enable write journal before return?
     :param port: mongodb port to connect to
-    :param mongoexport: path to mongoexport command
     :param read_preference: default - NEAREST
     :param replica_set: name of replica set, if any
     :param ssl: enable ssl
@@ -143,11 +191,11 @@ class mongodb_config(JSONConf):
             'collection_cube_profile': 'cube_profile',
             'collection_user_profile': 'user_profile',
             'collection_logs': 'logs',
+            'collection_rollups': 'rollups',
             'fsync': False,
             'host': '127.0.0.1',
             'journal': True,
             'port': 27017,
-            'mongoexport': '/usr/bin/mongoexport',
             'read_preference': 'NEAREST',
             'replica_set': None,
             'ssl': False,
@@ -237,3 +285,13 @@ class mongodb_config(JSONConf):
     def c_logs_admin(self):
         '''Wrapper for a read/write 'logs' collection proxy'''
         return self.db_metrique_admin[self.collection_logs]
+
+    @property
+    def c_rollups_data(self):
+        '''Wrapper for a read only 'rollups' collection proxy'''
+        return self.db_metrique_data[self.collection_rollups]
+
+    @property
+    def c_rollups_admin(self):
+        '''Wrapper for a read/write 'rollups' collection proxy'''
+        return self.db_metrique_admin[self.collection_rollups]
@@ -10,24 +10,33 @@ This module contains all the core metriqued api functionality.
 '''
 
 import base64
-from bson import SON
-import cPickle
+from bson import SON, ObjectId
 from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from datetime import timedelta
+from functools import partial
+import hashlib
 try:
     import kerberos
 except ImportError:
     kerberos = None
 import logging
 from passlib.hash import sha256_crypt
+from pymongo.errors import OperationFailure
 import random
 import socket
 import simplejson as json
 from tornado import gen
+import zlib
 from tornado.web import RequestHandler, HTTPError
 
-from metriqued.utils import parse_pql_query, json_encode
+from metriqued.utils import parse_pql_query, json_encode, and_specs
+from metriqued.utils import and_date_specs, current_at
+from metriqued.utils import ConcurrencyLimiter, LogPipeline, LRUCache
+from metriqued.utils import PQL_CACHE, result_size, GzipDecoder
 
-from metriqueu.utils import set_default, utcnow, strip_split
+from metriqueu.utils import set_default, utcnow, strip_split, dt2ts
+from metriqueu import wire
 
 logger = logging.getLogger(__name__)
 
@@ -37,12 +46,34 @@ SAMPLE_SIZE = 1
 # 'admin' is cube superuser; 'read' can only read; 'write' can only write
 VALID_CUBE_ROLES = set(('own', 'admin', 'read', 'write'))
 VALID_ACTIONS = set(('pull', 'addToSet', 'set'))
+MISSING = object()
+PROFILE_CACHE_SIZE = 10000
+# seconds after which a write still registered as in flight (see
+# begin_write) is assumed to have died
+WRITE_TIMEOUT = 3600
+
+
+def _log_requests(name, requests):
+    '''
+    Log a batch of request (access) details to the named logger,
+    then flush its (eg, buffering mongodb) handlers.
+
+    :param name: name of the requests logger
+    :param requests: list of request details dicts
+    '''
+    logger = logging.getLogger(name)
+    for request in requests:
+        logger.error(json.dumps(request, indent=1))
+    for hdlr in logger.handlers:
+        hdlr.flush()
 
 
 class MetriqueHdlr(RequestHandler):
     '''
     Main tornado.RequestHandler for handling incoming 'metriqued api' requests.
     '''
+    _log_pipeline = None
+
 ############################### Cube Manipulation ##########
     @staticmethod
     def cjoin(owner, cube):
@@ -81,15 +112,15 @@ class MetriqueHdlr(RequestHandler):
                                      exists_only=True)
 
     @staticmethod
-    def estimate_obj_size(obj):
+    def arguments_size(arguments):
         '''
-        Naively calculate an objects "size" by counting the
-        total number number of characters of the pickle when
-        dumped as a string.
+        Calculate the total size, in bytes, of the request
+        arguments names and values, as received.
 
-        :param obj: object to estimate size of
+        :param arguments: dict of argument name, list of values pairs
         '''
-        return len(cPickle.dumps(obj))
+        return sum(len(k) + sum(len(v) for v in values)
+                   for k, values in arguments.iteritems())
 
     def get_fields(self, owner, cube, fields=None):
         '''
@@ -254,6 +285,9 @@ class MetriqueHdlr(RequestHandler):
         deserialize on the way in, unless explictly told the
         data is not json.
 
+        Arguments sent as a single msgpack or bson encoded request
+        body are decoded all at once, instead.
+
         :param key: argument key to manipulate
         :param default: default to apply to argument value if not present
         :param with_json: flag indicating our assumption that the data is JSON
@@ -262,8 +296,16 @@ class MetriqueHdlr(RequestHandler):
         # manually; what if we set content-type to JSON in header?
         # would json decoding happen automatically?
 
+        body_arguments = self._binary_body_arguments()
+        if body_arguments is not None:
+            # the whole body was decoded already
+            return body_arguments.get(key, default)
+
         # arguments are expected to be json encoded!
-        _arg = super(MetriqueHdlr, self).get_argument(key, default)
+        _arg = super(MetriqueHdlr, self).get_argument(key, None)
+        if _arg is None:
+            # defaults are not json encoded
+            return default
 
         if _arg and with_json:
             try:
@@ -278,6 +320,28 @@ class MetriqueHdlr(RequestHandler):
 
         return arg
 
+    def _binary_body_arguments(self):
+        '''
+        Decode and cache request body arguments sent as a single
+        binary (msgpack or bson) encoded dict. Returns None if the
+        request body isn't binary encoded.
+        '''
+        if not hasattr(self, '_body_arguments'):
+            content_type = self.request.headers.get('Content-Type', '')
+            content_type = content_type.split(';')[0].strip()
+            if content_type in (wire.MSGPACK, wire.BSON):
+                try:
+                    arguments = wire.decode(self.request.body, content_type)
+                except Exception as e:
+                    self._raise(400, "Invalid %s content: %s" % (
+                        content_type, e))
+                if not isinstance(arguments, dict):
+                    self._raise(400, "expected encoded dict of arguments")
+                self._body_arguments = arguments
+            else:
+                self._body_arguments = None
+        return self._body_arguments
+
     def _request_dict(self):
         r = self.request
         request = {
@@ -285,8 +349,9 @@ class MetriqueHdlr(RequestHandler):
             'start_time': r._start_time,
             'finish_time': r._finish_time,
             'arguments_len': len(r.arguments),
-            'arguments_size': self.estimate_obj_size(r.arguments),
-            'body_size': self.estimate_obj_size(r.body),
+            'arguments_size': self.arguments_size(r.arguments),
+            # streamed request bodies aren't kept
+            'body_size': len(r.body) if isinstance(r.body, str) else None,
             'files': r.files,
             'full_url': r.full_url(),
             'headers': r.headers,
@@ -304,35 +369,96 @@ class MetriqueHdlr(RequestHandler):
         }
         return request
 
-    def _log_request(self):
-        request_json = json.dumps(self._request_dict(), indent=1)
-        logger = logging.getLogger(self.metrique_config.log_requests_name)
-        logger.error(request_json)
+    def log_pipeline(self):
+        '''
+        Return back the (process wide) pipeline request (access)
+        details are logged through, in batches, in the background.
+        '''
+        cls = MetriqueHdlr
+        if cls._log_pipeline is None:
+            config = self.metrique_config
+            handler = partial(_log_requests, config.log_requests_name)
+            cls._log_pipeline = LogPipeline(
+                handler, maxsize=config.log_queue_size,
+                batch_size=config.log_batch_size,
+                timeout=config.log_queue_timeout)
+        return cls._log_pipeline
 
-    @gen.coroutine
     def on_finish(self):
         '''
         Routines to run after every tornado request completes.
 
         Currently implemented routines are as follows:
-            * log the request (access) details
+            * queue the request (access) details to be logged
         '''
-        with ThreadPoolExecutor(1) as ex:
-            yield ex.submit(self._log_request)
+        self.log_pipeline().put(self._request_dict())
 
     def write(self, value, binary=False):
         '''
         All http request writes are expected to be in JSON form,
-        unless otherwise explicity requested to be in binary.
+        unless otherwise explicity requested to be in binary or
+        the client Accepts msgpack or bson encoded responses.
 
         :param value: value to be return to requesting http client
         :param binary: flag to indicate whether data is binary (write as-is)
         '''
+        if self.get_status() == 304:
+            # Not Modified; responses must not have a body
+            return
         if binary:
             super(MetriqueHdlr, self).write(value)
-        else:
+            return
+
+        accept = self.request.headers.get('Accept')
+        content_type = wire.negotiate(accept)
+        if content_type == wire.JSON:
             result = json.dumps(value, default=json_encode, ensure_ascii=False)
-            super(MetriqueHdlr, self).write(result)
+        else:
+            self.set_header('Content-Type', content_type)
+            result = wire.encode(value, content_type)
+        super(MetriqueHdlr, self).write(result)
+
+    def write_stream(self, objects):
+        '''
+        Write a batch of objects to a streamed response, as newline
+        delimited JSON, or as concatenated msgpack or bson objects if
+        the client Accepts them. Call flush() to send the batch.
+
+        :param objects: list of objects to be streamed to the client
+        '''
+        accept = self.request.headers.get('Accept')
+        content_type = wire.negotiate(accept)
+        if not self._headers_written:
+            if content_type == wire.JSON:
+                self.set_header('Content-Type', wire.NDJSON)
+            else:
+                self.set_header('Content-Type', content_type)
+        result = wire.encode_stream(objects, content_type)
+        super(MetriqueHdlr, self).write(result)
+
+    def abort_stream(self):
+        '''
+        Drop the connection of a streamed response which failed after
+        its headers were written. Finishing it as usual would end it
+        as a complete (200) response; the client would not know the
+        response was cut short.
+        '''
+        if self._headers_written:
+            logger.error('streamed response failed; dropping connection')
+            self.request.connection.close()
+
+    def set_default_headers(self):
+        '''
+        Advertise the wire formats (and content encodings) this server
+        accepts, so clients can send binary encoded (and gzip
+        compressed) request bodies.
+        '''
+        formats = ','.join(wire.available_formats())
+        self.set_header(wire.FORMATS_HEADER, formats)
+        config = getattr(self, 'metrique_config', None)
+        if config and config.decompress_request:
+            # clients can send gzip compressed request bodies
+            self.set_header(wire.ENCODINGS_HEADER, 'gzip')
 
 ##################### auth #################################
     def current_user_acl(self, roles):
@@ -376,10 +502,18 @@ class MetriqueHdlr(RequestHandler):
         Return back a filtered list of collections the current authenticated
         user has read access to.
         '''
+        # cube sub collections (eg, snapshots) have dotted names
         names = [c for c in self._timeline_data.collection_names()
-                 if not c.startswith('system')]
+                 if not c.startswith('system') and '.' not in c]
         if not self.is_superuser():
-            names = [n for n in names if self.can_read(*n.split('__'))]
+            # fetch the ids of all the cube profiles granting the
+            # user read access (see can_read) in a single query
+            users = [self.current_user, '__all__', '~']
+            spec = {'$or': [{role: {'$in': users}}
+                            for role in ('read', 'write', 'admin')]}
+            readable = set(p['_id'] for p in self.cube_profile().find(
+                spec, fields={'_id': 1}))
+            names = [n for n in names if n in readable]
         return names
 
     def _scrape_username_password(self):
@@ -576,6 +710,168 @@ class MongoDBBackendHdlr(MetriqueHdlr):
 
     It is currently the main and only backend supported by metriqued.
     '''
+    _executor = None
+    _limiters = {}
+    _profile_cache = None
+    _response_cache = None
+
+    def begin_write(self, owner, cube):
+        '''
+        Register a write (save or removal) of the cube as in flight,
+        until bump_write_generation is called with the returned
+        token; see unwritten_spec.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        token = str(ObjectId())
+        self.update_cube_profile(owner, cube, 'addToSet', 'writes', token)
+        return token
+
+    def bump_write_generation(self, owner, cube, token=None):
+        '''
+        Mark the cube as modified, which invalidates all the cached
+        read results of the cube. The generation is a unique token,
+        rather than a counter, so a cube dropped and registered
+        again never matches results cached before the drop.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        :param token: token of the write (see begin_write) finished
+        '''
+        generation = str(ObjectId())
+        update = {'$set': {'write_generation': generation}}
+        if token:
+            update['$pull'] = {'writes': token}
+        collection = self.cjoin(owner, cube)
+        _cube = self.cube_profile(admin=True)
+        _cube.update({'_id': collection}, update)
+        self.invalidate_profile(_cube, collection)
+        return generation
+
+    def unwritten_spec(self, owner, cube):
+        '''
+        Return back a spec matching the cube's profile only until the
+        cube is written to; that is, until a write is begun or one in
+        flight finishes. Or None, if the cube is being written to
+        already. Writes in flight for over WRITE_TIMEOUT seconds are
+        assumed to have died.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        started = utcnow(as_datetime=True) - timedelta(seconds=WRITE_TIMEOUT)
+        # tokens are ObjectIds; their hex strings sort by creation time
+        cutoff = str(ObjectId.from_datetime(started))
+        generation = self._cube_profile_key(owner, cube, 'write_generation')
+        spec = {'_id': self.cjoin(owner, cube),
+                'write_generation': generation,
+                'writes': {'$not': {'$gt': cutoff}}}
+        if not self.cube_profile(admin=True).find(spec).count():
+            return None
+        return spec
+
+    def cached_result(self, owner, cube, endpoint, func, **kwargs):
+        '''
+        Return back func(owner=owner, cube=cube, **kwargs); cached
+        until the cube's write generation changes. Results of more
+        than response_cache_max_objects objects are not cached.
+
+        The cube read ACL is always checked before a cached result
+        is returned. Responses are tagged with an ETag derived from
+        the cache key, so clients sending If-None-Match get back a
+        304 without the query being run again.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        :param endpoint: name of the api endpoint being cached
+        :param func: function to call on cache misses
+        :param kwargs: (json serializable) func arguments
+        '''
+        cache = self.response_cache()
+        if cache is None:
+            return func(owner=owner, cube=cube, **kwargs)
+        self.requires_read(owner, cube)
+        # read the generation from mongodb; other server processes
+        # might have bumped it since the cube profile was cached
+        spec = {'_id': self.cjoin(owner, cube)}
+        profile = self.cube_profile().find_one(
+            spec, fields={'_id': 0, 'write_generation': 1}) or {}
+        generation = profile.get('write_generation')
+        content_type = wire.negotiate(self.request.headers.get('Accept'))
+        key = json.dumps([owner, cube, endpoint, generation,
+                          content_type, kwargs], sort_keys=True)
+        key = hashlib.sha1(key).hexdigest()
+        etag = '"%s"' % key
+        self.set_header('Etag', etag)
+        if etag == self.request.headers.get('If-None-Match'):
+            self.set_status(304)
+            return None
+        result = cache.get(key, MISSING)
+        if result is MISSING:
+            result = func(owner=owner, cube=cube, **kwargs)
+            # large results would hold too much memory in every process
+            max_objects = self.metrique_config.response_cache_max_objects
+            if not max_objects or result_size(result) <= max_objects:
+                cache.set(key, result)
+        return result
+
+    def response_cache(self):
+        '''
+        Return back the (process wide) read results cache; or
+        None if caching is disabled (response_cache_size <= 0).
+        '''
+        cls = MongoDBBackendHdlr
+        if cls._response_cache is None:
+            size = self.metrique_config.response_cache_size
+            if not size or size <= 0:
+                return None
+            cls._response_cache = LRUCache(size)
+        return cls._response_cache
+
+    def executor(self):
+        '''
+        Return back the (process wide) thread pool blocking
+        mongodb calls are run in, off the IOLoop.
+        '''
+        cls = MongoDBBackendHdlr
+        if cls._executor is None:
+            workers = self.metrique_config.executor_workers
+            cls._executor = ThreadPoolExecutor(workers)
+        return cls._executor
+
+    def limiter(self, endpoint):
+        '''
+        Return back the concurrency limiter of the given endpoint.
+
+        :param endpoint: name of the api endpoint
+        '''
+        limiters = MongoDBBackendHdlr._limiters
+        if endpoint not in limiters:
+            config = self.metrique_config
+            limits = config.executor_endpoint_limits or {}
+            limit = limits.get(endpoint, config.executor_endpoint_limit)
+            limiters[endpoint] = ConcurrencyLimiter(limit)
+        return limiters[endpoint]
+
+    @gen.coroutine
+    def run_async(self, endpoint, func, *args, **kwargs):
+        '''
+        Run func(*args, **kwargs) in the executor, so it doesn't block
+        the IOLoop; waiting first if too many other calls for the same
+        endpoint are running already.
+
+        :param endpoint: name of the api endpoint
+        :param func: (blocking) function to call
+        '''
+        limiter = self.limiter(endpoint)
+        yield limiter.acquire()
+        try:
+            result = yield self.executor().submit(func, *args, **kwargs)
+        finally:
+            limiter.release()
+        raise gen.Return(result)
+
     @staticmethod
     def check_sort(sort, son=False):
         '''
@@ -644,22 +940,16 @@ class MongoDBBackendHdlr(MetriqueHdlr):
                            err_msg="keys must be a list")
         mask = set_default(mask, list, null_ok=True,
                            err_msg="keys must be a list")
-        spec = {'_id': _id}
-        cursor = _cube.find(spec)
-        count = cursor.count()
-        if not count:
+        profile = self._find_profile(_cube, _id)
+        if not profile:
             if raise_if_not:
                 self._raise(400, 'resource does not exist: %s' % _id)
             elif exists_only:
                 return False
             else:
                 return {}
-        elif exists_only:  # return back only the count
-            return True if count else False
-        else:
-            # return back the profile doc
-            # which is the first and only item in the cursor
-            profile = cursor.next()
+        elif exists_only:
+            return True
 
         if keys:
             if profile:
@@ -676,7 +966,55 @@ class MongoDBBackendHdlr(MetriqueHdlr):
                 result = result[0]
         else:
             result = profile
-        return result
+        # don't hand out (parts of) the cached doc itself
+        return deepcopy(result)
+
+    def _find_profile(self, _cube, _id):
+        '''
+        Return back the profile doc with the given _id, or None.
+
+        Profiles are memoized for the rest of the request, and
+        cached across requests for profile_cache_ttl seconds.
+        '''
+        key = (_cube.full_name, _id)
+        profiles = self.__dict__.setdefault('_profiles', {})
+        if key in profiles:
+            return profiles[key]
+        cache = self.profile_cache()
+        profile = MISSING if cache is None else cache.get(key, MISSING)
+        if profile is MISSING:
+            profile = _cube.find_one({'_id': _id})
+            if cache is not None:
+                cache.set(key, profile)
+        profiles[key] = profile
+        return profile
+
+    def invalidate_profile(self, _cube, _id):
+        '''
+        Drop the cached profile doc with the given _id; to be called
+        whenever a profile is modified.
+
+        :param _cube: proxy to profile collection modified
+        :param _id: object _id modified
+        '''
+        key = (_cube.full_name, _id)
+        self.__dict__.setdefault('_profiles', {}).pop(key, None)
+        cache = self.profile_cache()
+        if cache is not None:
+            cache.pop(key)
+
+    def profile_cache(self):
+        '''
+        Return back the (process wide) profile cache; or None
+        if caching is disabled (profile_cache_ttl <= 0).
+        '''
+        cls = MongoDBBackendHdlr
+        if cls._profile_cache is None:
+            ttl = self.metrique_config.profile_cache_ttl
+            if not ttl or ttl <= 0:
+                return None
+            cls._profile_cache = LRUCache(PROFILE_CACHE_SIZE, ttl=ttl)
+        return cls._profile_cache
 
     def initialize(self, metrique_config, mongodb_config):
         '''
@@ -687,6 +1025,196 @@ class MongoDBBackendHdlr(MetriqueHdlr):
         '''
         self.metrique_config = metrique_config
         self.mongodb_config = mongodb_config
+        # the default headers were set before the config was
+        self.set_default_headers()
+
+    def prepare(self):
+        '''
+        Decompress gzip compressed request bodies, and parse their
+        arguments; only once the request is authenticated, and up
+        to decompress_max_bytes.
+        '''
+        request = self.request
+        encoding = request.headers.get('Content-Encoding', '')
+        if 'gzip' not in encoding or not request.body:
+            return
+        elif not self.metrique_config.decompress_request:
+            self._raise(415, "gzip compressed request bodies not accepted")
+        elif not self.current_user:
+            self._raise(401, "authentication required")
+        decoder = GzipDecoder(self.metrique_config.decompress_max_bytes)
+        try:
+            body = decoder.decompress(request.body) + decoder.flush()
+        except zlib.error as e:
+            self._raise(400, "Invalid gzip content: %s" % e)
+        except ValueError as e:
+            self._raise(413, str(e))
+        request.body = body
+        del request.headers['Content-Encoding']
+        request.headers['Content-Length'] = str(len(body))
+        # tornado skipped parsing the (compressed) body arguments
+        request._parse_body()
+
+    def rollups(self, admin=False):
+        '''
+        Shortcut for getting a mongodb proxy read/admin rollups collection
+
+        :param admin: flag for getting back a (read/write) authenticated proxy
+        '''
+        if admin:
+            return self.mongodb_config.c_rollups_admin
+        else:
+            return self.mongodb_config.c_rollups_data
+
+    def _cube_profile_key(self, owner, cube, key):
+        '''
+        Return back the value of a cube profile key, read from mongodb
+        rather than the profile cache; other server processes might
+        have modified it since the profile was cached.
+        '''
+        spec = {'_id': self.cjoin(owner, cube)}
+        profile = self.cube_profile(admin=True).find_one(
+            spec, fields={'_id': 0, key: 1}) or {}
+        return profile.get(key)
+
+    def cube_rollups(self, owner, cube):
+        '''
+        Return back (fields, build) of the cube's daily rollups; the
+        list of fields they're kept for, with None (the total) first,
+        and the id of the rollups build in use. Or (None, None) if the
+        cube has no rollups.
+
+        Read uncached; saves and removals must never miss a rollups
+        (re)build or drop by another server process.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        rollups = self._cube_profile_key(owner, cube, 'rollups')
+        if not rollups:
+            return None, None
+        return [None] + list(rollups['fields']), rollups['build']
+
+    def update_rollups(self, owner, cube, deltas, build):
+        '''
+        Apply daily rollup deltas (see utils.rollup_version) to the
+        given build of the cube's rollups, in a single bulk operation.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        :param deltas: dict of (field, value key, day) -> [value, delta]
+        :param build: id of the rollups build
+        '''
+        changes = [(k, v) for k, v in deltas.iteritems() if v[1]]
+        if not changes:
+            return 0
+        collection = self.cjoin(owner, cube)
+        bulk = self.rollups(admin=True).initialize_unordered_bulk_op()
+        for (field, key, day), (value, delta) in changes:
+            # concurrent upserts might create duplicate docs; that's
+            # fine, since the deltas of all the matching docs are summed
+            spec = {'cube': collection, 'build': build, 'field': field,
+                    'key': key, 'day': day}
+            bulk.find(spec).upsert().update({'$inc': {'delta': delta},
+                                             '$set': {'value': value}})
+        bulk.execute()
+        return len(changes)
+
+    def cube_snapshots(self, owner, cube):
+        '''
+        Return back the cube's snapshot catalog; the list of the
+        cube's snapshots (date and collection name), sorted by date.
+
+        Read uncached; saves must never miss a snapshot just built,
+        and queries a snapshot just dropped, by another server process.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        return self._cube_profile_key(owner, cube, 'snapshots') or []
+
+    def snapshot_sources(self, owner, cube, query, date=None, delta=True):
+        '''
+        Return back the list of (collection proxy, spec) pairs to
+        query, together, for the objects matching the given query
+        at the given date.
+
+        Exact date queries are served from the cube's snapshot of
+        that date, if there is one. Otherwise, with delta, they're
+        served from the nearest snapshot (within snapshot_max_delta
+        seconds) plus the versions which started, or ended, between
+        the two dates; read from the cube by _start (or _end) range.
+        All other queries are served from the cube itself.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        :param query: pql query
+        :param date: metrique date (range) that should be queried
+        :param delta: serve from a snapshot of another date?
+        '''
+        _cube = self.timeline(owner, cube)
+        snapshots = self.cube_snapshots(owner, cube)
+        if not (snapshots and isinstance(date, basestring) and
+                '~' not in date):
+            return [(_cube, parse_pql_query(query, date))]
+
+        ts = round(dt2ts(date), 6)
+        snapshot = min(snapshots, key=lambda s: abs(s['date'] - ts))
+        max_delta = self.metrique_config.snapshot_max_delta if delta else 0
+        if abs(snapshot['date'] - ts) > max_delta:
+            return [(_cube, parse_pql_query(query, date))]
+
+        _snapshot = self._timeline_data[snapshot['collection']]
+        spec = parse_pql_query(query)
+        if ts == snapshot['date']:
+            return [(_snapshot, spec)]
+        elif ts > snapshot['date']:
+            # snapshot versions all started before the date; versions
+            # started since, and still current, are read from the cube
+            current = {'$or': [{'_end': {'$gte': ts}}, {'_end': None}]}
+            started = {'_start': {'$gt': snapshot['date'], '$lte': ts}}
+            return [(_snapshot, and_date_specs(spec, [current])),
+                    (_cube, and_date_specs(spec, [started, current]))]
+        else:
+            # snapshot versions all end after the date; versions which
+            # ended before the snapshot date are read from the cube
+            started = {'_start': {'$lte': ts}}
+            ended = {'_end': {'$gte': ts, '$lt': snapshot['date']}}
+            return [(_snapshot, and_specs(spec, started)),
+                    (_cube, and_specs(spec, started, ended))]
+
+    def update_snapshots(self, owner, cube, snapshots, versions):
+        '''
+        Apply saved versions to the cube's snapshots: saved versions
+        current at a snapshot's date are saved in the snapshot; the
+        versions they replaced are removed from it, otherwise.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        :param snapshots: the cube's snapshot catalog
+        :param versions: list of (replaced version or None, saved
+                         version) pairs, in the order saved
+        '''
+        # the version first replaced and the one last saved, per _id
+        changes = {}
+        for old, new in versions:
+            old = changes.get(new['_id'], (old, None))[0]
+            changes[new['_id']] = (old, new)
+        for snapshot in snapshots:
+            date = snapshot['date']
+            _snapshot = self._timeline_admin[snapshot['collection']]
+            bulk = _snapshot.initialize_unordered_bulk_op()
+            k = 0
+            for _id, (old, new) in changes.iteritems():
+                if current_at(new, date):
+                    bulk.find({'_id': _id}).upsert().replace_one(new)
+                elif old and current_at(old, date):
+                    bulk.find({'_id': _id}).remove_one()
+                else:
+                    continue
+                k += 1
+            if k:
+                bulk.execute()
 
     def sample_cube(self, owner, cube, sample_size=None, query=None):
         '''
@@ -704,13 +1232,95 @@ class MongoDBBackendHdlr(MetriqueHdlr):
         query = set_default(query, '', null_ok=True)
         spec = parse_pql_query(query)
         _cube = self.timeline(owner, cube)
-        docs = _cube.find(spec)
-        n = docs.count()
-        if n <= sample_size:
-            docs = tuple(docs)
-        else:
-            to_sample = sorted(set(random.sample(xrange(n), sample_size)))
-            docs = [docs[i] for i in to_sample]
+        return self.sample_docs(_cube, spec, sample_size)
+
+    @staticmethod
+    def aggregate_rows(_cube, pipeline):
+        '''
+        Return back an iterable of the results of an aggregation
+        pipeline; read from a cursor, which isn't limited to 16MB of
+        results and may use disk (mongodb 2.6+), or, on older servers,
+        from the single result document.
+
+        :param _cube: cube (collection) to aggregate
+        :param pipeline: aggregation pipeline
+        '''
+        try:
+            return _cube.aggregate(pipeline, cursor={}, allowDiskUse=True)
+        except OperationFailure as e:
+            logger.debug('aggregation cursor unavailable (%s)' % e)
+            return _cube.aggregate(pipeline)['result']
+
+    def sample_docs(self, _cube, spec, sample_size, fields=None):
+        '''
+        Draw up to sample_size matching objects at random, server side,
+        rather than with one skip query per sampled object.
+
+        The aggregation $sample stage (mongodb 3.2+) is used where
+        available. Only as the first stage, ie when spec is empty, does
+        it read no more than the sampled objects; after a $match,
+        mongodb reads all the matching objects and sorts them randomly.
+        Older servers fall back to reservoir sampling a single cursor
+        over the matching objects.
+
+        :param _cube: cube (collection) to sample
+        :param spec: mongodb query spec of the population to sample
+        :param sample_size: number of objects to sample
+        :param fields: dict of (field, 0/1) pairs to return
+        '''
+        sample_size = int(sample_size)
+        if sample_size <= 0:
+            return []
+        try:
+            docs = self._sample_aggregate(_cube, spec, sample_size, fields)
+        except OperationFailure as e:
+            logger.debug('$sample unavailable (%s); using reservoir' % e)
+            docs = self._sample_reservoir(_cube, spec, sample_size, fields)
+        return docs
+
+    @staticmethod
+    def _sample_aggregate(_cube, spec, sample_size, fields=None):
+        if fields:
+            # keep _id (to drop duplicates) until the sample is drawn
+            project = dict((k, v) for k, v in fields.iteritems() if v)
+            project['_id'] = 1
+        drop_id = fields and not fields.get('_id', 1)
+        seen = set()
+        docs = []
+        while len(docs) < sample_size:
+            # $sample may return the same object more than once; top
+            # the sample up from the objects not sampled yet
+            match = spec
+            if seen:
+                match = and_specs(spec, {'_id': {'$nin': list(seen)}})
+            pipeline = [{'$sample': {'size': sample_size - len(docs)}}]
+            if match:
+                pipeline.insert(0, {'$match': match})
+            if fields:
+                pipeline.append({'$project': project})
+            k = len(docs)
+            for doc in _cube.aggregate(pipeline, cursor={},
+                                       allowDiskUse=True):
+                if doc['_id'] in seen:
+                    continue
+                seen.add(doc['_id'])
+                if drop_id:
+                    del doc['_id']
+                docs.append(doc)
+            if len(docs) == k:
+                break  # every matching object is sampled
+        return docs
+
+    @staticmethod
+    def _sample_reservoir(_cube, spec, sample_size, fields=None):
+        docs = []
+        for i, doc in enumerate(_cube.find(spec, fields=fields)):
+            if i < sample_size:
+                docs.append(doc)
+            else:
+                k = random.randint(0, i)
+                if k < sample_size:
+                    docs[k] = doc
         return docs
 
     @property
@@ -756,6 +1366,7 @@ class MongoDBBackendHdlr(MetriqueHdlr):
         spec = {'_id': _id}
         update = {'$%s' % action: {key: value}}
         _cube.update(spec, update)
+        self.invalidate_profile(_cube, _id)
         return True
 
 
@@ -783,5 +1394,15 @@ class PingHdlr(MongoDBBackendHdlr):
                 'action': 'ping',
                 'current_user': user,
                 'metriqued': HOSTNAME,
+                'pql_cache': PQL_CACHE.stats(),
             }
+            cache = self.response_cache()
+            if cache is not None:
+                response['response_cache'] = cache.stats()
+            cache = self.profile_cache()
+            if cache is not None:
+                response['profile_cache'] = cache.stats()
+            response['log_pipeline'] = self.log_pipeline().stats()
+            response['endpoints'] = dict(
+                (k, v.stats()) for k, v in self._limiters.iteritems())
             return response
@@ -9,32 +9,56 @@ metriqued.cube_api
 This module contains all Cube related api functionality.
 '''
 
+from bson import ObjectId
 from copy import copy
-from datetime import datetime
-import gzip
 import itertools
 import logging
-import os
-import re
-import shlex
-import subprocess
-import tempfile
+from pymongo.errors import BulkWriteError, OperationFailure
+import simplejson as json
 from types import NoneType
-from tornado.web import authenticated
-# FIXME: gen.coroutine async decorator for find, index, export, saveobjects...
+from tornado import gen
+from tornado.web import authenticated, stream_request_body, HTTPError
+import zlib
 
 from metriqued.core_api import MongoDBBackendHdlr
-from metriqued.utils import query_add_date, parse_pql_query
-from metriqueu.utils import utcnow, jsonhash
+from metriqued.utils import and_specs, parse_pql_query, date_spec
+from metriqued.utils import explain_summary, rollup_version, GzipDecoder
+from metriqueu.utils import utcnow, jsonhash, batch_gen, dt2ts
+from metriqueu import wire
 
 logger = logging.getLogger(__name__)
 
+# mongodb duplicate key error codes
+DUP_KEY_ERRORS = (11000, 11001)
+# export format: wire format exported objects are encoded with
+EXPORT_FORMATS = {'json': wire.NDJSON, 'bson': wire.BSON}
+# number of _ids sampled per export split, to place the splits
+EXPORT_SPLIT_SAMPLES = 100
+# indexes every cube has:
+#  * (_hash, _end): duplicate version checks
+#  * (_oid, _start): _oid lookups, in merged versions order
+#  * _start: most recent _start (see core_api.get_cube_last_start)
+#  * (_end, _start): current value (_end == None) queries and both
+#    clauses of as of date queries; see utils.and_date_specs
+CUBE_INDEXES = [[('_hash', 1), ('_end', 1)],
+                [('_oid', 1), ('_start', 1)],
+                [('_start', 1)],
+                [('_end', 1), ('_start', 1)]]
+
+
+def _index_key(key):
+    ' normalize an index_information() key for comparison '
+    return [(k, int(d) if isinstance(d, (int, float)) else d)
+            for k, d in key]
+
 
 class DropHdlr(MongoDBBackendHdlr):
     ''' RequestsHandler for dropping given cube from timeline '''
     @authenticated
+    @gen.coroutine
     def delete(self, owner, cube):
-        result = self.drop_cube(owner=owner, cube=cube)
+        result = yield self.run_async('drop', self.drop_cube,
+                                      owner=owner, cube=cube)
         self.write(result)
 
     def drop_cube(self, owner, cube):
@@ -47,80 +71,168 @@ class DropHdlr(MongoDBBackendHdlr):
         self.requires_admin(owner, cube)
         if not self.cube_exists(owner, cube):
             self._raise(404, '%s.%s does not exist' % (owner, cube))
-        # drop the cube
+        # drop the cube, and its snapshots
         _cube = self.cjoin(owner, cube)
         self.mongodb_config.db_timeline_admin[_cube].drop()
+        for snapshot in self.cube_snapshots(owner, cube):
+            self._timeline_admin[snapshot['collection']].drop()
+        self.rollups(admin=True).remove({'cube': _cube})
         # drop the entire cube profile
         spec = {'_id': _cube}
-        self.cube_profile(admin=True).remove(spec)
+        _cube_profile = self.cube_profile(admin=True)
+        _cube_profile.remove(spec)
+        self.invalidate_profile(_cube_profile, _cube)
         # pull the cube from the owner's profile
         self.update_user_profile(owner, 'pull', 'own', _cube)
         return True
 
 
-# FIXME: add 'gzip' to find() and drop this!
 class ExportHdlr(MongoDBBackendHdlr):
     '''
-    RequestHandler for exporting a collection (cube) to gzipped json
+    RequestHandler for exporting a collection (cube) to gzipped,
+    newline delimited json (or concatenated bson) objects
     '''
     @authenticated
+    @gen.coroutine
     def get(self, owner, cube):
-        self.requires_admin(owner, cube)
-        path = ''
+        query = self.get_argument('query')
+        fields = self.get_argument('fields', '~')
+        date = self.get_argument('date', '~')
+        _format = self.get_argument('format', 'json')
+        batch_size = self.get_argument('batch_size', 1000)
+        id_min = self.get_argument('id_min')
+        id_max = self.get_argument('id_max')
+        yield self.run_async('export', self.requires_admin, owner, cube)
+        yield self.export(owner=owner, cube=cube, query=query,
+                          fields=fields, date=date, _format=_format,
+                          batch_size=batch_size, id_min=id_min,
+                          id_max=id_max)
+
+    @gen.coroutine
+    def export(self, owner, cube, query=None, fields='~', date='~',
+               _format='json', batch_size=1000, id_min=None, id_max=None):
+        '''
+        Stream back the (matching) cube objects, gzip compressed,
+        as they're read from the cursor; the export is never
+        written to disk or held in memory in full.
+
+        By default, all versions of all objects are exported.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        :param query: `pql` query to filter the exported objects with
+        :param fields: fields to export; '~' exports whole objects
+        :param date: date (metrique date range) to export versions of
+        :param _format: 'json' (newline delimited) or 'bson'
+        :param batch_size: number of objects to compress per write
+        :param id_min: only export objects with _id >= id_min
+        :param id_max: only export objects with _id < id_max
+        '''
+        if _format not in EXPORT_FORMATS:
+            self._raise(400, "format must be one of %s" %
+                        sorted(EXPORT_FORMATS))
+        if batch_size <= 0:
+            self._raise(400, "batch_size must be >= 1")
+        content_type = EXPORT_FORMATS[_format]
+        spec = parse_pql_query(query, date)
+        id_range = {}
+        if id_min is not None:
+            id_range['$gte'] = id_min
+        if id_max is not None:
+            id_range['$lt'] = id_max
+        if id_range:
+            spec = and_specs(spec, {'_id': id_range})
+        _fields = self.get_fields(owner, cube, fields)
+        _cube = self.timeline(owner, cube)
+        # exports of large cubes can outlive the default cursor timeout
+        cursor = _cube.find(spec, fields=_fields, timeout=False)
+        cursor.batch_size(batch_size)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        filename = '%s.%s.gz' % (self.cjoin(owner, cube), _format)
+        self.set_header('Content-Type', 'application/x-gzip')
+        self.set_header('Content-Disposition',
+                        'attachment; filename="%s"' % filename)
+        k = 0
         try:
-            path = self.mongoexport(owner, cube)
-            with open(path, 'rb') as f:
-                while 1:
-                    data = f.read(16384)
-                    if not data:
-                        break
-                    self.write(data, binary=True)
+            while True:
+                # reading the next batch from the cursor blocks
+                batch = yield self.run_async('export', list,
+                                             itertools.islice(cursor,
+                                                              batch_size))
+                if not batch:
+                    break
+                k += len(batch)
+                data = wire.encode_stream(batch, content_type)
+                if isinstance(data, unicode):
+                    data = data.encode('utf-8')
+                self.write(compressor.compress(data), binary=True)
+                yield self.flush()
+            self.write(compressor.flush(), binary=True)
+        except Exception:
+            # a truncated gzip body must not look like a complete export
+            self.abort_stream()
+            raise
         finally:
-            if os.path.exists(path):
-                os.remove(path)
+            cursor.close()
+        logger.debug('[%s.%s] %s objects exported' % (owner, cube, k))
+
+
+class ExportSplitsHdlr(MongoDBBackendHdlr):
+    '''
+    RequestHandler for splitting a collection (cube) into _id ranges
+    of roughly equal size, to be exported in parallel
+    '''
+    @authenticated
+    @gen.coroutine
+    def get(self, owner, cube):
+        splits = self.get_argument('splits', 2)
+        yield self.run_async('export', self.requires_admin, owner, cube)
+        result = yield self.run_async('export', self.export_splits,
+                                      owner=owner, cube=cube,
+                                      splits=splits)
+        self.write(result)
 
-    # FIXME: UNICODE IS NOT PROPERLY ENCODED!
-    def mongoexport(self, owner, cube):
+    def export_splits(self, owner, cube, splits=2):
         '''
-        Calls mongoexport command line application and returns
-        the results as compressed gzip file.
+        Return back the sorted list of (up to splits - 1) _ids which
+        split the cube into `splits` ranges of roughly equal numbers
+        of objects; the first range starts at the lowest _id and the
+        last range ends after the highest _id.
+
+        The splits of large cubes are placed at the quantiles of a
+        random sample of EXPORT_SPLIT_SAMPLES _ids per split; so
+        the ranges are only roughly equal. Older servers, without
+        $sample, walk the _id index once instead.
 
         :param owner: username of cube owner
         :param cube: cube name
+        :param splits: number of ranges to split the cube into
         '''
-        conf = self.mongodb_config
-        _cube = '__'.join((owner, cube))
-        now = datetime.now().isoformat()
-
-        fd, path = tempfile.mkstemp(prefix=_cube + '-',
-                                    suffix='-%s.json' % now)
-        path_gz = path + '.gz'
-
-        x = conf['mongoexport']
-        db = '--db timeline'
-        collection = '--collection %s' % _cube
-        out = '--out %s' % path
-        ssl = '--ssl' if conf['ssl'] else ''
-        auth = conf['auth']
-        authdb = '--authenticationDatabase admin' if auth else ''
-        user = '--username admin' if auth else ''
-        _pass = '--password %s' % conf['admin_password'] if auth else ''
-        cmd = ' '.join([x, db, collection, out, ssl, authdb, user, _pass])
-        _cmd = re.sub('password.*$', 'password *****', cmd)
-        logger.debug('Running: %s' % _cmd)
-        try:
-            subprocess.check_call(shlex.split(cmd.encode('ascii')),
-                                  stdout=open(os.devnull, 'wb'),
-                                  stderr=open(os.devnull, 'wb'))
-            f_in = open(path, 'rb')
-            f_out = gzip.open(path_gz, 'wb')
-            f_out.writelines(f_in)
-            f_in.close()
-            f_out.close()
-        finally:
-            if os.path.exists(path):
-                os.remove(path)
-        return path_gz
+        if not isinstance(splits, (int, long)) or isinstance(splits, bool) \
+                or splits <= 0:
+            self._raise(400, "splits must be an integer >= 1")
+        _cube = self.timeline(owner, cube)
+        count = _cube.count()
+        if count < splits:
+            return []
+        size = splits * EXPORT_SPLIT_SAMPLES
+        if count > size:
+            pipeline = [{'$sample': {'size': size}},
+                        {'$project': {'_id': 1}}]
+            try:
+                rows = _cube.aggregate(pipeline, cursor={})
+                _ids = sorted(set(row['_id'] for row in rows))
+            except OperationFailure as e:
+                logger.debug('$sample unavailable (%s); walking _ids' % e)
+            else:
+                keys = [_ids[i * len(_ids) // splits]
+                        for i in range(1, splits) if _ids]
+                return sorted(set(keys))
+        # walks the _id index only, once; no objects are read
+        step = count // splits
+        cursor = _cube.find(fields={'_id': 1}).sort('_id', 1)
+        docs = itertools.islice(cursor, step, step * (splits - 1) + 1, step)
+        return [doc['_id'] for doc in docs]
 
 
 class IndexHdlr(MongoDBBackendHdlr):
@@ -128,6 +240,7 @@ class IndexHdlr(MongoDBBackendHdlr):
     RequestHandler for creating indexes for a given cube
     '''
     @authenticated
+    @gen.coroutine
     def delete(self, owner, cube):
         '''
         Delete an existing cube index.
@@ -135,17 +248,13 @@ class IndexHdlr(MongoDBBackendHdlr):
         :param owner: username of cube owner
         :param cube: cube name
         '''
-        self.requires_admin(owner, cube)
         drop = self.get_argument('drop')
-        _cube = self.timeline(owner, cube, admin=True)
-        if drop:
-            # json serialization->deserialization process leaves
-            # us with a list of lists which pymongo rejects
-            drop = map(tuple, drop) if isinstance(drop, list) else drop
-            _cube.drop_index(drop)
-        self.write(_cube.index_information())
+        result = yield self.run_async('index', self.drop_index,
+                                      owner, cube, drop)
+        self.write(result)
 
     @authenticated
+    @gen.coroutine
     def get(self, owner, cube):
         '''
         Return a list of the existing cube indexes.
@@ -153,11 +262,12 @@ class IndexHdlr(MongoDBBackendHdlr):
         :param owner: username of cube owner
         :param cube: cube name
         '''
-        self.requires_read(owner, cube)
-        _cube = self.timeline(owner, cube, admin=True)
-        self.write(_cube.index_information())
+        result = yield self.run_async('index', self.index_information,
+                                      owner, cube)
+        self.write(result)
 
     @authenticated
+    @gen.coroutine
     def post(self, owner, cube):
         '''
         Create a new index for a cube.
@@ -165,7 +275,6 @@ class IndexHdlr(MongoDBBackendHdlr):
         :param owner: username of cube owner
         :param cube: cube name
         '''
-        self.requires_admin(owner, cube)
         ensure = self.get_argument('ensure')
         background = self.get_argument('background', True)
         name = self.get_argument('name', None)
@@ -174,6 +283,37 @@ class IndexHdlr(MongoDBBackendHdlr):
             kwargs['name'] = name
         if background:
             kwargs['background'] = background
+        result = yield self.run_async('index', self.ensure_index,
+                                      owner, cube, ensure, **kwargs)
+        self.write(result)
+
+    def drop_index(self, owner, cube, drop=None):
+        '''
+        Drop the given index and return back the remaining ones.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        :param drop: index (name or spec) to drop
+        '''
+        self.requires_admin(owner, cube)
+        _cube = self.timeline(owner, cube, admin=True)
+        if drop:
+            # json serialization->deserialization process leaves
+            # us with a list of lists which pymongo rejects
+            drop = map(tuple, drop) if isinstance(drop, list) else drop
+            _cube.drop_index(drop)
+        return _cube.index_information()
+
+    def ensure_index(self, owner, cube, ensure=None, **kwargs):
+        '''
+        Ensure the given index exists and return back all the indexes.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        :param ensure: index spec to ensure
+        :param kwargs: pymongo ensure_index options
+        '''
+        self.requires_admin(owner, cube)
         _cube = self.timeline(owner, cube, admin=True)
         if ensure:
             # json serialization->deserialization process leaves us
@@ -181,7 +321,95 @@ class IndexHdlr(MongoDBBackendHdlr):
             # to ordered dict instead
             ensure = map(tuple, ensure) if isinstance(ensure, list) else ensure
             _cube.ensure_index(ensure, **kwargs)
-        self.write(_cube.index_information())
+        return _cube.index_information()
+
+    def index_information(self, owner, cube):
+        '''
+        Return back the existing cube indexes.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        self.requires_read(owner, cube)
+        _cube = self.timeline(owner, cube, admin=True)
+        return _cube.index_information()
+
+
+class IndexAdviceHdlr(MongoDBBackendHdlr):
+    '''
+    RequestHandler for checking the indexes of a cube against the
+    indexes its (temporal) queries are planned to use
+    '''
+    @authenticated
+    @gen.coroutine
+    def get(self, owner, cube):
+        '''
+        Return the cube's missing and redundant indexes, and the
+        query plans of current value and as of date queries.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        query = self.get_argument('query')
+        date = self.get_argument('date')
+        result = yield self.run_async('index', self.index_advice,
+                                      owner, cube, query, date)
+        self.write(result)
+
+    @authenticated
+    @gen.coroutine
+    def post(self, owner, cube):
+        '''
+        Create the cube's missing indexes; then return the advice.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        query = self.get_argument('query')
+        date = self.get_argument('date')
+        result = yield self.run_async('index', self.index_advice,
+                                      owner, cube, query, date, apply=True)
+        self.write(result)
+
+    def index_advice(self, owner, cube, query=None, date=None, apply=False):
+        '''
+        Compare the cube's indexes with CUBE_INDEXES; returning back
+        the missing ones and the existing ones which are redundant
+        (prefixes of one of CUBE_INDEXES). Explain current value and
+        as of date versions of the query, to verify they're planned
+        on indexes (see utils.explain_summary); explaining runs them.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        :param query: pql query to explain; defaults to all objects
+        :param date: as of date to explain; defaults to now
+        :param apply: create the missing indexes (in the background)?
+        '''
+        if apply:
+            self.requires_admin(owner, cube)
+        else:
+            self.requires_read(owner, cube)
+        _cube = self.timeline(owner, cube, admin=apply)
+        keys = dict((name, _index_key(info['key']))
+                    for name, info in _cube.index_information().iteritems())
+        missing = [index for index in CUBE_INDEXES
+                   if index not in keys.values()]
+        if apply:
+            for index in missing:
+                _cube.ensure_index(index, background=True)
+            missing = []
+        redundant = sorted(name for name, key in keys.iteritems()
+                           if key not in CUBE_INDEXES and
+                           any(index[:len(key)] == key
+                               for index in CUBE_INDEXES))
+
+        date = date or utcnow(as_datetime=True).isoformat()
+        plans = {}
+        for name, _date in (('current', None), ('as_of', date)):
+            spec = parse_pql_query(query, _date)
+            plans[name] = explain_summary(_cube.find(spec).explain())
+        return {'missing': missing, 'redundant': redundant,
+                'plans': plans}
 
 
 class ListHdlr(MongoDBBackendHdlr):
@@ -189,6 +417,7 @@ class ListHdlr(MongoDBBackendHdlr):
     RequestHandler for querying about available cubes and cube.fields
     '''
     @authenticated
+    @gen.coroutine
     def get(self, owner=None, cube=None):
         if (owner and cube):
             # return a 'best effort' of fields in the case that there are
@@ -197,9 +426,12 @@ class ListHdlr(MongoDBBackendHdlr):
             # (maxed out?) to ensure accuracy
             sample_size = self.get_argument('sample_size')
             query = self.get_argument('query')
-            names = self.sample_fields(owner, cube, sample_size, query=query)
+            names = yield self.run_async('list', self.sample_fields,
+                                         owner, cube, sample_size,
+                                         query=query)
         else:
-            names = self.get_readable_collections()
+            names = yield self.run_async('list',
+                                         self.get_readable_collections)
         if owner and not cube:
             # filter out by startswith prefix string
             names = [n for n in names if n and n.startswith(owner)]
@@ -235,9 +467,11 @@ class RenameHdlr(MongoDBBackendHdlr):
     '''
     RequestHandler for renaming cubes.
     '''
+    @gen.coroutine
     def post(self, owner, cube):
         new_name = self.get_argument('new_name')
-        result = self.rename(owner=owner, cube=cube, new_name=new_name)
+        result = yield self.run_async('rename', self.rename, owner=owner,
+                                      cube=cube, new_name=new_name)
         self.write(result)
 
     def rename(self, owner, cube, new_name):
@@ -264,18 +498,28 @@ class RenameHdlr(MongoDBBackendHdlr):
         # get the cube_profile doc
         spec = {'_id': old}
         doc = _cube_profile.find_one(spec)
+        # rename the cube's snapshots (sub collections) too
+        for snapshot in doc.get('snapshots') or []:
+            name = new + snapshot['collection'][len(old):]
+            self._timeline_admin[snapshot['collection']].rename(name)
+            snapshot['collection'] = name
         # save the doc with new _id
         doc.update({'_id': new})
         _cube_profile.insert(doc)
         # rename the collection
 
         self.mongodb_config.db_timeline_admin[old].rename(new)
+        self.rollups(admin=True).update({'cube': old},
+                                        {'$set': {'cube': new}}, multi=True)
         # push the collection into the list of ones user owns
         self.update_user_profile(owner, 'addToSet', 'own', new)
         # pull the old cube from user profile's 'own'
         self.update_user_profile(owner, 'pull', 'own', old)
         # remove the old doc
         _cube_profile.remove(spec)
+        self.invalidate_profile(_cube_profile, old)
+        self.invalidate_profile(_cube_profile, new)
+        self.bump_write_generation(owner, new_name)
         return True
 
 
@@ -283,8 +527,10 @@ class RegisterHdlr(MongoDBBackendHdlr):
     '''
     RequestHandler for registering new cubes.
     '''
+    @gen.coroutine
     def post(self, owner, cube):
-        result = self.register(owner=owner, cube=cube)
+        result = yield self.run_async('register', self.register,
+                                      owner=owner, cube=cube)
         self.write(result)
 
     def register(self, owner, cube):
@@ -333,8 +579,13 @@ class RegisterHdlr(MongoDBBackendHdlr):
                'created': now_utc,
                'read': [],
                'write': [],
-               'admin': [owner]}
-        self.cube_profile(admin=True).insert(doc)
+               'admin': [owner],
+               # cached results of dropped cubes of the same
+               # name must never match the new cube's
+               'write_generation': str(ObjectId())}
+        _cube_profile = self.cube_profile(admin=True)
+        _cube_profile.insert(doc)
+        self.invalidate_profile(_cube_profile, collection)
 
         # push the collection into the list of ones user owns
         self.update_user_profile(owner, 'addToSet', 'own', collection)
@@ -342,10 +593,8 @@ class RegisterHdlr(MongoDBBackendHdlr):
         # run core index
         _cube = self.timeline(owner, cube, admin=True)
         # ensure basic indices:
-        _cube.ensure_index([('_hash', 1), ('_end', 1)])
-        _cube.ensure_index('_oid')
-        _cube.ensure_index('_start')  # used in core_api.get_cube_last_start
-        _cube.ensure_index('_end')  # default for non-historical queries
+        for index in CUBE_INDEXES:
+            _cube.ensure_index(index)
         return remaining
 
 
@@ -354,11 +603,13 @@ class RemoveObjectsHdlr(MongoDBBackendHdlr):
     RequestHandler for removing objects from a cube.
     '''
     @authenticated
+    @gen.coroutine
     def delete(self, owner, cube):
         query = self.get_argument('query')
         date = self.get_argument('date')
-        result = self.remove_objects(owner=owner, cube=cube,
-                                     query=query, date=date)
+        result = yield self.run_async('remove', self.remove_objects,
+                                      owner=owner, cube=cube,
+                                      query=query, date=date)
         self.write(result)
 
     def remove_objects(self, owner, cube, query, date=None):
@@ -375,8 +626,7 @@ class RemoveObjectsHdlr(MongoDBBackendHdlr):
             return []
 
         if isinstance(query, basestring):
-            query = query_add_date(query, date)
-            spec = parse_pql_query(query)
+            spec = parse_pql_query(query, date)
         elif isinstance(query, (list, tuple)):
             spec = {'_id': {'$in': query}}
         else:
@@ -384,7 +634,161 @@ class RemoveObjectsHdlr(MongoDBBackendHdlr):
                 'Expected query string or list of ids, got: %s' % type(query))
 
         _cube = self.timeline(owner, cube, admin=True)
-        return _cube.remove(spec)
+        # registered before the rollups build is read; see rebuild_rollups
+        token = self.begin_write(owner, cube)
+        try:
+            rollup_fields, build = self.cube_rollups(owner, cube)
+            if rollup_fields:
+                deltas = {}
+                fields = dict((f, 1) for f in
+                              ['_start', '_end'] + rollup_fields if f)
+                for doc in _cube.find(spec, fields=fields):
+                    rollup_version(deltas, rollup_fields, doc, -1)
+            result = _cube.remove(spec)
+            if rollup_fields:
+                self.update_rollups(owner, cube, deltas, build)
+            for snapshot in self.cube_snapshots(owner, cube):
+                self._timeline_admin[snapshot['collection']].remove(spec)
+        finally:
+            self.bump_write_generation(owner, cube, token)
+        return result
+
+
+class RollupHdlr(MongoDBBackendHdlr):
+    '''
+    RequestHandler for managing the daily rollups of a cube; the
+    pre-aggregated counts history queries are answered from.
+    '''
+    @authenticated
+    @gen.coroutine
+    def delete(self, owner, cube):
+        '''
+        Drop the cube's rollups.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        result = yield self.run_async('rollup', self.drop_rollups,
+                                      owner, cube)
+        self.write(result)
+
+    @authenticated
+    @gen.coroutine
+    def get(self, owner, cube):
+        '''
+        Return the cube's rollup fields and size.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        result = yield self.run_async('rollup', self.rollup_info,
+                                      owner, cube)
+        self.write(result)
+
+    @authenticated
+    @gen.coroutine
+    def post(self, owner, cube):
+        '''
+        (Re)build the cube's rollups.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        fields = self.get_argument('fields')
+        result = yield self.run_async('rollup', self.rebuild_rollups,
+                                      owner, cube, fields)
+        self.write(result)
+
+    def drop_rollups(self, owner, cube):
+        '''
+        Stop keeping daily rollups of the cube and remove them.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        self.requires_admin(owner, cube)
+        self.update_cube_profile(owner, cube, 'set', 'rollups', None)
+        self.rollups(admin=True).remove({'cube': self.cjoin(owner, cube)})
+        return True
+
+    def rebuild_rollups(self, owner, cube, fields=None):
+        '''
+        Start keeping daily rollups of the cube, for the given fields,
+        and (re)build them from the cube's versions.
+
+        Rollups hold, per day, the number of versions which started
+        minus the number which ended that day; per value of each
+        rollup field and in total. Saves and removals keep them up
+        to date.
+
+        New rollups are built under a new build id, then swapped in;
+        until then, history queries read the previous rollups (or the
+        cube). The rebuild fails (409), and the new build is
+        discarded, if the cube is written to (saves or removals)
+        before it's swapped in.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        :param fields: list of fields to roll up (by_field of history
+                       queries); the total is always rolled up
+        '''
+        self.requires_admin(owner, cube)
+        fields = fields or []
+        if not isinstance(fields, list) or \
+                not all(isinstance(f, basestring) for f in fields):
+            self._raise(400, "fields must be a list of field names")
+        fields = sorted(set(fields))
+        collection = self.cjoin(owner, cube)
+        # writes from now on would be missing from the new build
+        unwritten = self.unwritten_spec(owner, cube)
+        if unwritten is None:
+            self._raise(409, "cube is being written to; try again later")
+        build = str(ObjectId())
+        _rollups = self.rollups(admin=True)
+        _rollups.ensure_index([('cube', 1), ('build', 1), ('field', 1),
+                               ('day', 1)])
+
+        # count the versions per distinct value, _start and _end;
+        # like HistoryHdlr.history does
+        _cube = self.timeline(owner, cube, admin=True)
+        deltas = {}
+        for field in [None] + fields:
+            _id = {'start': '$_start', 'end': '$_end'}
+            if field:
+                _id['value'] = '$%s' % field
+            agg = [{'$group': {'_id': _id, 'count': {'$sum': 1}}}]
+            for row in self.aggregate_rows(_cube, agg):
+                _id = row['_id']
+                version = {'_start': _id['start'], '_end': _id.get('end'),
+                           field: _id.get('value')}
+                rollup_version(deltas, [field], version, row['count'])
+        self.update_rollups(owner, cube, deltas, build)
+        # swap the new build in, unless the cube was written to
+        # meanwhile; then remove the previous one
+        rollups = {'fields': fields, 'build': build}
+        _profiles = self.cube_profile(admin=True)
+        result = _profiles.update(unwritten, {'$set': {'rollups': rollups}})
+        self.invalidate_profile(_profiles, collection)
+        if not result.get('n'):
+            _rollups.remove({'cube': collection, 'build': build})
+            self._raise(409, "cube written to during the rollups rebuild; "
+                        "try again later")
+        _rollups.remove({'cube': collection, 'build': {'$ne': build}})
+        return self.rollup_info(owner, cube)
+
+    def rollup_info(self, owner, cube):
+        '''
+        Return back the cube's rollup fields (None if the cube has
+        no rollups) and the number of rollup docs.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        self.requires_read(owner, cube)
+        fields, build = self.cube_rollups(owner, cube)
+        spec = {'cube': self.cjoin(owner, cube), 'build': build}
+        return {'fields': fields[1:] if fields else None,
+                'size': self.rollups().find(spec).count()}
 
 
 class SaveObjectsHdlr(MongoDBBackendHdlr):
@@ -392,21 +796,31 @@ class SaveObjectsHdlr(MongoDBBackendHdlr):
     RequestHandler for saving/persisting objects to a cube
     '''
     @authenticated
+    @gen.coroutine
     def post(self, owner, cube):
         objects = self.get_argument('objects')
         autosnap = self.get_argument('autosnap')
-        result = self.save_objects(owner=owner, cube=cube,
-                                   objects=objects, autosnap=autosnap)
+        start_time = self.get_argument('start_time')
+        try:
+            start_time = dt2ts(start_time)
+        except Exception as e:
+            self._raise(400, "invalid start_time (%s): %s" % (start_time, e))
+        result = yield self.run_async('save', self.save_objects,
+                                      owner=owner, cube=cube,
+                                      objects=objects, autosnap=autosnap,
+                                      start_time=start_time)
         self.write(result)
 
-    def _prepare_objects(self, objects, autosnap=True):
+    def _prepare_objects(self, objects, autosnap=True, start_time=None):
         '''
         Validate and normalize objects.
 
         :param _cube: mongodb cube collection proxy
         :param obejcts: list of objects to manipulate
+        :param start_time: epoch _start of objects without one;
+                           defaults to now
         '''
-        start = utcnow()
+        start = start_time or utcnow()
         _exclude_hash = ['_hash', '_id', '_start', '_end']
         _end_types_ok = NoneType if autosnap else (NoneType, float, int)
         for i, o in enumerate(objects):
@@ -429,30 +843,50 @@ class SaveObjectsHdlr(MongoDBBackendHdlr):
 
         return objects
 
-    @staticmethod
-    def _get_start(_id, objs):
-        for o in objs:
-            if o['_oid'] == _id:
-                return o['_start']
-
     def _prep_snap_objects(self, _cube, objects):
-        # get current obj where _end:None and the _hash isn't the
-        # same (ie, objects isn't a duplicate)
-        hash_map = dict([(o['_oid'], o['_hash']) for o in objects])
-        _objs = _cube.find({'_end': None,
-                            '_oid': {'$in': hash_map.keys()},
-                            '_hash': {'$nin': hash_map.values()}})
-        k = _objs.count()
-        logger.debug('%s objects need to be rotated' % k)
-        if k > 0:  # nothing to rotate...
+        '''
+        Append rotated copies of the current (_end:None) versions
+        which are being replaced by a new version with a different
+        _hash (ie, objects which aren't duplicates).
+
+        :param _cube: mongodb cube collection proxy
+        :param objects: list of _end:None objects to be saved
+        '''
+        # index the objects by _oid once per batch; the first version
+        # of each _oid supplies the _end of the rotated version
+        index = {}
+        for o in objects:
+            index.setdefault(o['_oid'], o)
+        to_rotate = self._plan_rotation(_cube, index)
+        logger.debug('%s objects need to be rotated' % len(to_rotate))
+        if to_rotate:
+            _objs = _cube.find({'_id': {'$in': to_rotate}})
             for o in _objs:
                 # _end of existing obj where _end:None should get new's _start
-                o['_end'] = self._get_start(o['_oid'], objects)
+                o['_end'] = index[o['_oid']]['_start']
                 o = self._obj_id(o)
                 objects.append(o)
         return objects
 
-    def save_objects(self, owner, cube, objects, autosnap=True):
+    def _plan_rotation(self, _cube, index):
+        '''
+        Return back the _ids of current (_end:None) versions whose
+        _hash differs from the new version of the same _oid.
+
+        Only _oid and _hash of the candidates are fetched; full
+        documents are queried later only for those to be rotated.
+
+        :param _cube: mongodb cube collection proxy
+        :param index: dict of _oid -> new object
+        '''
+        spec = {'_end': None, '_oid': {'$in': index.keys()}}
+        fields = {'_id': 1, '_oid': 1, '_hash': 1}
+        candidates = _cube.find(spec, fields=fields)
+        return [d['_id'] for d in candidates
+                if d.get('_hash') != index[d['_oid']]['_hash']]
+
+    def save_objects(self, owner, cube, objects, autosnap=True,
+                     start_time=None):
         '''
         Get a list of dictionary objects from client and insert
         or save them to the timeline.
@@ -463,13 +897,19 @@ class SaveObjectsHdlr(MongoDBBackendHdlr):
         :param autosnap: flag indicating non-dup _end:None objects
                          should rotate previous _end:None value before
                          saving
+        :param start_time: epoch _start of objects without one;
+                           defaults to now (serverside)
 
         Incoming objects must all have _oid and _start defined.
         Optionally, objects can have _end defined.
 
         '''
         self.requires_write(owner, cube)
+        return self._save_objects(owner, cube, objects, autosnap,
+                                  start_time)
 
+    def _save_objects(self, owner, cube, objects, autosnap=True,
+                      start_time=None):
         logger.debug(
             '[%s.%s] Recieved %s objects' % (owner, cube, len(objects)))
 
@@ -478,7 +918,7 @@ class SaveObjectsHdlr(MongoDBBackendHdlr):
 
         _cube = self.timeline(owner, cube, admin=True)
 
-        objects = self._prepare_objects(objects, autosnap)
+        objects = self._prepare_objects(objects, autosnap, start_time)
 
         snap_objects, save_objects = [], []
         for o in objects:
@@ -494,11 +934,147 @@ class SaveObjectsHdlr(MongoDBBackendHdlr):
 
         # save each object; overwrite existing (same _oid + _start or _oid if
         # _end = None) or upsert
-        objects = itertools.chain(save_objects, snap_objects)
-        _ids = [_cube.save(o, manipulate=True) for o in objects]
+        objects = list(itertools.chain(save_objects, snap_objects))
+        # registered before the rollups build is read; see rebuild_rollups
+        token = self.begin_write(owner, cube)
+        try:
+            rollup_fields, build = self.cube_rollups(owner, cube)
+            snapshots = self.cube_snapshots(owner, cube)
+            # the versions replaced and saved keep rollups and snapshots
+            # up to date
+            versions = [] if rollup_fields or snapshots else None
+            try:
+                _ids = self._save_bulk(_cube, objects, versions,
+                                       filter(None, rollup_fields or []))
+            finally:
+                if rollup_fields:
+                    deltas = {}
+                    for old, new in versions:
+                        if old:
+                            rollup_version(deltas, rollup_fields, old, -1)
+                        rollup_version(deltas, rollup_fields, new)
+                    self.update_rollups(owner, cube, deltas, build)
+                if snapshots:
+                    self.update_snapshots(owner, cube, snapshots, versions)
+        finally:
+            # even partially failed saves modify the cube
+            self.bump_write_generation(owner, cube, token)
         logger.debug('[%s.%s] %s versions saved' % (owner, cube, len(_ids)))
         return _ids
 
+    def _save_bulk(self, _cube, objects, versions=None, fields=None):
+        '''
+        Save objects in chunks of bulk write operations.
+
+        The chunk size and whether the bulk operations are ordered
+        or not is set by the `save_batch_size` and `save_ordered`
+        metriqued config options.
+
+        :param _cube: mongodb cube collection proxy
+        :param objects: list of prepared objects to save
+        :param versions: list to append the versions replaced and saved
+                         by each saved batch to; see _save_batch
+        :param fields: fields of the replaced versions to return back
+        :returns: list of saved object _ids, in the order given
+        '''
+        batch_size = self.metrique_config.save_batch_size
+        ordered = self.metrique_config.save_ordered
+        _ids = []
+        for batch in batch_gen(objects, batch_size):
+            _ids.extend(self._save_batch(_cube, batch, ordered,
+                                         versions, fields))
+        return _ids
+
+    def _save_batch(self, _cube, objects, ordered=False, versions=None,
+                    fields=None):
+        '''
+        Bulk insert objects with new _ids and bulk replace (upsert)
+        objects with existing _ids.
+
+        Objects whose _id repeats within the batch, or whose insert
+        fails with a duplicate key error (eg, a concurrent save), are
+        saved one by one afterwards, so the last version given wins.
+
+        Once the batch is saved, (replaced version or None, saved
+        version) pairs are appended to versions, if given. Replaced
+        versions hold only their _id, _start, _end and the given
+        fields. Versions saved concurrently by another request
+        might be missed.
+
+        :param _cube: mongodb cube collection proxy
+        :param objects: list of prepared objects to save
+        :param ordered: run the bulk operation as ordered?
+        :param versions: list to append the versions saved to
+        :param fields: fields of the replaced versions to return back
+        '''
+        _ids = [o['_id'] for o in objects]
+        spec = {'_id': {'$in': _ids}}
+        _fields = ['_id']
+        if versions is not None:
+            _fields += ['_start', '_end'] + list(fields or [])
+        _fields = dict((f, 1) for f in _fields)
+        docs = _cube.find(spec, fields=_fields)
+        existing = dict((d['_id'], d) for d in docs)
+
+        if ordered:
+            bulk = _cube.initialize_ordered_bulk_op()
+        else:
+            bulk = _cube.initialize_unordered_bulk_op()
+
+        seen, ops, conflicts = set(), [], []
+        for o in objects:
+            _id = o['_id']
+            if _id in seen:
+                conflicts.append(o)
+                continue
+            seen.add(_id)
+            if _id in existing:
+                bulk.find({'_id': _id}).upsert().replace_one(o)
+            else:
+                bulk.insert(o)
+            ops.append(o)
+
+        retry = []
+        if ops:
+            try:
+                bulk.execute()
+            except BulkWriteError as e:
+                retry = self._bulk_conflicts(e, ops, ordered)
+        conflicts = retry + conflicts
+
+        logger.debug('%s bulk saved; %s saved individually' % (
+            len(ops) - len(retry), len(conflicts)))
+        [_cube.save(o, manipulate=True) for o in conflicts]
+
+        if versions is not None:
+            for o in objects:
+                versions.append((existing.get(o['_id']), o))
+                existing[o['_id']] = o
+        return _ids
+
+    def _bulk_conflicts(self, error, ops, ordered=False):
+        '''
+        Return back the objects of a failed bulk operation which
+        need to be saved individually, if all the errors were
+        duplicate key errors. Otherwise, re-raise the error.
+
+        :param error: BulkWriteError raised by bulk.execute()
+        :param ops: list of objects, in bulk operation order
+        :param ordered: was the bulk operation ordered?
+        '''
+        details = error.details
+        errors = details.get('writeErrors', [])
+        ok = all(e.get('code') in DUP_KEY_ERRORS for e in errors)
+        if not ok or details.get('writeConcernErrors'):
+            logger.error('bulk save failed: %s' % details)
+            raise error
+        conflicts = [ops[e['index']] for e in errors]
+        if ordered and errors:
+            # ordered bulk operations stop at the first error; the
+            # remaining operations were never run
+            conflicts.extend(ops[errors[-1]['index'] + 1:])
+        return conflicts
+
     def _obj_id(self, obj):
         if obj['_end']:
             # if the object at the exact start/oid is later
@@ -532,13 +1108,297 @@ class SaveObjectsHdlr(MongoDBBackendHdlr):
         return obj
 
 
+@stream_request_body
+class SaveStreamHdlr(SaveObjectsHdlr):
+    '''
+    RequestHandler for saving/persisting objects to a cube from a
+    streamed request body of newline-delimited JSON objects,
+    optionally gzip compressed (Content-Encoding: gzip). The body is
+    limited to save_stream_max_bytes, compressed and decompressed,
+    and each object to decompress_max_bytes.
+
+    Objects are saved in batches of `save_batch_size` while the
+    request body is still being received. Batches saved before an
+    error are not rolled back; error responses list their _ids
+    under 'saved'.
+    '''
+    @gen.coroutine
+    def prepare(self):
+        owner, cube = self.path_args
+        if not self.current_user:
+            self._raise(401, "authentication required")
+        yield self.run_async('save', self.requires_write, owner, cube)
+        max_bytes = self.metrique_config.save_stream_max_bytes
+        self.request.connection.set_max_body_size(max_bytes)
+        self._autosnap = self.get_argument('autosnap', True)
+        encoding = self.request.headers.get('Content-Encoding', '')
+        if 'gzip' in encoding:
+            self._decompressor = GzipDecoder(max_bytes)
+        else:
+            self._decompressor = None
+        self._buffer = ''
+        self._batch = []
+        self._saved = []
+        self._error = None
+
+    @gen.coroutine
+    def data_received(self, chunk):
+        if self._error:
+            return  # discard the rest of the body
+        try:
+            self._read_chunk(chunk)
+            # the rest of the body isn't read until the batches are saved
+            yield self._save_batches()
+        except HTTPError as e:
+            self._error = e
+        except Exception as e:
+            logger.error('stream save failed: %s' % e)
+            self._error = HTTPError(500, str(e))
+
+    @gen.coroutine
+    def post(self, owner, cube):
+        if self._error:
+            raise self._error
+        if self._decompressor:
+            self._read_chunk('', flush=True)
+        # the last line might not be newline terminated
+        self._parse_line(self._buffer)
+        self._buffer = ''
+        yield self._save_batches(flush=True)
+        logger.debug('[%s.%s] %s versions saved from stream' % (
+            owner, cube, len(self._saved)))
+        self.write(self._saved)
+
+    def write_error(self, status_code, **kwargs):
+        saved = getattr(self, '_saved', None)
+        if not saved:
+            return super(SaveStreamHdlr, self).write_error(status_code,
+                                                           **kwargs)
+        headers = getattr(self, '_error_headers', None)
+        if headers:
+            [self.set_header(name, value) for name, value in headers.items()]
+        exc = kwargs.get('exc_info', (None, None))[1]
+        message = getattr(exc, 'log_message', None) or self._reason
+        self.finish({'code': status_code, 'message': message,
+                     'saved': saved})
+
+    def _read_chunk(self, chunk, flush=False):
+        '''
+        Decompress, if gzip compressed, and parse a chunk of the
+        request body; flushing the decompressor if flush is True.
+        '''
+        try:
+            if self._decompressor:
+                chunk = self._decompressor.decompress(chunk)
+                if flush:
+                    chunk += self._decompressor.flush()
+            self._parse_chunk(chunk)
+        except zlib.error as e:
+            self._raise(400, "Invalid gzip content: %s" % e)
+        except ValueError as e:
+            self._raise(413, str(e))
+
+    def _parse_chunk(self, chunk):
+        lines = (self._buffer + chunk).split('\n')
+        # keep the trailing, incomplete line for the next chunk
+        self._buffer = lines.pop()
+        max_bytes = self.metrique_config.decompress_max_bytes
+        if max_bytes > 0 and len(self._buffer) > max_bytes:
+            raise ValueError("object exceeds %s bytes" % max_bytes)
+        [self._parse_line(line) for line in lines]
+
+    def _parse_line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            obj = json.loads(line)
+        except ValueError as e:
+            self._raise(400, "Invalid JSON content: %s" % e)
+        if not isinstance(obj, dict):
+            self._raise(400, "expected JSON object; got %s" % type(obj))
+        self._batch.append(obj)
+
+    @gen.coroutine
+    def _save_batches(self, flush=False):
+        '''
+        Save the parsed objects in batches of save_batch_size;
+        including the last, partial, batch if flush is True.
+        '''
+        owner, cube = self.path_args
+        batch_size = self.metrique_config.save_batch_size
+        if batch_size <= 0:
+            # save everything at once, at the end
+            batch_size = len(self._batch) if flush else 0
+        while self._batch and batch_size > 0 and (
+                flush or len(self._batch) >= batch_size):
+            objects = self._batch[:batch_size]
+            self._batch = self._batch[batch_size:]
+            _ids = yield self.run_async('save', self._save_objects,
+                                        owner, cube, objects,
+                                        self._autosnap)
+            self._saved.extend(_ids)
+
+
+class SnapshotHdlr(MongoDBBackendHdlr):
+    '''
+    RequestHandler for managing the point-in-time snapshots of a
+    cube; the cube's objects as of a date, which exact date find
+    and count queries are served from.
+    '''
+    @authenticated
+    @gen.coroutine
+    def delete(self, owner, cube):
+        '''
+        Drop the cube's snapshot of the given date.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        date = self.get_argument('date')
+        result = yield self.run_async('snapshot', self.drop_snapshot,
+                                      owner, cube, date)
+        self.write(result)
+
+    @authenticated
+    @gen.coroutine
+    def get(self, owner, cube):
+        '''
+        Return the list of the cube's snapshots.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        result = yield self.run_async('snapshot', self.list_snapshots,
+                                      owner, cube)
+        self.write(result)
+
+    @authenticated
+    @gen.coroutine
+    def post(self, owner, cube):
+        '''
+        (Re)build the cube's snapshot of the given date.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        date = self.get_argument('date')
+        result = yield self.run_async('snapshot', self.build_snapshot,
+                                      owner, cube, date)
+        self.write(result)
+
+    def _snapshot_date(self, date):
+        if not isinstance(date, basestring) or not date or '~' in date:
+            self._raise(400, "snapshot date must be a single date")
+        # rounded like the dates of date queries
+        return round(dt2ts(date), 6)
+
+    def build_snapshot(self, owner, cube, date):
+        '''
+        Copy the cube objects (versions) current at the given date
+        into a snapshot collection of the cube, server side, and add
+        it to the cube's snapshot catalog; replacing any snapshot of
+        the same date.
+
+        Saves and removals keep snapshots up to date. Build them
+        while the cube isn't being written to.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        :param date: date of the snapshot
+        '''
+        self.requires_admin(owner, cube)
+        ts = self._snapshot_date(date)
+        snapshots = self.cube_snapshots(owner, cube)
+        names = dict((s['date'], s['collection']) for s in snapshots)
+        name = names.get(ts) or '%s.snapshot.%s' % (self.cjoin(owner, cube),
+                                                    ObjectId())
+        _cube = self.timeline(owner, cube, admin=True)
+        spec = and_specs(*date_spec(date))
+        try:
+            # $out replaces the snapshot collection, if any, atomically
+            _cube.aggregate([{'$match': spec}, {'$out': name}])
+        except OperationFailure:
+            # mongodb < 2.6 has no $out; copy, then swap the copy in
+            self._copy_objects(_cube, spec, name)
+        _snapshot = self._timeline_admin[name]
+        # same indexes as the cube; but _hash, which is used by saves
+        for index in CUBE_INDEXES:
+            if index[0][0] != '_hash':
+                _snapshot.ensure_index(index)
+
+        snapshots = [s for s in snapshots if s['date'] != ts]
+        snapshots.append({'date': ts, 'collection': name,
+                          'created': utcnow()})
+        snapshots.sort(key=lambda s: s['date'])
+        self.update_cube_profile(owner, cube, 'set', 'snapshots', snapshots)
+        return {'date': ts, 'size': _snapshot.count()}
+
+    def _copy_objects(self, _cube, spec, name):
+        '''
+        Replace the named collection with a copy of the cube objects
+        matching spec; the copy is renamed over the collection once
+        it's complete.
+        '''
+        batch_size = self.metrique_config.save_batch_size
+        if batch_size <= 0:
+            batch_size = None  # copy everything at once
+        _copy = self._timeline_admin['%s.copy' % name]
+        _copy.drop()
+        cursor = _cube.find(spec)
+        while True:
+            batch = list(itertools.islice(cursor, batch_size))
+            if not batch:
+                break
+            _copy.insert(batch)
+        if _copy.count():
+            _copy.rename(name, dropTarget=True)
+        else:
+            self._timeline_admin[name].remove({})
+
+    def drop_snapshot(self, owner, cube, date):
+        '''
+        Drop the cube's snapshot of the given date.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        :param date: date of the snapshot
+        '''
+        self.requires_admin(owner, cube)
+        ts = self._snapshot_date(date)
+        snapshots = self.cube_snapshots(owner, cube)
+        names = [s['collection'] for s in snapshots if s['date'] == ts]
+        if not names:
+            self._raise(404, "%s.%s has no snapshot of %s" % (owner, cube,
+                                                              date))
+        snapshots = [s for s in snapshots if s['date'] != ts]
+        self.update_cube_profile(owner, cube, 'set', 'snapshots', snapshots)
+        self._timeline_admin[names[0]].drop()
+        return True
+
+    def list_snapshots(self, owner, cube):
+        '''
+        Return back the date, creation date and size of each of the
+        cube's snapshots.
+
+        :param owner: username of cube owner
+        :param cube: cube name
+        '''
+        self.requires_read(owner, cube)
+        return [{'date': s['date'], 'created': s['created'],
+                 'size': self._timeline_data[s['collection']].count()}
+                for s in self.cube_snapshots(owner, cube)]
+
+
 class StatsHdlr(MongoDBBackendHdlr):
     '''
     RequestHandler for getting basic statistics about a cube
     '''
     @authenticated
+    @gen.coroutine
     def get(self, owner, cube):
-        result = self.stats(owner=owner, cube=cube)
+        result = yield self.run_async('stats', self.stats,
+                                      owner=owner, cube=cube)
         self.write(result)
 
     def stats(self, owner, cube):
@@ -564,13 +1424,15 @@ class UpdateRoleHdlr(MongoDBBackendHdlr):
     role can be read, write, admin
     '''
     @authenticated
+    @gen.coroutine
     def post(self, owner, cube):
         username = self.get_argument('username')
         action = self.get_argument('action')
         role = self.get_argument('role')
-        result = self.update_role(owner=owner, cube=cube,
-                                  username=username,
-                                  action=action, role=role)
+        result = yield self.run_async('update_role', self.update_role,
+                                      owner=owner, cube=cube,
+                                      username=username,
+                                      action=action, role=role)
         self.write(result)
 
     def update_role(self, owner, cube, username, action='addToSet',
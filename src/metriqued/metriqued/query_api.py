@@ -9,16 +9,21 @@ metriqued.query_api
 This module contains all the query metriqued api functionality.
 '''
 
+import base64
+from bisect import bisect_right
+from bson import json_util
+import hashlib
+import heapq
+from itertools import chain, islice
 import logging
-from operator import itemgetter
-import pql
-import random
+from pymongo.cursor import Cursor
+import simplejson as json
+from tornado import gen
 from tornado.web import authenticated
-from collections import defaultdict
 
-from metriqued.utils import parse_pql_query
-from metriqued.utils import date_pql_string, query_add_date
-from metriqued.core_api import MongoDBBackendHdlr
+from metriqued.utils import parse_pql_query, and_specs, and_date_specs
+from metriqued.utils import date_spec, rollup_day, rollup_key
+from metriqued.core_api import MongoDBBackendHdlr, SAMPLE_SIZE
 
 from metriqueu.utils import set_default, dt2ts
 
@@ -31,9 +36,12 @@ class AggregateHdlr(MongoDBBackendHdlr):
     framwork pipeines against a given cube
     '''
     @authenticated
+    @gen.coroutine
     def get(self, owner, cube):
         pipeline = self.get_argument('pipeline')
-        result = self.aggregate(owner=owner, cube=cube, pipeline=pipeline)
+        result = yield self.run_async('aggregate', self.cached_result,
+                                      owner, cube, 'aggregate',
+                                      self.aggregate, pipeline=pipeline)
         self.write(result)
 
     def aggregate(self, owner, cube, pipeline):
@@ -57,11 +65,13 @@ class CountHdlr(MongoDBBackendHdlr):
     counts of objects matching the given query
     '''
     @authenticated
+    @gen.coroutine
     def get(self, owner, cube):
         query = self.get_argument('query')
         date = self.get_argument('date')
-        result = self.count(owner=owner, cube=cube,
-                            query=query, date=date)
+        result = yield self.run_async('count', self.cached_result,
+                                      owner, cube, 'count', self.count,
+                                      query=query, date=date)
         self.write(result)
 
     def count(self, owner, cube, query, date=None):
@@ -79,14 +89,9 @@ class CountHdlr(MongoDBBackendHdlr):
         '''
         self.requires_read(owner, cube)
 
-        query = query or ''
-        query = query_add_date(query, date)
-        # FIXME: logging move to parse_pql_query, after
-        # logging refactor
-        spec = parse_pql_query(query)
-        _cube = self.timeline(owner, cube)
-        docs = _cube.find(spec=spec)
-        return docs.count() if docs else 0
+        # exact date counts might be served from a cube snapshot
+        sources = self.snapshot_sources(owner, cube, query, date)
+        return sum(_cube.find(spec=spec).count() for _cube, spec in sources)
 
 
 class DeptreeHdlr(MongoDBBackendHdlr):
@@ -95,14 +100,16 @@ class DeptreeHdlr(MongoDBBackendHdlr):
     oids matching the given tree.
     '''
     @authenticated
+    @gen.coroutine
     def get(self, owner, cube):
         field = self.get_argument('field')
         oids = self.get_argument('oids')
         date = self.get_argument('date')
         level = self.get_argument('level')
-        result = self.deptree(owner=owner, cube=cube,
-                              field=field, oids=oids,
-                              date=date, level=level)
+        result = yield self.run_async('deptree', self.deptree,
+                                      owner=owner, cube=cube,
+                                      field=field, oids=oids,
+                                      date=date, level=level)
         self.write(result)
 
     def deptree(self, owner, cube, field, oids, date, level):
@@ -127,12 +134,12 @@ class DeptreeHdlr(MongoDBBackendHdlr):
         checked = set(oids)
         fringe = oids
         loop_k = 0
-        pql_date = date_pql_string(date)
+        _date_spec = date_spec(date)
         while len(fringe) > 0:
             if level and loop_k == abs(level):
                 break
-            spec = pql.find(
-                '_oid in %s and %s != None and %s' % (fringe, field, pql_date))
+            spec = and_specs({'_oid': {'$in': list(fringe)}},
+                             {field: {'$ne': None}}, *_date_spec)
             _cube = self.timeline(owner, cube)
             fields = {'_id': -1, '_oid': 1, field: 1}
             docs = _cube.find(spec, fields=fields)
@@ -149,12 +156,15 @@ class DistinctHdlr(MongoDBBackendHdlr):
     given cube.field
     '''
     @authenticated
+    @gen.coroutine
     def get(self, owner, cube):
         field = self.get_argument('field')
         query = self.get_argument('query')
         date = self.get_argument('date')
-        result = self.distinct(owner=owner, cube=cube, field=field,
-                               query=query, date=date)
+        result = yield self.run_async('distinct', self.cached_result,
+                                      owner, cube, 'distinct',
+                                      self.distinct, field=field,
+                                      query=query, date=date)
         self.write(result)
 
     def distinct(self, owner, cube, field, query=None, date=None):
@@ -175,8 +185,7 @@ class DistinctHdlr(MongoDBBackendHdlr):
         '''
         self.requires_read(owner, cube)
         if isinstance(query, basestring):
-            query = query_add_date(query, date)
-            spec = parse_pql_query(query)
+            spec = parse_pql_query(query, date)
             result = self.timeline(owner, cube).find(spec).distinct(field)
         else:
             result = self.timeline(owner, cube).distinct(field)
@@ -189,6 +198,7 @@ class FindHdlr(MongoDBBackendHdlr):
     matching the given query
     '''
     @authenticated
+    @gen.coroutine
     def get(self, owner, cube):
         query = self.get_argument('query')
         fields = self.get_argument('fields')
@@ -199,17 +209,51 @@ class FindHdlr(MongoDBBackendHdlr):
         merge_versions = self.get_argument('merge_versions', True)
         skip = self.get_argument('skip')
         limit = self.get_argument('limit')
-        result = self.find(owner=owner, cube=cube,
-                           query=query, fields=fields,
-                           date=date, sort=sort,
-                           one=one, explain=explain,
-                           merge_versions=merge_versions,
-                           skip=skip, limit=limit)
-        self.write(result)
+        batch_size = self.get_argument('batch_size')
+        page_size = self.get_argument('page_size')
+        page_token = self.get_argument('page_token')
+        if page_size:
+            if one or explain or sort or skip or batch_size:
+                self._raise(400, "one, explain, sort, skip and batch_size "
+                            "can't be used with paging")
+            result = yield self.run_async('find', self.find_page,
+                                          owner=owner, cube=cube,
+                                          query=query, fields=fields,
+                                          date=date,
+                                          merge_versions=merge_versions,
+                                          page_size=page_size,
+                                          page_token=page_token)
+            self.write(result)
+        elif batch_size:
+            if one or explain:
+                self._raise(400, "one and explain can't be streamed")
+            yield self.find_stream(owner=owner, cube=cube,
+                                   query=query, fields=fields,
+                                   date=date, sort=sort,
+                                   merge_versions=merge_versions,
+                                   skip=skip, limit=limit,
+                                   batch_size=batch_size)
+        elif explain:
+            result = yield self.run_async('find', self.find,
+                                          owner=owner, cube=cube,
+                                          query=query, fields=fields,
+                                          date=date, sort=sort,
+                                          one=one, explain=explain,
+                                          merge_versions=merge_versions,
+                                          skip=skip, limit=limit)
+            self.write(result)
+        else:
+            result = yield self.run_async('find', self.cached_result,
+                                          owner, cube, 'find', self.find,
+                                          query=query, fields=fields,
+                                          date=date, sort=sort, one=one,
+                                          merge_versions=merge_versions,
+                                          skip=skip, limit=limit)
+            self.write(result)
 
     def find(self, owner, cube, query, fields=None, date=None,
              sort=None, one=False, explain=False, merge_versions=True,
-             skip=0, limit=0):
+             skip=0, limit=0, cursor=False):
         '''
         Wrapper around pymongo's find() command.
 
@@ -228,6 +272,12 @@ class FindHdlr(MongoDBBackendHdlr):
         :param sort: return back results sorted
         :param skip: number of results matched to skip and not return
         :param limit: number of results matched to return of total found
+        :param cursor: return the pymongo cursor (or merged versions
+                       iterator), rather than a tuple
+
+        Exact date queries might be served from a cube snapshot; see
+        snapshot_sources. Sorted, explained and find one queries
+        only from a snapshot of the very same date.
         '''
         self.requires_read(owner, cube)
 
@@ -238,11 +288,9 @@ class FindHdlr(MongoDBBackendHdlr):
                                               fields['_id']):
             merge_versions = False
 
-        query = query or ''
-        query = query_add_date(query, date)
-        spec = parse_pql_query(query)
-
-        _cube = self.timeline(owner, cube)
+        sources = self.snapshot_sources(owner, cube, query, date,
+                                        delta=not (explain or one or sort))
+        _cube, spec = sources[0]
         if explain:
             result = _cube.find(spec, fields=fields, sort=sort,
                                 skip=skip, limit=limit).explain()
@@ -251,43 +299,256 @@ class FindHdlr(MongoDBBackendHdlr):
                                     skip=skip, limit=limit)
         elif merge_versions:
             # merge_versions ignores sort (for now)
-            result = self._merge_versions(_cube, spec, fields,
+            result = self._merge_versions(sources, fields,
                                           skip=skip, limit=limit)
+            if not cursor:
+                result = tuple(result)
+        elif len(sources) > 1:
+            # snapshot objects first, then the cube's
+            docs = chain(*[c.find(_spec, fields=fields)
+                           for c, _spec in sources])
+            stop = (skip or 0) + limit if limit else None
+            result = islice(docs, skip, stop)
+            if not cursor:
+                result = tuple(result)
         else:
-            result = tuple(_cube.find(spec, fields=fields, sort=sort,
-                                      skip=skip, limit=limit))
+            result = _cube.find(spec, fields=fields, sort=sort,
+                                skip=skip, limit=limit)
+            if not cursor:
+                result = tuple(result)
         return result
 
-    def _merge_versions(self, _cube, spec, fields, skip=0, limit=0):
+    def find_page(self, owner, cube, query, fields=None, date=None,
+                  merge_versions=True, page_size=1000, page_token=None):
+        '''
+        Return back a page of the objects matching the given query,
+        along with the (opaque) token to request the next page with;
+        or None, if this is the last page.
+
+        Pages are read in _id order (or _oid order, if versions are
+        merged) starting after the last object of the previous page,
+        so each page costs about the same to read; unlike skip.
+
+        Takes the same arguments as find(), except sort, one, explain,
+        skip and limit.
+
+        :param page_size: max number of objects per page; when merging
+                          versions, the last object's versions are all
+                          included in the same page, possibly exceeding
+                          page_size
+        :param page_token: page_token returned with the previous page
+        '''
+        if page_size <= 0:
+            self._raise(400, "page_size must be >= 1")
+        self.requires_read(owner, cube)
+        _fields = self.get_fields(owner, cube, fields)
+        if date is None or _fields is None or ('_id' in _fields and
+                                               _fields['_id']):
+            merge_versions = False
+        fingerprint = _query_fingerprint(owner, cube, query, fields, date,
+                                         merge_versions)
+        sources = self.snapshot_sources(owner, cube, query, date,
+                                        delta=False)
+        _cube, spec = sources[0]
+        key = '_oid' if merge_versions else '_id'
+        if page_token:
+            try:
+                last = _page_token_key(page_token, fingerprint)
+            except ValueError as e:
+                self._raise(400, str(e))
+            # keeps a top level date $or on top; see and_date_specs
+            spec = and_date_specs({key: {'$gt': last}}, [spec])
+
+        hide_id = False
+        if merge_versions:
+            sort = [('_oid', 1), ('_start', 1)]
+            docs = _cube.find(spec, fields=_fields, sort=sort)
+            objects = []
+            more = False
+            for doc in _merge_docs(docs):
+                if (len(objects) >= page_size and
+                        doc['_oid'] != objects[-1]['_oid']):
+                    more = True
+                    break
+                objects.append(doc)
+            docs.close()
+        else:
+            hide_id = _fields is not None and not _fields.get('_id')
+            if hide_id:
+                # _ids are needed for the page token
+                _fields = dict(_fields, _id=1)
+            # reading one more object tells if there's another page
+            objects = list(_cube.find(spec, fields=_fields,
+                                      sort=[('_id', 1)],
+                                      limit=page_size + 1))
+            more = len(objects) > page_size
+            objects = objects[:page_size]
+        token = None
+        if more:
+            try:
+                token = _page_token(fingerprint, objects[-1][key])
+            except ValueError as e:
+                self._raise(400, str(e))
+        if hide_id:
+            [o.pop('_id') for o in objects]
+        return {'objects': objects, 'page_token': token}
+
+    @gen.coroutine
+    def find_stream(self, owner, cube, query, fields=None, date=None,
+                    sort=None, merge_versions=True, skip=0, limit=0,
+                    batch_size=1000):
+        '''
+        Stream back the objects matching the given query in batches,
+        flushing each batch to the client as it's read from the
+        cursor, rather than building the whole result in memory.
+
+        Takes the same arguments as find(), except one and explain.
+
+        :param batch_size: number of objects to write per flush
+        '''
+        if batch_size <= 0:
+            self._raise(400, "batch_size must be >= 1")
+        result = yield self.run_async('find', self.find, owner=owner,
+                                      cube=cube, query=query,
+                                      fields=fields, date=date, sort=sort,
+                                      merge_versions=merge_versions,
+                                      skip=skip, limit=limit, cursor=True)
+        if not isinstance(result, Cursor):
+            result = iter(result)
+        else:
+            result.batch_size(batch_size)
+        k = 0
+        try:
+            while True:
+                # reading the next batch from the cursor blocks
+                batch = yield self.run_async('find', list,
+                                             islice(result, batch_size))
+                if not batch:
+                    break
+                k += len(batch)
+                self.write_stream(batch)
+                yield self.flush()
+        except Exception:
+            self.abort_stream()
+            raise
+        logger.debug('... %s objects streamed' % k)
+
+    def _merge_versions(self, sources, fields, skip=0, limit=0):
         '''
         merge versions with unchanging fields of interest
+
+        Versions are merged in a single pass over cursors sorted by
+        _oid, _start, one per (collection, spec) source; skip and
+        limit apply to the merged versions.
         '''
-        logger.debug("merging doc version...")
-        # contains a dummy document to avoid some condition
-        # checks in merge_doc
-        ret = [{'_oid': None}]
-        no_check = set(['_start', '_end'])
-
-        def merge_doc(doc):
-            '''
-            merges doc with the last document in ret if possible
-            '''
-            last = ret[-1]
-            ret.append(doc)
-            if doc['_oid'] == last['_oid'] and doc['_start'] == last['_end']:
-                if all(item in last.items() or item[0] in no_check
-                       for item in doc.iteritems()):
-                    # the fields of interest did not change, merge docs:
-                    last['_end'] = doc['_end']
-                    ret.pop()
-
-        sort = self.check_sort([('_oid', 1)])
-        docs = _cube.find(spec, fields=fields, sort=sort,
-                          skip=skip, limit=limit)
-        docs = sorted(docs, key=itemgetter('_oid', '_start', '_end'))
-        [merge_doc(doc) for doc in docs]
-        logger.debug('... done')
-        return ret[1:]
+        sort = [('_oid', 1), ('_start', 1)]
+        cursors = [_cube.find(spec, fields=fields, sort=sort)
+                   for _cube, spec in sources]
+        if len(cursors) > 1:
+            docs = _merge_sorted(cursors)
+        else:
+            docs = cursors[0]
+        merged = _merge_docs(docs)
+        stop = skip + limit if limit else None
+        return islice(merged, skip, stop)
+
+
+def _query_fingerprint(*args):
+    ' return back a short hash identifying the given query arguments '
+    return hashlib.sha1(json.dumps(args, sort_keys=True)).hexdigest()[:16]
+
+
+def _page_token(fingerprint, key):
+    '''
+    Return back an (opaque) page token, which continues the query
+    with the given fingerprint after the given key (_id or _oid).
+
+    Keys of bson types (eg, datetime _oids) are encoded in mongodb
+    extended json, so they're decoded back to the same type. Raises
+    ValueError for keys which can't be encoded.
+
+    :param fingerprint: query fingerprint
+    :param key: key value of the last object of the page
+    '''
+    try:
+        token = json.dumps([fingerprint, key], default=json_util.default)
+    except TypeError:
+        raise ValueError("%s can't be paged by" % type(key).__name__)
+    return base64.urlsafe_b64encode(token)
+
+
+def _page_token_key(token, fingerprint):
+    '''
+    Return back the key (_id or _oid) a page token continues after.
+    Raises ValueError if the token is invalid or if it belongs to
+    a different query.
+
+    :param token: page token
+    :param fingerprint: fingerprint of the current query
+    '''
+    try:
+        _fingerprint, key = json.loads(
+            base64.urlsafe_b64decode(str(token)),
+            object_hook=json_util.object_hook)
+    except (TypeError, ValueError):
+        raise ValueError("invalid page_token")
+    if _fingerprint != fingerprint:
+        raise ValueError("page_token is for a different query")
+    return key
+
+
+def _merge_docs(docs):
+    '''
+    Yield back docs, merging each doc into the one before it when
+    it's the next version of the same object and none of its fields,
+    other than _start and _end, changed.
+
+    :param docs: iterable of docs sorted by _oid, _start
+    '''
+    no_check = ('_start', '_end')
+    last = last_values = None
+    for doc in docs:
+        values = dict((k, v) for k, v in doc.iteritems()
+                      if k not in no_check)
+        if (last is not None and doc['_oid'] == last['_oid'] and
+                doc['_start'] == last['_end'] and values == last_values):
+            # the fields of interest did not change, merge docs
+            last['_end'] = doc['_end']
+            continue
+        if last is not None:
+            yield last
+        last, last_values = doc, values
+    if last is not None:
+        yield last
+
+
+def _merge_sorted(cursors):
+    '''
+    Yield back the docs of all the given cursors, sorted by
+    _oid, _start; each cursor being sorted by _oid, _start.
+
+    :param cursors: iterables of docs
+    '''
+    def keyed(docs):
+        for doc in docs:
+            yield (doc['_oid'], doc['_start']), doc
+    for key, doc in heapq.merge(*map(keyed, cursors)):
+        yield doc
+
+
+def _running_totals(diffs):
+    '''
+    Turn dict of key -> (value, list of count changes per date)
+    into dict of key -> (value, list of counts per date).
+    '''
+    counts = {}
+    for key, (value, diff) in diffs.iteritems():
+        total = 0
+        counts[key] = (value, [])
+        for change in diff[:-1]:
+            total += change
+            counts[key][1].append(total)
+    return counts
 
 
 class HistoryHdlr(MongoDBBackendHdlr):
@@ -296,13 +557,15 @@ class HistoryHdlr(MongoDBBackendHdlr):
     the given query
     '''
     @authenticated
+    @gen.coroutine
     def get(self, owner, cube):
         query = self.get_argument('query')
         by_field = self.get_argument('by_field')
         date_list = self.get_argument('date_list')
-        result = self.history(owner=owner, cube=cube,
-                              query=query, by_field=by_field,
-                              date_list=date_list)
+        result = yield self.run_async('history', self.cached_result,
+                                      owner, cube, 'history', self.history,
+                                      query=query, by_field=by_field,
+                                      date_list=date_list)
         self.write(result)
 
     def history(self, owner, cube, query, by_field=None, date_list=None):
@@ -312,6 +575,17 @@ class HistoryHdlr(MongoDBBackendHdlr):
 
         Query sytax parsing is handled by `pql`.
 
+        Matching versions are counted by mongodb per distinct by_field
+        value, _start and _end; which is compact, since versions are
+        extracted in batches sharing the same _start and _end. These
+        counts are then binned by date in a single pass.
+
+        Unfiltered (empty query) counts of cubes with rollups, by
+        a rolled up field, are read from the cube's daily rollups
+        instead; see _rollup_counts.
+
+        Values counted zero at every date are left out.
+
         :param cube: cube name
         :param owner: username of cube owner
         :param query: The query in pql
@@ -319,55 +593,116 @@ class HistoryHdlr(MongoDBBackendHdlr):
         :param date: list of dates that should be used to bin the results
         '''
         self.requires_read(owner, cube)
+        if not date_list:
+            self._raise(400, "date_list required")
+
+        by_field = by_field or None
+        date_list = sorted(set(map(dt2ts, date_list)))
+        rollup_fields, build = self.cube_rollups(owner, cube)
+        if rollup_fields and by_field in rollup_fields and \
+                not (query or '').strip():
+            counts = self._rollup_counts(owner, cube, by_field, date_list,
+                                         build)
+        else:
+            counts = self._version_counts(owner, cube, query, by_field,
+                                          date_list)
+        # drop the values counted zero at every date; eg, of versions
+        # which started and ended between two dates, or (rollups)
+        # ended before the first date
+        counts = dict((key, (value, _counts))
+                      for key, (value, _counts) in counts.iteritems()
+                      if any(_counts))
 
-        date_list = sorted(map(dt2ts, date_list))
-        query = '%s and _start < %s and (_end >= %s or _end == None)' % (
-                query, max(date_list), min(date_list))
-        spec = parse_pql_query(query)
-        _cube = self.timeline(owner, cube)
-
-        agg = [{'$match': spec},
-               {'$group':
-                {'_id': '$%s' % by_field if by_field else 'id',
-                 'starts': {'$push': '$_start'},
-                 'ends': {'$push': '$_end'}}
-                }]
-        logger.debug('Aggregation: %s' % agg)
-        data = _cube.aggregate(agg)['result']
-
-        # accumulate the counts
-        res = defaultdict(lambda: defaultdict(int))
-        for group in data:
-            starts = sorted(group['starts'])
-            ends = sorted([x for x in group['ends'] if x is not None])
-            _id = group['_id']
-            ind = 0
-            # assuming date_list is sorted
-            for date in date_list:
-                while ind < len(starts) and starts[ind] < date:
-                    ind += 1
-                res[date][_id] = ind
-            ind = 0
-            for date in date_list:
-                while ind < len(ends) and ends[ind] < date:
-                    ind += 1
-                res[date][_id] -= ind
-
-        # convert to the return form
         ret = []
-        for date, value in res.items():
+        if not counts:
+            return ret
+        for k, date in enumerate(date_list):
             if by_field:
-                vals = []
-                for field_val, count in value.items():
-                    vals.append({by_field: field_val,
-                                 "count": count})
-                ret.append({"date": date,
-                            "values": vals})
+                vals = [{by_field: value, 'count': _counts[k]}
+                        for value, _counts in counts.itervalues()]
+                ret.append({'date': date, 'values': vals})
             else:
-                ret.append({"date": date,
-                            "count": value['id']})
+                ret.append({'date': date,
+                            'count': counts[rollup_key(None)][1][k]})
         return ret
 
+    def _group_versions(self, owner, cube, spec, by_field=None):
+        '''
+        Yield back (by_field value, _start, _end, count) of the
+        versions matching spec, counted by mongodb.
+        '''
+        _id = {'start': '$_start', 'end': '$_end'}
+        if by_field:
+            _id['value'] = '$%s' % by_field
+        agg = [{'$match': spec},
+               {'$group': {'_id': _id, 'count': {'$sum': 1}}}]
+        logger.debug('Aggregation: %s' % agg)
+        _cube = self.timeline(owner, cube)
+        for row in self.aggregate_rows(_cube, agg):
+            _id = row['_id']
+            yield _id.get('value'), _id['start'], _id.get('end'), row['count']
+
+    def _version_counts(self, owner, cube, query, by_field, date_list):
+        '''
+        Return back dict of by_field value key -> (value, list of
+        counts per date) of the versions matching the query.
+        '''
+        spec = and_date_specs(parse_pql_query(query),
+                              [{'_start': {'$lt': date_list[-1]}},
+                               {'$or': [{'_end': {'$gte': date_list[0]}},
+                                        {'_end': None}]}])
+        # a version is counted at the dates after its _start, up to
+        # and including its _end; diffs[key][k] is the change in the
+        # count from date_list[k - 1] to date_list[k]
+        diffs = {}
+        n = len(date_list) + 1
+        rows = self._group_versions(owner, cube, spec, by_field)
+        for value, start, end, count in rows:
+            diff = diffs.setdefault(rollup_key(value), (value, [0] * n))[1]
+            diff[bisect_right(date_list, start)] += count
+            if end is not None:
+                diff[bisect_right(date_list, end)] -= count
+        return _running_totals(diffs)
+
+    def _rollup_counts(self, owner, cube, by_field, date_list, build):
+        '''
+        Return back dict of by_field value key -> (value, list of
+        counts per date) of all the cube's versions, summing up the
+        cube's daily rollups.
+
+        Rollups count the versions up to the start of each date's
+        day; versions which started or ended later that day, before
+        the date, are counted from the cube itself. So only a day's
+        worth of versions, at most, are read per date.
+        '''
+        days = [rollup_day(date) for date in date_list]
+        spec = {'cube': self.cjoin(owner, cube), 'build': build,
+                'field': by_field, 'day': {'$lt': days[-1]}}
+        fields = {'_id': 0, 'key': 1, 'value': 1, 'day': 1, 'delta': 1}
+        diffs = {}
+        n = len(date_list) + 1
+        for doc in self.rollups().find(spec, fields=fields):
+            diff = diffs.setdefault(doc['key'], (doc['value'], [0] * n))[1]
+            diff[bisect_right(days, doc['day'])] += doc['delta']
+        counts = _running_totals(diffs)
+
+        tail = [(k, day, date) for k, (day, date)
+                in enumerate(zip(days, date_list)) if date > day]
+        if tail:
+            spec = {'$or': [{key: {'$gte': day, '$lt': date}}
+                            for k, day, date in tail
+                            for key in ('_start', '_end')]}
+            rows = self._group_versions(owner, cube, spec, by_field)
+            for value, start, end, count in rows:
+                key = rollup_key(value)
+                _counts = counts.setdefault(key, (value, [0] * (n - 1)))[1]
+                for k, day, date in tail:
+                    if day <= start < date:
+                        _counts[k] += count
+                    if end is not None and day <= end < date:
+                        _counts[k] -= count
+        return counts
+
 
 class SampleHdlr(MongoDBBackendHdlr):
     '''
@@ -375,15 +710,17 @@ class SampleHdlr(MongoDBBackendHdlr):
     given cube.field
     '''
     @authenticated
+    @gen.coroutine
     def get(self, owner, cube):
         sample_size = self.get_argument('sample_size')
         fields = self.get_argument('fields')
         date = self.get_argument('date')
         query = self.get_argument('query')
-        result = self.sample(owner=owner, cube=cube,
-                             sample_size=sample_size,
-                             fields=fields, date=date,
-                             query=query)
+        result = yield self.run_async('sample', self.sample,
+                                      owner=owner, cube=cube,
+                                      sample_size=sample_size,
+                                      fields=fields, date=date,
+                                      query=query)
         self.write(result)
 
     def sample(self, owner, cube, sample_size=None, fields=None,
@@ -403,15 +740,9 @@ class SampleHdlr(MongoDBBackendHdlr):
         :param query: query used to filter sampleset
         '''
         self.requires_read(owner, cube)
+        if sample_size is None:
+            sample_size = SAMPLE_SIZE
         fields = self.get_fields(owner, cube, fields)
-        query = query_add_date(query, date)
-        spec = parse_pql_query(query)
+        spec = parse_pql_query(query, date)
         _cube = self.timeline(owner, cube)
-        _docs = _cube.find(spec, fields=fields)
-        n = _docs.count()
-        if n <= sample_size:
-            docs = tuple(_docs)
-        else:
-            to_sample = sorted(set(random.sample(xrange(n), sample_size)))
-            docs = [_docs[i] for i in to_sample]
-        return docs
+        return self.sample_docs(_cube, spec, sample_size, fields)
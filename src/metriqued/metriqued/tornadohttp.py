@@ -12,6 +12,7 @@ and url handler definitions, start-up checks, etc.
 '''
 
 import logging
+from logging.handlers import BufferingHandler
 import os
 from tornado.web import StaticFileHandler
 import simplejson as json
@@ -48,9 +49,17 @@ def ucv2(value):
     return a2
 
 
-class MongoDBHandler(logging.StreamHandler):
-    def __init__(self, collection):
-        super(MongoDBHandler, self).__init__()
+class MongoDBHandler(BufferingHandler):
+    '''
+    Logging handler which buffers log records and inserts them
+    into mongodb in batches, once `capacity` records are buffered
+    or the handler is flushed.
+
+    :param collection: mongodb collection to insert records into
+    :param capacity: max number of records buffered
+    '''
+    def __init__(self, collection, capacity=100):
+        BufferingHandler.__init__(self, capacity)
         self.collection = collection
 
     def emit(self, record):
@@ -72,12 +81,30 @@ class MongoDBHandler(logging.StreamHandler):
             'process': r.process,
             'thread': r.thread,
         }
-        self.collection.insert(obj)
+        self.buffer.append(obj)
+        if self.shouldFlush(record):
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                self.collection.insert(self.buffer)
+                self.buffer = []
+        except Exception as e:
+            # don't let a mongodb outage take the process down with it
+            logger.error('failed to insert logs into mongodb: %s' % e)
+            self.buffer = []
+        finally:
+            self.release()
 
 
 class MetriqueHTTP(TornadoHTTPServer):
     ''' HTTP (Tornado >=3.0) implemntation of MetriqueServer '''
     name = 'metriqued'
+    # request bodies are decompressed by the handlers, once the
+    # request is authenticated; see MongoDBBackendHdlr.prepare
+    server_decompress = False
 
     def __init__(self, config_file=None, **kwargs):
         config_file = config_file or METRIQUED_JSON
@@ -139,10 +166,15 @@ class MetriqueHTTP(TornadoHTTPServer):
             (ucv2(r"sample"), query_api.SampleHdlr, init),
 
             (ucv2(r"index"), cube_api.IndexHdlr, init),
+            (ucv2(r"index_advice"), cube_api.IndexAdviceHdlr, init),
             (ucv2(r"save"), cube_api.SaveObjectsHdlr, init),
+            (ucv2(r"save_stream"), cube_api.SaveStreamHdlr, init),
+            (ucv2(r"snapshot"), cube_api.SnapshotHdlr, init),
             (ucv2(r"rename"), cube_api.RenameHdlr, init),
             (ucv2(r"remove"), cube_api.RemoveObjectsHdlr, init),
+            (ucv2(r"rollup"), cube_api.RollupHdlr, init),
             (ucv2(r"export"), cube_api.ExportHdlr, init),
+            (ucv2(r"export_splits"), cube_api.ExportSplitsHdlr, init),
             (ucv2(r"update_role"), cube_api.UpdateRoleHdlr, init),
             (ucv2(r"drop"), cube_api.DropHdlr, init),
             (ucv2(r"stats"), cube_api.StatsHdlr, init),
@@ -173,5 +205,6 @@ class MetriqueHTTP(TornadoHTTPServer):
             logger = logging.getLogger(self.config.log_requests_name)
             # FIXME: make handler-reset optional?
             logger.handlers = []  # remove existing (file) handler
-            hdlr = MongoDBHandler(collection=self.dbconf.c_logs_admin)
+            hdlr = MongoDBHandler(collection=self.dbconf.c_logs_admin,
+                                  capacity=self.config.log_batch_size)
             logger.addHandler(hdlr)
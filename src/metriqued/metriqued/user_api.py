@@ -150,7 +150,9 @@ class RegisterHdlr(MongoDBBackendHdlr):
                'cube_quota': cube_quota,
                '_passhash': passhash,
                }
-        self.user_profile(admin=True).save(doc, safe=True)
+        _cube = self.user_profile(admin=True)
+        _cube.save(doc, safe=True)
+        self.invalidate_profile(_cube, username)
         logger.info("new user added (%s)" % (username))
         return True
 
@@ -179,7 +181,9 @@ class RemoveHdlr(MongoDBBackendHdlr):
         self.user_exists(username, raise_if_not=True)
         # delete the user's profile
         spec = {'_id': username}
-        self.user_profile(admin=True).remove(spec)
+        _cube = self.user_profile(admin=True)
+        _cube.remove(spec)
+        self.invalidate_profile(_cube, username)
 
         # remove the user's cubes
         spec = {'owner': username}
@@ -10,10 +10,17 @@ This module contains various shared utils used by metriqued and friends.
 '''
 
 from bson.timestamp import Timestamp
+from collections import OrderedDict, deque
+from copy import deepcopy
 import logging
 import pql
+from Queue import Queue, Empty, Full
 import re
 import simplejson as json
+from threading import Lock, Thread
+from time import time
+from tornado.concurrent import Future
+import zlib
 
 from metriqueu.utils import dt2ts
 
@@ -23,6 +30,288 @@ json_encoder = json.JSONEncoder()
 
 OBJECTS_MAX_BYTES = 16777216
 EXISTS_SPEC = {'$exists': 1}
+PQL_CACHE_SIZE = 1000
+# seconds per (UTC) day; the granularity of cube rollups
+ROLLUP_DAY = 86400
+
+
+class LRUCache(object):
+    '''
+    Least recently used cache, which keeps count of
+    cache hits and misses.
+
+    :param maxsize: max number of items cached
+    :param ttl: seconds until cached items expire; None for never
+    '''
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._cache = OrderedDict()
+        self._expires = {}
+        # caches are shared by the handlers' executor threads
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key, default=None):
+        '''
+        Return back the cached value for key, marking it as
+        the most recently used, or default if it's not cached.
+
+        :param key: cache key
+        :param default: value to return on cache miss
+        '''
+        with self._lock:
+            try:
+                value = self._cache.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl and self._expires[key] < time():
+                del self._expires[key]
+                self.misses += 1
+                return default
+            self._cache[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        '''
+        Cache the value for key, evicting the least recently
+        used item if the cache is full.
+
+        :param key: cache key
+        :param value: value to cache
+        '''
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = value
+            if self.ttl:
+                self._expires[key] = time() + self.ttl
+            while len(self._cache) > self.maxsize:
+                old_key, _ = self._cache.popitem(last=False)
+                self._expires.pop(old_key, None)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self._expires.pop(key, None)
+            return self._cache.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._expires.clear()
+
+    def stats(self):
+        ' return back the cache size, hit and miss counts '
+        return {'size': len(self._cache), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+
+PQL_CACHE = LRUCache(PQL_CACHE_SIZE)
+
+
+class ConcurrencyLimiter(object):
+    '''
+    Limit the number of tasks running concurrently on the IOLoop;
+    tasks over the limit wait, in order, for running tasks to finish.
+
+    Not thread-safe; acquire() and release() are expected to be
+    called from the IOLoop thread only.
+
+    :param limit: max number of tasks running concurrently
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.completed = 0
+        self.max_queued = 0
+        self._waiters = deque()
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def acquire(self):
+        '''
+        Return back a Future, resolved once the task can run.
+        '''
+        future = Future()
+        if self.running < self.limit:
+            self.running += 1
+            future.set_result(None)
+        else:
+            self._waiters.append(future)
+            self.max_queued = max(self.max_queued, len(self._waiters))
+        return future
+
+    def release(self):
+        '''
+        Mark a task as finished, letting the next waiting task run.
+        '''
+        self.completed += 1
+        if self._waiters:
+            # the slot passes straight on to the next task
+            self._waiters.popleft().set_result(None)
+        else:
+            self.running -= 1
+
+    def stats(self):
+        ' return back the running, queued and completed task counts '
+        return {'limit': self.limit, 'running': self.running,
+                'queued': self.queued, 'max_queued': self.max_queued,
+                'completed': self.completed}
+
+
+class LogPipeline(object):
+    '''
+    Pass objects on to a handler function in batches, from a single
+    background thread, so slow log sinks (eg, files, mongodb) don't
+    hold up the caller.
+
+    The queue is bounded; when it's full, put() waits up to `timeout`
+    seconds for room before the object is dropped (and counted).
+
+    :param handler: function called with each list of queued objects
+    :param maxsize: max number of objects queued
+    :param batch_size: max number of objects passed per handler call
+    :param timeout: seconds put() blocks for when the queue is full;
+        0 drops objects immediately
+    '''
+    def __init__(self, handler, maxsize=10000, batch_size=100, timeout=0):
+        self.handler = handler
+        self.maxsize = maxsize
+        self.batch_size = max(batch_size, 1)
+        self.timeout = timeout
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self._queue = Queue(maxsize)
+        self._lock = Lock()
+        self._thread = None
+
+    def _start(self):
+        # (re)started lazily; threads don't survive a fork
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run,
+                                      name='metriqued-log-pipeline')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def put(self, obj):
+        '''
+        Queue an object to be handled. Returns back False if
+        the object was dropped.
+
+        :param obj: object to queue
+        '''
+        self._start()
+        try:
+            if self.timeout > 0:
+                self._queue.put(obj, True, self.timeout)
+            else:
+                self._queue.put_nowait(obj)
+        except Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def join(self):
+        '''
+        Block until all the queued objects have been handled.
+        '''
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            try:
+                self.handler(batch)
+                self.handled += len(batch)
+            except Exception as e:
+                self.errors += len(batch)
+                logger.error('log pipeline handler failed: %s' % e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def stats(self):
+        ' return back the queued, handled, dropped and error counts '
+        return {'queued': self._queue.qsize(), 'maxsize': self.maxsize,
+                'handled': self.handled, 'dropped': self.dropped,
+                'errors': self.errors}
+
+
+class GzipDecoder(object):
+    '''
+    Incremental gzip decompressor of request bodies, which never
+    decompresses more than max_bytes in total; ValueError is raised
+    instead. zlib.error is raised on invalid gzip content.
+
+    :param max_bytes: max decompressed size; 0 for no limit
+    '''
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        '''
+        Return back the given chunk of gzip content, decompressed.
+
+        :param data: gzip compressed chunk
+        '''
+        if self.max_bytes > 0:
+            # stop one byte past the limit; the rest isn't decompressed
+            limit = self.max_bytes - self.size + 1
+            data = self._decompressor.decompress(data, limit)
+        else:
+            data = self._decompressor.decompress(data)
+        return self._count(data)
+
+    def flush(self):
+        '''
+        Return back what's left of the decompressed content.
+        '''
+        return self._count(self._decompressor.flush())
+
+    def _count(self, data):
+        self.size += len(data)
+        if self.max_bytes > 0 and self.size > self.max_bytes:
+            raise ValueError("decompressed body exceeds %s bytes" % (
+                self.max_bytes))
+        return data
+
+
+def _date_bounds(date):
+    '''
+    Split a metrique date (range) into its (before, after) date
+    strings; either of which might be None (unbounded).
+    '''
+    split = date.split('~')
+    # replace all occurances of 'T' with ' '
+    # this is used for when datetime is passed in
+    # like YYYY-MM-DDTHH:MM:SS instead of
+    #      YYYY-MM-DD HH:MM:SS as expected
+    # and drop all occurances of 'timezone' like substring
+    split = [re.sub('\+\d\d:\d\d', '', d.replace('T', ' ')) for d in split]
+    if len(split) == 1:
+        # 'dt'
+        return split[0], split[0]
+    else:
+        # '~dt', 'dt~', 'dt~dt'
+        return split[1] or None, split[0] or None
 
 
 def date_pql_string(date):
@@ -62,27 +351,122 @@ def date_pql_string(date):
     if date == '~':
         return ''
 
-    before = lambda d: '_start <= %f' % dt2ts(d)
-    after = lambda d: '(_end >= %f or _end == None)' % dt2ts(d)
-    split = date.split('~')
-    # replace all occurances of 'T' with ' '
-    # this is used for when datetime is passed in
-    # like YYYY-MM-DDTHH:MM:SS instead of
-    #      YYYY-MM-DD HH:MM:SS as expected
-    # and drop all occurances of 'timezone' like substring
-    split = [re.sub('\+\d\d:\d\d', '', d.replace('T', ' ')) for d in split]
-    if len(split) == 1:
-        # 'dt'
-        return '%s and %s' % (before(split[0]), after(split[0]))
-    elif split[0] == '':
-        # '~dt'
-        return before(split[1])
-    elif split[1] == '':
-        # 'dt~'
-        return after(split[0])
+    before, after = _date_bounds(date)
+    parts = []
+    if before:
+        parts.append('_start <= %f' % dt2ts(before))
+    if after:
+        parts.append('(_end >= %f or _end == None)' % dt2ts(after))
+    return ' and '.join(parts)
+
+
+def date_spec(date):
+    '''
+    Generate the list of pymongo spec components equivalent to
+    date_pql_string(date); without parsing any pql.
+
+    :param date: metrique date (range) to build the spec for
+    '''
+    if date is None:
+        return [{'_end': None}]
+    if date == '~':
+        return []
+
+    before, after = _date_bounds(date)
+    parts = []
+    if before:
+        parts.append({'_start': {'$lte': round(dt2ts(before), 6)}})
+    if after:
+        parts.append({'$or': [{'_end': {'$gte': round(dt2ts(after), 6)}},
+                              {'_end': None}]})
+    return parts
+
+
+def and_specs(*specs):
+    '''
+    Combine pymongo specs into a single spec matching all of them,
+    flattening nested $and specs the way pql does.
+
+    :param specs: pymongo spec dictionaries
+    '''
+    parts = []
+    for spec in specs:
+        if not spec:
+            continue
+        elif spec.keys() == ['$and']:
+            parts.extend(spec['$and'])
+        else:
+            parts.append(spec)
+    if not parts:
+        return {}
+    elif len(parts) == 1:
+        return parts[0]
+    else:
+        return {'$and': parts}
+
+
+def and_date_specs(spec, parts):
+    '''
+    Combine a pymongo spec with date spec components (see date_spec)
+    into a single spec matching all of them.
+
+    The (_end >= date or _end == None) component is hoisted to the
+    top of the spec, as an $or of the rest of the spec and-ed with
+    each of its clauses. So each clause range scans the cubes'
+    (_end, _start) index, rather than all the versions started by
+    the date; mongodb plans an index per clause for top level $or's.
+
+    :param spec: pymongo spec dictionary
+    :param parts: list of date spec components
+    '''
+    rest, clauses = [], None
+    for part in parts:
+        if clauses is None and part.keys() == ['$or']:
+            clauses = part['$or']
+        else:
+            rest.append(part)
+    spec = and_specs(spec, *rest)
+    if clauses is None:
+        return spec
+    return {'$or': [and_specs(spec, clause) for clause in clauses]}
+
+
+def explain_summary(explain):
+    '''
+    Summarize a pymongo cursor explain() result, of any mongodb
+    version: the indexes used, whether any collection scan was
+    planned, and the number of objects matched and scanned.
+
+    :param explain: explain() result
+    '''
+    indexes, collscan = [], False
+    if 'queryPlanner' in explain:
+        # mongodb >= 3.0
+        plans = [explain['queryPlanner'].get('winningPlan', {})]
+        while plans:
+            plan = plans.pop()
+            if plan.get('stage') == 'COLLSCAN':
+                collscan = True
+            elif plan.get('stage') == 'IXSCAN':
+                indexes.append(plan.get('indexName'))
+            plans.extend(plan.get('inputStages', []))
+            if 'inputStage' in plan:
+                plans.append(plan['inputStage'])
+        stats = explain.get('executionStats', {})
+        n = stats.get('nReturned')
+        scanned = stats.get('totalDocsExamined')
     else:
-        # 'dt~dt'
-        return '%s and %s' % (before(split[1]), after(split[0]))
+        # top level $or's are explained per clause
+        for clause in explain.get('clauses') or [explain]:
+            cursor = clause.get('cursor', '')
+            if cursor.startswith('BtreeCursor'):
+                indexes.append(cursor.split(' ')[1])
+            elif cursor == 'BasicCursor':
+                collscan = True
+        n = explain.get('n')
+        scanned = explain.get('nscannedObjects')
+    return {'indexes': sorted(set(indexes)), 'collscan': collscan,
+            'n': n, 'scanned': scanned}
 
 
 def query_add_date(query, date):
@@ -99,28 +483,116 @@ def query_add_date(query, date):
     return query or date_pql
 
 
-def parse_pql_query(query):
+def parse_pql_query(query, date='~'):
     '''
     Given a pql based query string, parse it using
     pql.SchemaFreeParser and return the resulting
     pymongo 'spec' dictionary.
 
+    Parsed queries are cached (see PQL_CACHE), keyed by the query
+    text alone; the date (range) limiter is bound to the cached spec
+    afterwards, so the same query parsed for different dates only
+    gets parsed once.
+
     :param query: pql query
+    :param date: metrique date (range) to limit the query to;
+                 defaults to all dates ('~'). None will limit the
+                 query to current values only.
     '''
-    logger.debug('pql query: %s' % query)
-    if not query:
-        return {}
-    if not isinstance(query, basestring):
+    logger.debug('pql query: %s (date: %s)' % (query, date))
+    if query and not isinstance(query, basestring):
         raise TypeError("query expected as a string")
-    pql_parser = pql.SchemaFreeParser()
-    try:
-        spec = pql_parser.parse(query)
-    except Exception as e:
-        raise SyntaxError("Invalid Query (%s)" % str(e))
+    query = (query or '').strip()
+    if query:
+        spec = PQL_CACHE.get(query)
+        if spec is None:
+            pql_parser = pql.SchemaFreeParser()
+            try:
+                spec = pql_parser.parse(query)
+            except Exception as e:
+                raise SyntaxError("Invalid Query (%s)" % str(e))
+            PQL_CACHE.set(query, spec)
+        # callers are free to modify the spec they get back
+        spec = deepcopy(spec)
+    else:
+        spec = {}
+    spec = and_date_specs(spec, date_spec(date))
     logger.debug('mongo spec: %s' % spec)
     return spec
 
 
+def current_at(version, ts):
+    '''
+    Return back whether the version is current (valid) at the given
+    epoch; as matched by date_spec(date) of the same date.
+
+    :param version: version (object) dict, with _start and _end
+    :param ts: epoch timestamp
+    '''
+    _end = version.get('_end')
+    return version['_start'] <= ts and (_end is None or _end >= ts)
+
+
+def rollup_day(ts):
+    '''
+    Return back the start of the (UTC) day the given epoch is on.
+
+    :param ts: epoch timestamp
+    '''
+    return ts - ts % ROLLUP_DAY
+
+
+def rollup_key(value):
+    '''
+    Return back the key rollups of the given field value are
+    stored under; field values aren't necessarily hashable.
+
+    :param value: field value
+    '''
+    return json.dumps(value, sort_keys=True, default=json_encode)
+
+
+def rollup_version(deltas, fields, version, count=1):
+    '''
+    Add the daily rollup deltas of a version: a version is counted
+    from the day of its _start up to the day of its _end, so it adds
+    `count` on the former and removes it on the latter; per value of
+    each rolled up field.
+
+    :param deltas: dict of (field, value key, day) -> [value, delta]
+    :param fields: list of rolled up fields; None rolls up the total
+    :param version: version (object) dict, with _start and _end
+    :param count: number of such versions; negative to remove them
+    '''
+    days = [(rollup_day(version['_start']), count)]
+    if version.get('_end') is not None:
+        days.append((rollup_day(version['_end']), -count))
+    for field in fields:
+        value = version.get(field) if field else None
+        key = rollup_key(value)
+        for day, change in days:
+            delta = deltas.setdefault((field, key, day), [value, 0])
+            delta[1] += change
+    return deltas
+
+
+def result_size(result):
+    '''
+    Return back the number of objects in a read result; the items
+    of a list result, or of the lists in a dict result (eg, the
+    'result' of an aggregation). Other results count as one.
+
+    :param result: read result
+    '''
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    elif isinstance(result, dict):
+        return sum(len(v) for v in result.itervalues()
+                   if isinstance(v, (list, tuple))) or 1
+    else:
+        return 1
+
+
 def json_encode(obj):
     '''
     Convert pymongo.timestamp.Timestamp to epoch
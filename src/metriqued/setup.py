@@ -18,14 +18,14 @@ __requires__ = [
     'metriqueu (>=%s)' % __version__,
     'gnupg (==1.2.5)',
     'passlib (==1.6.2)',
-    'pymongo (==2.6.3)',
+    'pymongo (==2.7.2)',
 ]
 __irequires__ = [
     'metriquet>=%s' % __version__,
     'metriqueu>=%s' % __version__,
     'gnupg==1.2.5',
     'passlib==1.6.2',
-    'pymongo==2.6.3',
+    'pymongo==2.7.2',
 ]
 pip_src = 'https://pypi.python.org/packages/source'
 __deplinks__ = []
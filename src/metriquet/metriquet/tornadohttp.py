@@ -12,14 +12,19 @@ Supports log handling, server startup / shutdown and
 configuration loading.
 '''
 
+import errno
 import logging
 from functools import partial
+import multiprocessing
 import os
+import random
 import signal
 import sys
 import time
 from tornado.httpserver import HTTPServer
+from tornado.httputil import HTTPMessageDelegate
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
 from tornado.web import Application
 
 from metriqueu.jsonconf import JSONConf
@@ -42,6 +47,8 @@ TEMP_DIR = os.path.join(USER_DIR, 'tmp')
 STATIC_DIR = os.path.join(USER_DIR, 'static/')
 API_DOCS_PATH = os.path.join(STATIC_DIR, 'api_docs/')
 TEMPLATE_PATH = os.path.join(USER_DIR, 'templates/')
+# seconds between checks for requests in flight, while draining
+DRAIN_POLL_INTERVAL = 0.1
 
 
 class TornadoConfig(JSONConf):
@@ -66,6 +73,14 @@ class TornadoConfig(JSONConf):
     :param configdir: path to directory where config files are stored
     :param cookie_secret: random key for signing secure cookies
     :param debug: verbosity level
+    :param decompress_request:
+        transparently decompress gzip (Content-Encoding) request bodies?
+        Bodies are decompressed before any handler runs and their
+        decompressed size isn't limited (max_body_size only limits
+        the compressed size); only enable it for trusted clients
+    :param drain_timeout:
+        max seconds a stopping worker waits for its requests in flight
+        to finish
     :param gzip: enable gzip compression of requests?
     :param host: host address to listen on
     :param logdir: path to directory where logs are saved
@@ -89,6 +104,16 @@ class TornadoConfig(JSONConf):
     :param temp_path: path to directory where temporary files are saved
     :param template_path: path to directory where template files are found
     :param userdir: path to directory where user files are stored
+    :param workers:
+        number of pre-forked worker processes sharing the listening
+        socket; 0 starts one per cpu
+    :param worker_max_restarts:
+        max restarts of a worker within worker_restart_window seconds;
+        once exceeded, all workers are stopped. 0 for no limit
+    :param worker_restart_delay:
+        seconds to wait before restarting a worker which died
+    :param worker_restart_window:
+        seconds over which worker restarts are counted
     :param xsrf_cookies: enable xsrf_cookie form validation?
 
     :ivar name: name of the tornado instance
@@ -108,6 +133,8 @@ class TornadoConfig(JSONConf):
             'configdir':  ETC_DIR,
             'cookie_secret': SECRET,
             'debug': True,
+            'decompress_request': False,
+            'drain_timeout': 30,
             'gzip': True,
             'host': '127.0.0.1',
             'logdir': LOG_DIR,
@@ -131,6 +158,10 @@ class TornadoConfig(JSONConf):
             'temp_path': TEMP_DIR,
             'template_path': TEMPLATE_PATH,
             'userdir': USER_DIR,
+            'workers': 1,
+            'worker_max_restarts': 5,
+            'worker_restart_delay': 1,
+            'worker_restart_window': 60,
             'xsrf_cookies': False,
         }
         # apply defaults
@@ -141,6 +172,63 @@ class TornadoConfig(JSONConf):
         self.config.update(kwargs)
 
 
+class _CountingDelegate(HTTPMessageDelegate):
+    '''
+    Request delegate counting its request as in flight, from its
+    headers being received until its response is finished or its
+    connection is closed.
+    '''
+    def __init__(self, server, delegate, connection):
+        self.server = server
+        self.delegate = delegate
+        self.connection = connection
+        self._counted = False
+
+    def headers_received(self, start_line, headers):
+        self.server.requests += 1
+        self._counted = True
+        finish = self.connection.finish
+
+        def _finish():
+            try:
+                return finish()
+            finally:
+                self._done()
+        self.connection.finish = _finish
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        return self.delegate.finish()
+
+    def on_connection_close(self):
+        try:
+            return self.delegate.on_connection_close()
+        finally:
+            self._done()
+
+    def _done(self):
+        if self._counted:
+            self._counted = False
+            self.server.requests -= 1
+
+
+class DrainingHTTPServer(HTTPServer):
+    '''
+    HTTPServer keeping count of its requests in flight, so it
+    can be stopped once they're finished.
+    '''
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.requests = 0
+
+    def start_request(self, server_conn, request_conn):
+        delegate = HTTPServer.start_request(self, server_conn, request_conn)
+        return _CountingDelegate(self, delegate, request_conn)
+
+
 class TornadoHTTPServer(object):
     ''' HTTP (Tornado >=3.0) implemntation of MetriqueServer '''
     conf = TornadoConfig()
@@ -148,6 +236,9 @@ class TornadoHTTPServer(object):
     child_pid = None
     handlers = []
     name = BASENAME
+    # False if the handlers decompress request bodies themselves,
+    # instead of the HTTPServer (config.decompress_request)
+    server_decompress = True
 
     def __init__(self, config_file=None, **kwargs):
         self.config = TornadoConfig(config_file=config_file, **kwargs)
@@ -224,7 +315,10 @@ class TornadoHTTPServer(object):
     @property
     def pid_file(self):
         '''Return back the name of the current instance's pid file on disk'''
-        pid_file = '%s.%s.pid' % (self.config.pid_name, str(self.pid))
+        return self._pid_file(self.pid)
+
+    def _pid_file(self, pid):
+        pid_file = '%s.%s.pid' % (self.config.pid_name, str(pid))
         path = os.path.join(self.config.piddir, pid_file)
         return os.path.expanduser(path)
 
@@ -253,9 +347,13 @@ class TornadoHTTPServer(object):
             ssl_options = dict(
                 certfile=os.path.expanduser(self.config.ssl_certificate),
                 keyfile=os.path.expanduser(self.config.ssl_certificate_key))
-            self.server = HTTPServer(self._web_app, ssl_options=ssl_options)
         else:
-            self.server = HTTPServer(self._web_app)
+            ssl_options = None
+        decompress = (self.server_decompress and
+                      self.config.decompress_request)
+        self.server = DrainingHTTPServer(self._web_app,
+                                         ssl_options=ssl_options,
+                                         decompress_request=decompress)
 
     def set_pid(self):
         '''Store the current instances pid number into a pid file on disk'''
@@ -313,16 +411,168 @@ class TornadoHTTPServer(object):
         uri += ':%s' % port
         return uri
 
+    @property
+    def worker_count(self):
+        '''Return back the number of worker processes to pre-fork'''
+        workers = self.config.workers
+        if workers is None or workers <= 0:
+            workers = multiprocessing.cpu_count()
+        return workers
+
+    def spawn_workers(self, workers):
+        '''
+        Bind the listening socket, then pre-fork the given number of
+        worker processes to share it. This (supervisor) process
+        restarts workers which die, until it's sent SIGTERM or SIGINT;
+        which is passed on to the workers to drain and stop.
+
+        Workers dying more than worker_max_restarts times within
+        worker_restart_window seconds (eg, failing on startup) are
+        not restarted again; all the workers are stopped and
+        RuntimeError is raised.
+
+        :param workers: number of worker processes to fork
+        '''
+        logger.debug("spawning %s tornado workers %s..." % (workers,
+                                                            self.uri))
+        host, port = self.config.host, self.config.port
+        self._sockets = bind_sockets(port, address=host)
+        self.set_pid()
+        signal.signal(signal.SIGTERM, self._supervisor_stop_handler)
+        signal.signal(signal.SIGINT, self._supervisor_stop_handler)
+        self._stopping = False
+        self._workers = {}
+        restarts = {}
+        failed = None
+        for worker_id in range(workers):
+            self._spawn_worker(worker_id)
+        while self._workers:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue  # interupted by a signal
+                elif e.errno == errno.ECHILD:
+                    break
+                raise
+            worker_id = self._workers.pop(pid, None)
+            if worker_id is None:
+                continue
+            # killed workers can't clean up after themselves
+            pid_file = self._pid_file(pid)
+            if os.path.exists(pid_file):
+                os.remove(pid_file)
+            if self._stopping or status == 0:
+                logger.debug("worker %s (%s) stopped" % (worker_id, pid))
+                continue
+            now = time.time()
+            window = self.config.worker_restart_window
+            max_restarts = self.config.worker_max_restarts
+            recent = [t for t in restarts.get(worker_id, [])
+                      if now - t < window]
+            if max_restarts and len(recent) >= max_restarts:
+                failed = "worker %s died %s times within %ss" % (
+                    worker_id, len(recent) + 1, window)
+                logger.error("%s; stopping all workers" % failed)
+                self._stop_workers()
+                continue
+            logger.error("worker %s (%s) died (%s); restarting" % (
+                worker_id, pid, status))
+            restarts[worker_id] = recent + [now]
+            time.sleep(self.config.worker_restart_delay)
+            self._spawn_worker(worker_id)
+            if self._stopping:
+                # stopped while restarting; stop the new worker too
+                self._stop_workers()
+        self.remove_pid(quiet=True)
+        if failed:
+            raise RuntimeError(failed)
+
+    def _spawn_worker(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            # don't run the supervisor's handlers if stopped right away
+            self._set_worker_handlers()
+            status = 1
+            try:
+                self._run_worker(worker_id)
+                status = 0
+            except Exception as e:
+                logger.error("worker %s (%s) failed: %s" % (worker_id,
+                                                            self.pid, e))
+            finally:
+                # never return into the supervisor's loop
+                os._exit(status)
+        self._workers[pid] = worker_id
+        return pid
+
+    def _run_worker(self, worker_id):
+        self.worker_id = worker_id
+        # don't share the supervisor's random state
+        random.seed()
+        self.set_pid()
+        self._set_worker_handlers()
+        self._prepare_web_app()
+        self.server.add_sockets(self._sockets)
+        logger.debug("worker %s (%s) started" % (worker_id, self.pid))
+        IOLoop.instance().start()
+        self.remove_pid(quiet=True)
+
+    def _set_worker_handlers(self):
+        signal.signal(signal.SIGTERM, self._worker_stop_handler)
+        signal.signal(signal.SIGINT, self._worker_stop_handler)
+
+    def _supervisor_stop_handler(self, sig, frame):
+        logger.debug("[SUPERVISOR] (%s) recieved signal %s" % (self.pid,
+                                                               sig))
+        self._stop_workers()
+
+    def _stop_workers(self):
+        self._stopping = True
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass  # already gone
+
+    def _worker_stop_handler(self, sig, frame):
+        logger.debug("[WORKER] (%s) recieved signal %s" % (self.pid, sig))
+        IOLoop.instance().add_callback_from_signal(self._drain)
+
+    def _drain(self):
+        # stop accepting new connections; stop the ioloop once the
+        # requests in flight are finished, or drain_timeout passed
+        self.server.stop()
+        deadline = time.time() + self.config.drain_timeout
+        self._wait_drained(deadline)
+
+    def _wait_drained(self, deadline):
+        requests = self.server.requests
+        if requests <= 0:
+            self._stop_ioloop()
+        elif time.time() >= deadline:
+            logger.warn("stopping with %s requests in flight" % requests)
+            self._stop_ioloop()
+        else:
+            IOLoop.instance().add_timeout(
+                time.time() + DRAIN_POLL_INTERVAL,
+                partial(self._wait_drained, deadline))
+
     def start(self, fork=False):
         ''' Start a new tornado web app '''
-        self._prepare_web_app()
+        workers = self.worker_count
+        if workers > 1:
+            spawn = partial(self.spawn_workers, workers)
+        else:
+            self._prepare_web_app()
+            spawn = self.spawn_instance
         if fork:
             pid = os.fork()
             if pid == 0:
-                self.spawn_instance()
+                spawn()
         else:
             pid = self.pid
-            self.spawn_instance()
+            spawn()
         return pid
 
     def stop(self, delay=None):
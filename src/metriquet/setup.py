@@ -14,11 +14,11 @@ __desc__ = 'Metrique - Generic Tornado Server'
 __scripts__ = []
 __requires__ = [
     'metriqueu',
-    'tornado (==3.2)',
+    'tornado (==4.0.2)',
 ]
 __irequires__ = [
     'metriqueu',
-    'tornado==3.2',
+    'tornado==4.0.2',
 ]
 pip_src = 'https://pypi.python.org/packages/source'
 __deplinks__ = []
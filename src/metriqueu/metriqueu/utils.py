@@ -25,6 +25,7 @@ def batch_gen(data, batch_size):
     if batch_size <= 0:
         # override: yield the whole list
         yield data
+        return
 
     for i in range(0, len(data), batch_size):
         yield data[i:i + batch_size]
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+# Author: "Chris Ward" <cward@redhat.com>
+
+'''
+metriqueu.wire
+~~~~~~~~~~~~~~
+
+This module contains the wire format (content type) encoders and
+decoders shared by metrique clients and metriqued.
+
+JSON is always available. msgpack and BSON are available only if
+the `msgpack` and `bson` (pymongo) modules are installed.
+
+Datetimes and bson Timestamps are always sent as epoch floats,
+whichever wire format is used.
+'''
+
+from datetime import datetime
+from struct import unpack_from
+try:
+    import bson
+    from bson.timestamp import Timestamp
+except ImportError:
+    bson = Timestamp = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from metriqueu.utils import dt2ts
+
+JSON = 'application/json'
+NDJSON = 'application/x-ndjson'
+MSGPACK = 'application/x-msgpack'
+BSON = 'application/bson'
+
+# HTTP header used by metriqued to advertise the formats it accepts
+FORMATS_HEADER = 'X-Metrique-Formats'
+# HTTP header used by metriqued to advertise the request body
+# (Content-Encoding) compressions it accepts
+ENCODINGS_HEADER = 'X-Metrique-Encodings'
+
+
+def available_formats():
+    '''
+    Return back the list of wire formats available locally,
+    in order of preference.
+    '''
+    formats = []
+    if msgpack:
+        formats.append(MSGPACK)
+    if bson:
+        formats.append(BSON)
+    formats.append(JSON)
+    return formats
+
+
+def negotiate(accept, available=None):
+    '''
+    Pick the first content type listed in an HTTP Accept header
+    which is available. Defaults to JSON.
+
+    :param accept: Accept header value
+    :param available: list of available content types
+    '''
+    available = available or available_formats()
+    for content_type in (accept or '').split(','):
+        content_type = content_type.split(';')[0].strip()
+        if content_type in available:
+            return content_type
+    return JSON
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return dt2ts(obj)
+    elif Timestamp and isinstance(obj, Timestamp):
+        return obj.time
+    else:
+        raise TypeError('%r is not serializable' % obj)
+
+
+def _to_bson(obj):
+    # bson has no 'default' hook; convert dates to epoch ourselves
+    if isinstance(obj, dict):
+        return dict((k, _to_bson(v)) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        return [_to_bson(v) for v in obj]
+    elif isinstance(obj, (datetime, Timestamp)):
+        return _default(obj)
+    else:
+        return obj
+
+
+def encode(value, content_type=JSON):
+    '''
+    Encode a value as the given content type.
+
+    :param value: value to encode
+    :param content_type: wire format to encode with
+    '''
+    if content_type == MSGPACK:
+        return msgpack.packb(value, default=_default)
+    elif content_type == BSON:
+        # bson documents must be dicts; wrap the value
+        return bson.BSON.encode({'v': _to_bson(value)})
+    else:
+        return json.dumps(value, default=_default, ensure_ascii=False)
+
+
+def decode(data, content_type=JSON):
+    '''
+    Decode data of the given content type.
+
+    :param data: string to decode
+    :param content_type: wire format to decode from
+    '''
+    content_type = (content_type or '').split(';')[0].strip()
+    if content_type == MSGPACK:
+        return msgpack.unpackb(data, encoding='utf-8')
+    elif content_type == BSON:
+        return bson.BSON(data).decode()['v']
+    else:
+        return json.loads(data)
+
+
+def encode_stream(objects, content_type=JSON):
+    '''
+    Encode a batch of objects for a streamed response; as newline
+    delimited JSON or as concatenated msgpack or bson objects.
+
+    :param objects: list of objects to encode
+    :param content_type: wire format to encode with
+    '''
+    if content_type == MSGPACK:
+        return ''.join(msgpack.packb(o, default=_default) for o in objects)
+    elif content_type == BSON:
+        return ''.join(bson.BSON.encode(_to_bson(o)) for o in objects)
+    else:
+        return ''.join(json.dumps(o, default=_default, ensure_ascii=False) +
+                       '\n' for o in objects)
+
+
+def decode_stream(chunks, content_type=JSON):
+    '''
+    Decode a streamed response, yielding back objects as soon as
+    they have been completely received.
+
+    :param chunks: iterable of strings, as received
+    :param content_type: wire format to decode from
+    '''
+    content_type = (content_type or '').split(';')[0].strip()
+    if content_type == MSGPACK:
+        unpacker = msgpack.Unpacker(encoding='utf-8')
+        for chunk in chunks:
+            unpacker.feed(chunk)
+            for obj in unpacker:
+                yield obj
+    elif content_type == BSON:
+        buf = ''
+        for chunk in chunks:
+            buf += chunk
+            offset = 0
+            # bson documents are prefixed by their int32 byte length
+            while len(buf) - offset >= 4:
+                size = unpack_from('<i', buf, offset)[0]
+                if len(buf) - offset < size:
+                    break
+                yield bson.BSON(buf[offset:offset + size]).decode()
+                offset += size
+            buf = buf[offset:]
+    else:
+        buf = ''
+        for chunk in chunks:
+            lines = (buf + chunk).split('\n')
+            buf = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+        if buf.strip():
+            yield json.loads(buf)
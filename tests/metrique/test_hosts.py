@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+# Author: "Chris Ward" <cward@redhat.com>
+
+import time
+
+
+def test_host_selector():
+    from metrique.hosts import HostSelector
+
+    a, b, c = 'http://a:5420/ping', 'http://b:5420/ping', 'http://c:5420/ping'
+    urls = [a, b, c]
+
+    hosts = HostSelector('ordered')
+    assert hosts.order(urls) == urls
+    assert hosts.order(urls, offset=1) == [b, c, a]
+
+    hosts = HostSelector('round_robin')
+    assert [hosts.order(urls)[0] for i in range(4)] == [a, b, c, a]
+
+    hosts = HostSelector('least_latency')
+    hosts.success(a, 0.5)
+    hosts.success(b, 0.1)
+    # c has no latency samples yet
+    assert hosts.order(urls) == [c, b, a]
+
+    hosts = HostSelector('ordered', max_failures=2, reset_timeout=0.05)
+    hosts.failure(a)
+    assert hosts.order(urls) == urls
+    hosts.failure(a)
+    # a is down; tried last
+    assert hosts.order(urls) == [b, c, a]
+    assert hosts.stats()['a:5420']['up'] is False
+    time.sleep(0.06)
+    assert hosts.order(urls) == urls
+    hosts.success(a)
+    assert hosts.stats()['a:5420'] == {'failures': 0, 'latency': None,
+                                       'up': True}
@@ -98,3 +98,26 @@ def test_json_encode():
 
     _dct = json.loads(json.dumps(dct, default=json_encode))
     assert isinstance(_dct["a"], float)
+
+
+def test_ndjson_gen():
+    ' args: objects, gzip=False, batch_size=1000 '
+    from metrique.utils import ndjson_gen
+    import zlib
+
+    objects = [{"a": i, "u": u"\u2603", "t": datetime(2000, 1, 1)}
+               for i in range(10)]
+
+    chunks = list(ndjson_gen(objects, batch_size=3))
+    assert len(chunks) == 4
+    lines = ''.join(chunks).splitlines()
+    assert len(lines) == 10
+    _objects = [json.loads(l) for l in lines]
+    assert [o['a'] for o in _objects] == range(10)
+    assert _objects[0]['u'] == u"\u2603"
+    assert isinstance(_objects[0]['t'], float)
+
+    chunks = list(ndjson_gen(objects, gzip=True, batch_size=3))
+    assert all(chunks)
+    z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert ''.join(z.decompress(c) for c in chunks).splitlines() == lines
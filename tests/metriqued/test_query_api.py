@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+# Author: "Chris Ward" <cward@redhat.com>
+
+
+def test_merge_docs():
+    from metriqued.query_api import _merge_docs
+
+    docs = [{'_oid': 1, '_start': 1, '_end': 2, 'a': 1},
+            {'_oid': 1, '_start': 2, '_end': 3, 'a': 1},
+            {'_oid': 1, '_start': 3, '_end': 4, 'a': 2},
+            # gap between versions; not merged
+            {'_oid': 1, '_start': 5, '_end': None, 'a': 2},
+            {'_oid': 2, '_start': 1, '_end': 2, 'a': 2},
+            {'_oid': 2, '_start': 2, '_end': None, 'a': 2}]
+    merged = list(_merge_docs(docs))
+    assert merged == [{'_oid': 1, '_start': 1, '_end': 3, 'a': 1},
+                      {'_oid': 1, '_start': 3, '_end': 4, 'a': 2},
+                      {'_oid': 1, '_start': 5, '_end': None, 'a': 2},
+                      {'_oid': 2, '_start': 1, '_end': None, 'a': 2}]
+    assert list(_merge_docs([])) == []
+
+
+def test_page_token():
+    from bson.tz_util import utc
+    from datetime import datetime
+    from metriqued.query_api import _page_token, _page_token_key
+    from metriqued.query_api import _query_fingerprint
+
+    fingerprint = _query_fingerprint('owner', 'cube', 'a == 1', None, '~')
+    assert fingerprint != _query_fingerprint('owner', 'cube', 'a == 2',
+                                             None, '~')
+    token = _page_token(fingerprint, 'abc')
+    assert _page_token_key(token, fingerprint) == 'abc'
+    # bson typed keys are decoded back to the same type
+    key = datetime(2014, 1, 1, tzinfo=utc)
+    assert _page_token_key(_page_token(fingerprint, key), fingerprint) == key
+    try:
+        _page_token(fingerprint, object())
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
+    for token, fingerprint in [(token, 'other'), ('garbage', fingerprint)]:
+        try:
+            _page_token_key(token, fingerprint)
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected ValueError'
+
+
+def test_sample_reservoir():
+    from metriqued.query_api import SampleHdlr
+
+    class Cube(object):
+        def find(self, spec, fields=None):
+            return iter({'_oid': i} for i in range(100))
+
+    docs = SampleHdlr._sample_reservoir(Cube(), {}, 10)
+    assert len(docs) == 10
+    assert len(set(d['_oid'] for d in docs)) == 10
+    assert len(SampleHdlr._sample_reservoir(Cube(), {}, 1000)) == 100
+
+
+def test_find_page_merged():
+    from metriqued.query_api import FindHdlr
+
+    docs = [{'_oid': 1, '_start': 1, '_end': 2, 'a': 1},
+            {'_oid': 1, '_start': 2, '_end': 3, 'a': 1},
+            {'_oid': 1, '_start': 3, '_end': None, 'a': 2},
+            {'_oid': 2, '_start': 1, '_end': None, 'a': 1},
+            {'_oid': 3, '_start': 1, '_end': None, 'a': 1}]
+
+    class Cursor(list):
+        def close(self):
+            pass
+
+    class Cube(object):
+        def find(self, spec, fields=None, sort=None):
+            last = spec.get('_oid', {}).get('$gt')
+            return Cursor(d for d in docs if last is None or d['_oid'] > last)
+
+    hdlr = FindHdlr.__new__(FindHdlr)
+    hdlr.requires_read = lambda owner, cube: True
+    hdlr.get_fields = lambda owner, cube, fields: {
+        '_id': 0, '_oid': 1, '_start': 1, '_end': 1, 'a': 1}
+    hdlr.snapshot_sources = lambda *args, **kwargs: [(Cube(), {})]
+
+    pages, token = [], None
+    while True:
+        page = hdlr.find_page('owner', 'cube', '', 'a', date='~',
+                              page_size=1, page_token=token)
+        pages.append([(d['_oid'], d['_start']) for d in page['objects']])
+        token = page['page_token']
+        if not token:
+            break
+    # all of the last _oid's (merged) versions are kept in its page,
+    # even past page_size; the next page starts after that _oid
+    assert pages == [[(1, 1), (1, 3)], [(2, 1)], [(3, 1)]]
+
+
+def test_history_zero_counts():
+    from metriqued.query_api import HistoryHdlr
+
+    class Rollups(object):
+        def find(self, spec, fields=None):
+            return []
+
+    # 'a' started and ended between the two dates
+    rows = [('a', 10, 20, 1), ('b', 1, None, 2)]
+    hdlr = HistoryHdlr.__new__(HistoryHdlr)
+    hdlr.requires_read = lambda owner, cube: True
+    hdlr._group_versions = lambda owner, cube, spec, by_field: iter(rows)
+    hdlr.rollups = lambda: Rollups()
+
+    expected = [{'date': 5.0, 'values': [{'g': 'b', 'count': 2}]},
+                {'date': 30.0, 'values': [{'g': 'b', 'count': 2}]}]
+    # counted from the cube
+    hdlr.cube_rollups = lambda owner, cube: (None, None)
+    assert hdlr.history('o', 'c', '', 'g', [5, 30]) == expected
+    # and from its rollups
+    hdlr.cube_rollups = lambda owner, cube: ([None, 'g'], 'build')
+    assert hdlr.history('o', 'c', '', 'g', [5, 30]) == expected
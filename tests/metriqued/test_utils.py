@@ -4,6 +4,7 @@
 
 from datetime import datetime
 import pytz
+import time
 
 from metriqueu.utils import dt2ts
 
@@ -63,3 +64,176 @@ def test_query_add_date():
     assert _(q, '~') == q
     assert _(q, None) == '%s and _end == None' % q
     assert _(q, '~%s' % d1) == '%s and %s' % (q, _pql)
+
+
+def test_lru_cache():
+    from metriqued.utils import LRUCache
+
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    # b is now the least recently used
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    assert cache.stats() == {'size': 2, 'maxsize': 2, 'hits': 2, 'misses': 1}
+
+    cache = LRUCache(ttl=0.01)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    time.sleep(0.02)
+    assert cache.get('a') is None
+
+
+def test_result_size():
+    from metriqued.utils import result_size
+
+    assert result_size([{'a': 1}, {'a': 2}]) == 2
+    assert result_size({'result': [1, 2, 3], 'ok': 1}) == 3
+    assert result_size({'a': 1}) == 1
+    assert result_size(10) == 1
+
+
+def test_parse_pql_query():
+    from metriqued.utils import parse_pql_query, PQL_CACHE
+
+    PQL_CACHE.clear()
+    assert parse_pql_query('') == {}
+    assert parse_pql_query(None, date=None) == {'_end': None}
+    spec = parse_pql_query(' a == 1 ', date=None)
+    assert spec == {'$and': [{'a': 1}, {'_end': None}]}
+    # cached specs are not modified by callers
+    spec['$and'].append({'b': 2})
+    assert parse_pql_query('a == 1') == {'a': 1}
+    assert len(PQL_CACHE) == 1
+    # the date applies to the whole query
+    spec = parse_pql_query('a == 1 or b == 2', date=None)
+    assert spec == {'$and': [{'$or': [{'a': 1}, {'b': 2}]}, {'_end': None}]}
+
+
+def test_log_pipeline():
+    from metriqued.utils import LogPipeline
+    from threading import Event
+
+    batches = []
+    release = Event()
+
+    def handler(batch):
+        release.wait()
+        batches.append(batch)
+
+    pipeline = LogPipeline(handler, maxsize=3, batch_size=2)
+    results = [pipeline.put(i) for i in range(6)]
+    # 1 object is held by the (blocked) handler thread, at most
+    assert results[:3] == [True] * 3
+    assert results[-1] is False
+    release.set()
+    pipeline.join()
+    handled = [i for batch in batches for i in batch]
+    assert handled == range(len(handled))
+    assert all(len(batch) <= 2 for batch in batches)
+    stats = pipeline.stats()
+    assert stats['handled'] == len(handled)
+    assert stats['dropped'] == 6 - len(handled)
+    assert stats['queued'] == 0
+
+
+def test_rollup_version():
+    from metriqued.utils import rollup_version, rollup_key, ROLLUP_DAY
+
+    day = 1400025600.0
+    deltas = {}
+    fields = [None, 'g']
+    rollup_version(deltas, fields, {'_start': day + 10, '_end': None,
+                                    'g': 'a'})
+    # a version which started and ended on the same day cancels out
+    rollup_version(deltas, fields, {'_start': day + 20,
+                                    'g': ['a', 'b'],
+                                    '_end': day + ROLLUP_DAY - 1})
+    # removing versions
+    rollup_version(deltas, fields, {'_start': day, 'g': 'a',
+                                    '_end': day + ROLLUP_DAY + 1}, count=-2)
+    assert deltas[(None, rollup_key(None), day)] == [None, -1]
+    assert deltas[('g', rollup_key('a'), day)] == ['a', -1]
+    assert deltas[('g', rollup_key(['a', 'b']), day)] == [['a', 'b'], 0]
+    next_day = day + ROLLUP_DAY
+    assert deltas[(None, rollup_key(None), next_day)] == [None, 2]
+    assert deltas[('g', rollup_key('a'), next_day)] == ['a', 2]
+    assert len(deltas) == 5
+
+
+def test_current_at():
+    from metriqued.utils import current_at
+
+    assert current_at({'_start': 1, '_end': None}, 1)
+    assert current_at({'_start': 1, '_end': 3}, 3)
+    assert not current_at({'_start': 1, '_end': 3}, 4)
+    assert not current_at({'_start': 2}, 1)
+
+
+def test_and_date_specs():
+    from metriqued.utils import and_date_specs, date_spec, parse_pql_query
+
+    assert and_date_specs({'a': 1}, date_spec(None)) == {'$and': [
+        {'a': 1}, {'_end': None}]}
+    spec = parse_pql_query('a == 1', '2000-01-01')
+    start, current = date_spec('2000-01-01')
+    assert spec == {'$or': [{'$and': [{'a': 1}, start, clause]}
+                            for clause in current['$or']]}
+    assert and_date_specs({}, [start]) == start
+
+
+def test_explain_summary():
+    from metriqued.utils import explain_summary
+
+    # mongodb 2.x
+    explain = {'clauses': [{'cursor': 'BtreeCursor _end_1__start_1'},
+                           {'cursor': 'BasicCursor'}],
+               'n': 2, 'nscannedObjects': 10}
+    assert explain_summary(explain) == {'indexes': ['_end_1__start_1'],
+                                        'collscan': True, 'n': 2,
+                                        'scanned': 10}
+    # mongodb >= 3.0
+    ixscan = {'stage': 'FETCH',
+              'inputStage': {'stage': 'IXSCAN',
+                             'indexName': '_end_1__start_1'}}
+    explain = {'queryPlanner': {'winningPlan': {
+        'stage': 'SUBPLAN', 'inputStage': {
+            'stage': 'OR', 'inputStages': [ixscan, ixscan]}}},
+        'executionStats': {'nReturned': 2, 'totalDocsExamined': 2}}
+    assert explain_summary(explain) == {'indexes': ['_end_1__start_1'],
+                                        'collscan': False, 'n': 2,
+                                        'scanned': 2}
+
+
+def test_gzip_decoder():
+    from metriqued.utils import GzipDecoder
+    import zlib
+
+    z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    body = z.compress('x' * 1000) + z.flush()
+
+    decoder = GzipDecoder()
+    assert decoder.decompress(body) + decoder.flush() == 'x' * 1000
+
+    decoder = GzipDecoder(1000)
+    data = decoder.decompress(body[:10]) + decoder.decompress(body[10:])
+    assert data + decoder.flush() == 'x' * 1000
+
+    decoder = GzipDecoder(999)
+    try:
+        decoder.decompress(body)
+    except ValueError:
+        # never more than one byte past the limit is decompressed
+        assert decoder.size == 1000
+    else:
+        assert False, 'expected ValueError'
+
+    try:
+        GzipDecoder().decompress('not gzip')
+    except zlib.error:
+        pass
+    else:
+        assert False, 'expected zlib.error'
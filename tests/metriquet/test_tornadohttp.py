@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+# Author: "Chris Ward" <cward@redhat.com>
+
+import glob
+import os
+import signal
+import socket
+import tempfile
+import time
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _server(**kwargs):
+    from metriquet.tornadohttp import TornadoHTTPServer
+
+    config = dict(port=_free_port(), piddir=tempfile.mkdtemp(),
+                  logstdout=False, worker_restart_delay=0)
+    config.update(kwargs)
+    return TornadoHTTPServer(**config)
+
+
+def _supervise(server, workers):
+    # run the supervisor in a child process; its exit status
+    # tells if it stopped cleanly (0) or raised (3)
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            server.spawn_workers(workers)
+            status = 0
+        except RuntimeError:
+            status = 3
+        finally:
+            os._exit(status)
+    return pid
+
+
+def _wait(pid, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        _pid, status = os.waitpid(pid, os.WNOHANG)
+        if _pid:
+            return os.WEXITSTATUS(status)
+        time.sleep(0.05)
+    os.kill(pid, signal.SIGKILL)
+    assert False, 'supervisor did not stop'
+
+
+def _worker_pids(server, supervisor, count, dead=None, timeout=10):
+    pattern = os.path.join(server.config.piddir, '*.pid')
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pids = set(int(os.path.basename(path).split('.')[1])
+                   for path in glob.glob(pattern)) - set([supervisor])
+        if len(pids) == count and dead not in pids:
+            return pids
+        time.sleep(0.05)
+    assert False, 'expected %s workers; got %s' % (count, pids)
+
+
+def test_spawn_workers():
+    server = _server()
+    supervisor = _supervise(server, 2)
+    try:
+        pids = _worker_pids(server, supervisor, 2)
+        # killed workers are restarted
+        dead = pids.pop()
+        os.kill(dead, signal.SIGKILL)
+        restarted = _worker_pids(server, supervisor, 2, dead) - pids
+        assert len(restarted) == 1
+    finally:
+        os.kill(supervisor, signal.SIGTERM)
+    assert _wait(supervisor) == 0
+    assert glob.glob(os.path.join(server.config.piddir, '*.pid')) == []
+
+
+def test_spawn_workers_restart_limit():
+    server = _server(worker_max_restarts=2)
+
+    def _fail():
+        raise ValueError('broken worker')
+    server._prepare_web_app = _fail
+    supervisor = _supervise(server, 2)
+    # workers failing on startup are only restarted twice
+    assert _wait(supervisor) == 3
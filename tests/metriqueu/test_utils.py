@@ -36,6 +36,10 @@ def test_batch_gen():
 
     assert len(tuple(batch_gen(range(100000), 1))) == 100000
 
+    # batch_size <= 0 yields back the whole list, once
+    assert len(tuple(batch_gen(range(50), 0))) == 1
+    assert len(next(batch_gen(range(50), -1))) == 50
+
 
 def test_dt2ts():
     '''  '''
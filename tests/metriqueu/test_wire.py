@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+# Author: "Chris Ward" <cward@redhat.com>
+
+from datetime import datetime
+
+from metriqueu.utils import dt2ts
+
+
+def test_negotiate():
+    from metriqueu.wire import negotiate, JSON, MSGPACK, BSON
+
+    available = [MSGPACK, BSON, JSON]
+    assert negotiate(None, available) == JSON
+    assert negotiate('*/*', available) == JSON
+    assert negotiate('application/bson, application/json',
+                     available) == BSON
+    assert negotiate('text/html;q=0.9, application/x-msgpack;q=0.8',
+                     available) == MSGPACK
+    # not available locally
+    assert negotiate(MSGPACK, [JSON]) == JSON
+
+
+def test_encode_decode():
+    from metriqueu import wire
+
+    now = datetime(2000, 1, 1, 0, 0, 0)
+    value = [{'_oid': 1, '_start': now, '_end': None,
+              'name': u'metrique', 'tags': ('a', 'b')}]
+    expected = [{'_oid': 1, '_start': dt2ts(now), '_end': None,
+                 'name': u'metrique', 'tags': ['a', 'b']}]
+    for content_type in wire.available_formats():
+        data = wire.encode(value, content_type)
+        assert isinstance(data, basestring)
+        assert wire.decode(data, content_type) == expected
+    # content-type header parameters are ignored
+    data = wire.encode(value)
+    assert wire.decode(data, 'application/json; charset=UTF-8') == expected
+
+
+def test_encode_decode_stream():
+    from metriqueu import wire
+
+    objects = [{'_oid': i, 'name': u'metrique'} for i in range(5)]
+    for content_type in wire.available_formats():
+        data = wire.encode_stream(objects, content_type)
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        # split the stream at arbitrary boundaries
+        chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+        assert list(wire.decode_stream(chunks, content_type)) == objects